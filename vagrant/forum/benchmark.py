@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# benchmark.py -- measures full-text search over a large generated corpus,
+# against a LIKE scan of the same posts
+#
+# The corpus is written to its own database, FORUM_BENCH_DSN (default
+# dbname=forum_bench), which must exist; its posts table is dropped and
+# created again from forum.sql.
+#
+# Usage: python benchmark.py [number of posts]
+#
+
+import os
+import random
+import sys
+import time
+from cStringIO import StringIO
+
+import psycopg2
+
+import forumdb
+
+BENCH_DSN = os.environ.get('FORUM_BENCH_DSN', 'dbname=forum_bench')
+DEFAULT_POSTS = 1000000
+REPEAT = 5
+
+# Words of the generated posts; the first ones are used far more often than
+# the last ones, as in real text, so the queries below find many, some or few
+# posts.
+VOCABULARY = ('the of and to in is that for it as with was on be by this are '
+              'post forum reply thread database query index server page user '
+              'message question answer python postgres search table column '
+              'vacuum replication transaction cursor trigger partition '
+              'tokenizer stemming lexeme rank headline snippet dictionary '
+              'zeppelin quokka marmalade').split()
+QUERIES = ['database', 'postgres replication', 'vacuum partition',
+           'quokka marmalade']
+
+
+def word():
+    """Returns a random word; the nth word is used about 1/n^2 as often."""
+    while True:
+        n = int(random.paretovariate(1.0)) - 1
+        if n < len(VOCABULARY):
+            return VOCABULARY[n]
+
+
+def createCorpus(size):
+    """Creates the posts table in the benchmark database with size posts."""
+    conn = psycopg2.connect(BENCH_DSN)
+    c = conn.cursor()
+    c.execute('DROP TABLE IF EXISTS posts')
+    c.execute(open(os.path.join(os.path.dirname(__file__) or '.',
+                                'forum.sql')).read())
+    batch = 100000
+    for start in range(0, size, batch):
+        rows = StringIO()
+        for n in range(start, min(start + batch, size)):
+            rows.write(' '.join(word() for i in range(random.randint(5, 60))))
+            rows.write('\n')
+        rows.seek(0)
+        c.copy_from(rows, 'posts', columns=('content',))
+    conn.commit()
+    c.execute('ANALYZE posts')
+    conn.commit()
+    conn.close()
+
+
+def timeIt(function, *args):
+    """Returns the best time of REPEAT calls, and the last call's result."""
+    best = None
+    for i in range(REPEAT):
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def likeSearch(query, limit=forumdb.PAGE_SIZE):
+    """The search without the index: every post is scanned for every word."""
+    with forumdb.cursor() as c:
+        words = query.split()
+        c.execute('select content, time, id from posts where ' +
+                  ' and '.join(['content ilike %s'] * len(words)) +
+                  ' order by time desc, id desc limit %s',
+                  ['%' + w + '%' for w in words] + [limit])
+        return c.fetchall()
+
+
+def countMatches(query):
+    with forumdb.cursor() as c:
+        c.execute("select count(*) from posts "
+                  "where search @@ plainto_tsquery('english', %s)", (query,))
+        return c.fetchone()[0]
+
+
+def main(size):
+    print 'Generating %d posts...' % size
+    start = time.time()
+    createCorpus(size)
+    print 'Done in %.1f s' % (time.time() - start)
+
+    forumdb.DSN = BENCH_DSN
+    print '%-24s %10s %14s %14s %14s' % ('Query', 'Matches', 'Search (ms)',
+                                        'Page 5 (ms)', 'LIKE (ms)')
+    for query in QUERIES:
+        search, posts = timeIt(forumdb.SearchPosts, query)
+        later, posts = timeIt(forumdb.SearchPosts, query, forumdb.PAGE_SIZE,
+                              4 * forumdb.PAGE_SIZE)
+        like, rows = timeIt(likeSearch, query)
+        print '%-24s %10d %14.1f %14.1f %14.1f' % (
+            query, countMatches(query), search * 1000, later * 1000,
+            like * 1000)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_POSTS)
@@ -0,0 +1,224 @@
+#
+# Real-time events for the forum server: new posts, and the standings of the
+# tournaments on the same server, pushed to clients as server-sent events.
+#
+# Writers announce changes with PostgreSQL's NOTIFY: forumdb when it saves
+# posts, tournament.py when it records results or registers players.  The Hub
+# LISTENs with one connection per database, from a background thread, reads
+# what changed once and fans it out to every connected client, however many
+# there are.
+#
+
+import logging
+import os
+import Queue
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+import fanout
+import forumdb
+
+## The tournament database, whose standings are pushed to the clients that
+## follow a tournament
+TOURNAMENT_DSN = os.environ.get('TOURNAMENT_DSN', 'dbname=tournament')
+
+## Channels notified by the writers: the payload is a comma separated list
+## of the new posts' ids, or the registration of the tournament that changed
+POSTS_CHANNEL = forumdb.NOTIFY_CHANNEL
+RESULTS_CHANNEL = 'tournament_results'
+
+## Seconds between the comments sent to idle clients, so that connections
+## closed by the client are noticed
+HEARTBEAT = 15
+
+## Clients streamed to at the same time by one server process.  Each holds a
+## server thread, so this should stay below the server's --threads to leave
+## some for serving pages; forum_async.py streams to any number of clients.
+MAX_STREAMS = int(os.environ.get('FORUM_MAX_STREAMS', 4))
+
+## Events queued for a client before it is considered stuck and disconnected
+CLIENT_QUEUE = 1000
+
+## Seconds to wait before connecting again after losing a listener connection
+RECONNECT = 5
+
+log = logging.getLogger('events')
+
+class Listener(object):
+    '''LISTENs on one channel of a database from a background thread.
+
+    handle(conn, payloads) is called on the thread with the listening
+    connection, which it may use for its own queries, and the distinct
+    payloads of the notifications received together.  payloads is empty when
+    the thread was woken with wake(), and None after (re)connecting, as
+    notifications may have been missed.
+    '''
+
+    def __init__(self, dsn, channel, handle):
+        self.dsn = dsn
+        self.channel = channel
+        self.handle = handle
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wakeFds = None
+        self._stopped = False
+
+    def start(self):
+        '''Starts the thread, unless it is running already.'''
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    # The pipe is made here rather than in __init__, so that
+                    # each pre-forked worker process has its own
+                    self._wakeFds = os.pipe()
+                    self._thread = threading.Thread(target=self._run)
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def wake(self):
+        '''Makes the thread call handle() with no payloads soon.'''
+        if self._wakeFds is not None:
+            os.write(self._wakeFds[1], 'x')
+
+    def stop(self):
+        self._stopped = True
+        self.wake()
+
+    def _run(self):
+        while not self._stopped:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(
+                    psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute('LISTEN %s;' % self.channel)
+                self.handle(conn, None)
+                self._listen(conn)
+            except Exception:
+                log.exception('Listening on %s failed', self.channel)
+                time.sleep(RECONNECT)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def _listen(self, conn):
+        wakeFd = self._wakeFds[0]
+        while not self._stopped:
+            readable = select.select([conn, wakeFd], [], [])[0]
+            woken = wakeFd in readable
+            if woken:
+                os.read(wakeFd, 4096)
+            conn.poll()
+            payloads = []
+            for notify in conn.notifies:
+                if notify.payload not in payloads:
+                    payloads.append(notify.payload)
+            del conn.notifies[:]
+            if (payloads or woken) and not self._stopped:
+                self.handle(conn, payloads)
+
+class Subscriber(object):
+    '''A connected client: the server-sent events queued for it.'''
+
+    def __init__(self, registration):
+        self.registration = registration
+        self.queue = Queue.Queue(CLIENT_QUEUE)
+        # Still waiting for the first standings of its tournament
+        self.waiting = registration is not None
+        self.closed = False
+
+    def next(self, timeout=HEARTBEAT):
+        '''Returns the next event to send, a comment if there was none within
+        timeout seconds, or None once the client should be disconnected.
+        '''
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return ':\n\n'
+
+class Hub(fanout.Fanout):
+    '''Fans out the notified changes to every subscriber, see fanout.Fanout
+    for the events sent.  The listeners read the changes on their threads;
+    the subscribers are changed holding _lock.
+    '''
+
+    QueueFull = Queue.Full
+
+    def __init__(self, dsn, tournamentDsn, maxSubscribers):
+        fanout.Fanout.__init__(self)
+        self.maxSubscribers = maxSubscribers
+        self._lock = threading.Lock()
+        self._stats['refused'] = 0
+        self._posts = Listener(dsn, POSTS_CHANNEL, self._postsAdded)
+        self._results = Listener(tournamentDsn, RESULTS_CHANNEL,
+                                 self._resultsChanged)
+
+    def subscribe(self, registration=None):
+        '''Returns a new Subscriber to new posts and, if registration is
+        given, to the standings of that tournament, or None if there are
+        maxSubscribers already.
+        '''
+        subscriber = Subscriber(registration)
+        self._posts.start()
+        with self._lock:
+            if len(self._subscribers) >= self.maxSubscribers:
+                self._stats['refused'] += 1
+                return None
+            self._add(subscriber)
+        if subscriber.waiting:
+            self._results.start()
+            self._results.wake()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._remove(subscriber)
+
+    def close(self):
+        '''Disconnects every subscriber and stops listening.'''
+        self._posts.stop()
+        self._results.stop()
+        with self._lock:
+            self._disconnectAll()
+
+    def stats(self):
+        '''Returns the number of subscribers, of events sent, of subscribers
+        dropped for falling behind and of those refused, as a dictionary.
+        '''
+        with self._lock:
+            return self._counters()
+
+    def _postsAdded(self, conn, payloads):
+        '''Listener thread: sends the new posts to every subscriber.'''
+        if not payloads:
+            return
+        ids = [int(id) for payload in payloads for id in payload.split(',')]
+        c = conn.cursor()
+        c.execute("select content, time, id from posts where id = any(%s) "
+                  "order by time, id", (ids,))
+        rows = c.fetchall()
+        with self._lock:
+            self._postsRead(rows)
+
+    def _resultsChanged(self, conn, payloads):
+        '''Listener thread: reads the standings of the tournaments that
+        changed, or that new subscribers are waiting for, and sends each
+        subscriber what it is missing.
+        '''
+        with self._lock:
+            changed = self._changed(payloads)
+        c = conn.cursor()
+        for registration in changed:
+            c.execute("select id, name, points, matches, bye, omw "
+                      "from standings where registration = %s",
+                      (registration,))
+            standings = dict((row[0], row) for row in c.fetchall())
+            with self._lock:
+                self._update(registration, standings)
+
+## The hub of this server process
+hub = Hub(forumdb.DSN, TOURNAMENT_DSN, MAX_STREAMS)
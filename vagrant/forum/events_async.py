@@ -0,0 +1,172 @@
+#
+# Real-time events for the asyncio forum server (Python 3): the same events as
+# events.py, pushed to clients as server-sent events.
+#
+# The Hub LISTENs with one aiopg connection per database and fans every change
+# out to the connected clients.  Each client is a coroutine waiting on its
+# queue rather than a thread, so a server process can stream to thousands of
+# them.
+#
+
+import asyncio
+import logging
+import os
+
+import aiopg
+
+import fanout
+import forumdb_async
+
+## The tournament database, whose standings are pushed to the clients that
+## follow a tournament
+TOURNAMENT_DSN = os.environ.get('TOURNAMENT_DSN', 'dbname=tournament')
+
+## Channels notified by the writers, see events.py
+POSTS_CHANNEL = forumdb_async.NOTIFY_CHANNEL
+RESULTS_CHANNEL = 'tournament_results'
+
+## Seconds between the comments sent to idle clients, so that connections
+## closed by the client are noticed
+HEARTBEAT = 15
+
+## Events queued for a client before it is considered stuck and disconnected
+CLIENT_QUEUE = 1000
+
+## Seconds to wait before connecting again after losing a listener connection
+RECONNECT = 5
+
+log = logging.getLogger('events')
+
+class Subscriber(object):
+    '''A connected client: the server-sent events queued for it.'''
+
+    def __init__(self, registration):
+        self.registration = registration
+        self.queue = asyncio.Queue(CLIENT_QUEUE)
+        # Still waiting for the first standings of its tournament
+        self.waiting = registration is not None
+        self.closed = False
+
+    async def next(self, timeout=HEARTBEAT):
+        '''Returns the next event to send, a comment if there was none within
+        timeout seconds, or None once the client should be disconnected.
+        '''
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return ':\n\n'
+
+class Hub(fanout.Fanout):
+    '''Fans out the notified changes to every subscriber, see fanout.Fanout
+    for the events sent.
+
+    The listeners run as tasks of the event loop of the first subscribe(), and
+    every method must be called from that loop.
+    '''
+
+    QueueFull = asyncio.QueueFull
+
+    def __init__(self, dsn, tournamentDsn):
+        fanout.Fanout.__init__(self)
+        self._dsn = dsn
+        self._tournamentDsn = tournamentDsn
+        self._tasks = None
+        # channel -> the connection listening on it, while it is connected
+        self._connections = {}
+        # Keeps the queries on the tournament listener's connection one at a
+        # time
+        self._resultsLock = None
+
+    def subscribe(self, registration=None):
+        '''Returns a new Subscriber to new posts and, if registration is
+        given, to the standings of that tournament.
+        '''
+        if self._tasks is None:
+            self._resultsLock = asyncio.Lock()
+            self._tasks = [
+                asyncio.ensure_future(self._listen(
+                    self._dsn, POSTS_CHANNEL, self._postsAdded)),
+                asyncio.ensure_future(self._listen(
+                    self._tournamentDsn, RESULTS_CHANNEL,
+                    self._resultsChanged))]
+        subscriber = Subscriber(registration)
+        self._add(subscriber)
+        if subscriber.waiting and RESULTS_CHANNEL in self._connections:
+            # Otherwise it is read once the listener connects
+            asyncio.ensure_future(self._resultsChanged(
+                self._connections[RESULTS_CHANNEL], []))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._remove(subscriber)
+
+    async def close(self):
+        '''Disconnects every subscriber and stops listening.'''
+        self._disconnectAll()
+        if self._tasks is not None:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks = None
+
+    def stats(self):
+        '''Returns the number of subscribers, of events sent and of
+        subscribers dropped for falling behind, as a dictionary.
+        '''
+        return self._counters()
+
+    async def _listen(self, dsn, channel, handle):
+        '''Task: LISTENs on channel and calls handle(conn, payloads) with the
+        distinct payloads of the notifications received together, or None
+        after (re)connecting, as notifications may have been missed.
+        '''
+        while True:
+            try:
+                async with aiopg.connect(dsn) as conn:
+                    async with conn.cursor() as c:
+                        await c.execute('LISTEN %s' % channel)
+                    self._connections[channel] = conn
+                    await handle(conn, None)
+                    while True:
+                        payloads = [(await conn.notifies.get()).payload]
+                        while not conn.notifies.empty():
+                            payload = conn.notifies.get_nowait().payload
+                            if payload not in payloads:
+                                payloads.append(payload)
+                        await handle(conn, payloads)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Listening on %s failed', channel)
+            finally:
+                self._connections.pop(channel, None)
+            await asyncio.sleep(RECONNECT)
+
+    async def _postsAdded(self, conn, payloads):
+        '''Sends the new posts to every subscriber.'''
+        if not payloads:
+            return
+        ids = [int(id) for payload in payloads for id in payload.split(',')]
+        async with conn.cursor() as c:
+            await c.execute("select content, time, id from posts "
+                            "where id = any(%s) order by time, id", (ids,))
+            self._postsRead(await c.fetchall())
+
+    async def _resultsChanged(self, conn, payloads):
+        '''Reads the standings of the tournaments that changed, or that new
+        subscribers are waiting for, and sends each subscriber what it is
+        missing.
+        '''
+        async with self._resultsLock:
+            for registration in self._changed(payloads):
+                async with conn.cursor() as c:
+                    await c.execute("select id, name, points, matches, bye, "
+                                    "omw from standings "
+                                    "where registration = %s",
+                                    (registration,))
+                    standings = dict((row[0], row)
+                                     for row in await c.fetchall())
+                self._update(registration, standings)
+
+## The hub of this server process
+hub = Hub(forumdb_async.DSN, TOURNAMENT_DSN)
@@ -0,0 +1,150 @@
+#
+# The fan-out of new posts and tournament standings to the clients of
+# /events, shared by the threaded hub (events.py) and the asyncio one
+# (events_async.py): the server-sent events and the standings kept to work
+# out what changed.  It does no I/O, so it imports under Python 2 and 3.
+#
+
+import json
+
+def Message(event, data):
+    '''Returns a server-sent event of the given type with data as JSON.'''
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+def PlayerRow(row):
+    '''Returns a standings row as a dictionary, see playerStandings().'''
+    return dict(zip(('id', 'name', 'points', 'matches', 'bye', 'omw'), row))
+
+def StandingsMessage(registration, standings):
+    '''Returns the 'standings' event for every player of a tournament.'''
+    return Message('standings', {
+        'registration': registration,
+        'players': [PlayerRow(row) for id, row in sorted(standings.items())],
+        'removed': []})
+
+class Fanout(object):
+    '''The subscribers of a hub and what is sent to them.
+
+    Every subscriber gets a 'post' event for each new post.  Subscribers that
+    follow a tournament first get a 'standings' event with every player's
+    row, then a 'standings-changed' event with the rows that changed, and the
+    ids of the players removed, whenever the tournament's standings change.
+    The standings of the tournaments followed are kept in memory to work out
+    the changes; each change costs one query however many clients follow it.
+
+    A subscriber has a registration, or None, a queue of messages, and the
+    waiting and closed flags.  Subclasses set QueueFull to the exception the
+    queues raise when full, do the I/O, and serialize the calls to these
+    methods.
+    '''
+
+    QueueFull = None
+
+    def __init__(self):
+        self._subscribers = set()
+        # registration -> {id: row} of each tournament followed, once read
+        self._standings = {}
+        self._stats = {'events': 0, 'dropped': 0}
+
+    def _add(self, subscriber):
+        '''Adds a subscriber, sending it the standings of its tournament if
+        they are known already.
+        '''
+        self._subscribers.add(subscriber)
+        registration = subscriber.registration
+        if registration is not None:
+            standings = self._standings.get(registration)
+            if standings is not None:
+                self._send(subscriber,
+                           StandingsMessage(registration, standings))
+                subscriber.waiting = False
+
+    def _remove(self, subscriber):
+        self._subscribers.discard(subscriber)
+        registration = subscriber.registration
+        if registration is not None and not any(
+                other.registration == registration
+                for other in self._subscribers):
+            self._standings.pop(registration, None)
+
+    def _disconnectAll(self):
+        for subscriber in self._subscribers:
+            self._disconnect(subscriber)
+
+    def _counters(self):
+        stats = dict(self._stats)
+        stats['subscribers'] = len(self._subscribers)
+        return stats
+
+    def _send(self, subscriber, message):
+        if subscriber.closed:
+            return
+        try:
+            subscriber.queue.put_nowait(message)
+            self._stats['events'] += 1
+        except self.QueueFull:
+            self._stats['dropped'] += 1
+            self._disconnect(subscriber)
+
+    def _disconnect(self, subscriber):
+        subscriber.closed = True
+        # Makes room for the None that ends the subscriber's stream
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        subscriber.queue.put_nowait(None)
+
+    def _postsRead(self, rows):
+        '''Sends the (content, time, id) rows of new posts to everyone.'''
+        for row in rows:
+            message = Message('post', {'content': str(row[0]),
+                                       'time': str(row[1]), 'id': row[2]})
+            for subscriber in list(self._subscribers):
+                self._send(subscriber, message)
+
+    def _changed(self, payloads):
+        '''Returns the registrations whose standings should be read, in
+        order: those followed that changed according to the payloads of
+        their notifications, or every one followed if payloads is None, and
+        those not read yet.
+        '''
+        followed = set(subscriber.registration
+                       for subscriber in self._subscribers
+                       if subscriber.registration is not None)
+        if payloads is None:
+            changed = followed
+        else:
+            changed = followed.intersection(payloads)
+            changed.update(registration for registration in followed
+                           if registration not in self._standings)
+            changed.update(subscriber.registration
+                           for subscriber in self._subscribers
+                           if subscriber.waiting)
+        return sorted(changed)
+
+    def _update(self, registration, standings):
+        '''Sends the changes to a tournament's standings, {id: row}, to its
+        subscribers.
+        '''
+        subscribers = [subscriber for subscriber in self._subscribers
+                       if subscriber.registration == registration]
+        if not subscribers:
+            return
+        old = self._standings.get(registration)
+        self._standings[registration] = standings
+        if old is not None:
+            players = [row for id, row in sorted(standings.items())
+                       if old.get(id) != row]
+            removed = sorted(id for id in old if id not in standings)
+            if players or removed:
+                message = Message('standings-changed', {
+                    'registration': registration,
+                    'players': [PlayerRow(row) for row in players],
+                    'removed': removed})
+                for subscriber in subscribers:
+                    if not subscriber.waiting:
+                        self._send(subscriber, message)
+        message = StandingsMessage(registration, standings)
+        for subscriber in subscribers:
+            if subscriber.waiting:
+                subscriber.waiting = False
+                self._send(subscriber, message)
@@ -4,57 +4,274 @@
 
 # The forumdb module is where the database interface code goes.
 import forumdb
+# The pagecache module keeps rendered pages and posts in memory.
+import pagecache
+# The events module pushes new posts and tournament standings to clients.
+import events
 
 # Other modules used to run a web server.
 import cgi
-from wsgiref.simple_server import make_server
+import hashlib
+import json
+import os
+import time
+import urllib
+from datetime import datetime
+from email.utils import formatdate, parsedate_tz, mktime_tz
 from wsgiref import util
 
-# HTML template for the forum page
-HTML_WRAP = '''\
-<!DOCTYPE html>
-<html>
-  <head>
-    <title>DB Forum</title>
-    <style>
-      h1, form { text-align: center; }
-      textarea { width: 400px; height: 100px; }
-      div.post { border: 1px solid #999;
-                 padding: 10px 10px;
-		 margin: 10px 20%%; }
-      hr.postbound { width: 50%%; }
-      em.date { color: #999 }
-    </style>
-  </head>
-  <body>
-    <h1>DB Forum</h1>
-    <form method=post action="/post">
-      <div><textarea id="content" name="content"></textarea></div>
-      <div><button id="go" type="submit">Post message</button></div>
-    </form>
-    <!-- post content will go here -->
-%s
-  </body>
-</html>
-'''
-
-# HTML template for an individual comment
-POST = '''\
-    <div class=post><em class=date>%(time)s</em><br>%(content)s</div>
-'''
+# HTML templates for the forum page, the posts and the page links
+from forumhtml import HTML_HEAD, HTML_FOOT, POST, NAV, LINK
+from forumhtml import RESULT, NO_RESULTS
+
+## Caches of rendered pages, keyed by page cursor, and of rendered posts,
+## keyed by post id, each with a memory budget in bytes.  Only the newest page
+## changes when a post is added; older pages are keyed by the post they
+## continue below, so they stay valid.  Posts added by other server processes,
+## such as the other pre-forked workers, drop the newest page when their
+## NOTIFY reaches POSTS_LISTENER; FRONT_PAGE_TTL bounds its age should the
+## listener lose its connection.
+PAGES = pagecache.LRUCache(int(os.environ.get('FORUM_PAGE_CACHE_BYTES',
+                                              8 * 1024 * 1024)))
+FRAGMENTS = pagecache.LRUCache(int(os.environ.get('FORUM_FRAGMENT_CACHE_BYTES',
+                                                  4 * 1024 * 1024)))
+FRONT_PAGE_TTL = float(os.environ.get('FORUM_FRONT_PAGE_TTL', 5))
+
+class CachedPage(object):
+    '''A rendered page with its validators.'''
+    __slots__ = ('body', 'etag', 'modified', 'lastModified')
+
+    def __init__(self, body):
+        self.body = body
+        self.etag = '"%s"' % hashlib.md5(body).hexdigest()
+        self.modified = int(time.time())
+        self.lastModified = formatdate(self.modified, usegmt=True)
+
+def CacheStats():
+    '''Returns the hit and miss counters of the page and fragment caches.'''
+    return {'pages': PAGES.stats(), 'fragments': FRAGMENTS.stats()}
+
+def PostsAdded(conn, payloads):
+    '''Drops the newest page when posts are added by any server process, or
+    after the listener (re)connects, as posts may have been missed.
+    '''
+    if payloads is None or payloads:
+        PAGES.invalidate(None)
+
+## Started by the first View() in each process, so that each pre-forked
+## worker has its own
+POSTS_LISTENER = events.Listener(forumdb.DSN, events.POSTS_CHANNEL, PostsAdded)
+
+def Stop():
+    '''Ends the event streams and stops listening, when the server stops.'''
+    events.hub.close()
+    POSTS_LISTENER.stop()
+
+## Page cursors - the (time, id) of the last post on a page, as used in links
+def EncodeCursor(post):
+    '''Returns the URL parameter that continues below the given post.'''
+    return urllib.quote_plus('%s,%d' % (post['time'], post['id']))
+
+def DecodeCursor(env):
+    '''Returns the (time, id) cursor given in the request, or None if there is
+    none or it is malformed.
+    '''
+    fields = cgi.parse_qs(env.get('QUERY_STRING', ''))
+    try:
+        time, id = fields['before'][0].rsplit(',', 1)
+        return (ParseTime(time), int(id))
+    except (KeyError, ValueError):
+        return None
+
+## Formats of a post's time as written by EncodeCursor()
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
+def ParseTime(text):
+    '''Returns the datetime written in text; raises ValueError if it is not
+    one of the TIME_FORMATS.
+    '''
+    for format in TIME_FORMATS:
+        try:
+            return datetime.strptime(text, format)
+        except ValueError:
+            pass
+    raise ValueError('Not a post time: %r' % text)
 
 ## Request handler for main page
 def View(env, resp):
     '''View is the 'main page' of the forum.
 
-    It displays the submission form and the previously posted messages.
+    It displays the submission form and one page of the previously posted
+    messages, with links to the newer and older pages.  Pages are served from
+    the PAGES cache when possible, answering conditional requests with 304 Not
+    Modified; otherwise the page is sent as it is rendered, see RenderPage(),
+    and cached once it is complete.
     '''
-    # get posts from database
-    posts = forumdb.GetAllPosts()
-    # send results
+    POSTS_LISTENER.start()
+    before = DecodeCursor(env)
     headers = [('Content-type', 'text/html')]
+    page = PAGES.get(before)
+    if page is not None:
+        validators = [('ETag', page.etag),
+                      ('Last-Modified', page.lastModified)]
+        if NotModified(env, page):
+            resp('304 Not Modified', validators)
+            return []
+        headers.extend(validators)
+        headers.append(('Content-Length', str(len(page.body))))
+        resp('200 OK', headers)
+        return [page.body]
+    # send results
+    resp('200 OK', headers)
+    return CachePage(before, RenderPage(before))
+
+def NotModified(env, page):
+    '''Returns True if the client's copy of the page is still current.'''
+    etags = env.get('HTTP_IF_NONE_MATCH')
+    if etags is not None:
+        return etags.strip() == '*' or page.etag in [
+            etag.strip() for etag in etags.split(',')]
+    since = parsedate_tz(env.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return since is not None and page.modified <= mktime_tz(since)
+
+def CachePage(before, chunks):
+    '''Pass the pieces of a page through, then cache the whole page.
+
+    The page is not cached if a post was added while it was being rendered.
+    '''
+    generation = PAGES.generation
+    body = []
+    for chunk in chunks:
+        body.append(chunk)
+        yield chunk
+    page = CachedPage(''.join(body))
+    ttl = FRONT_PAGE_TTL if before is None else None
+    PAGES.put(before, page, len(page.body), ttl, generation)
+
+def RenderPage(before):
+    '''Generate the main page in pieces: the header, then every post as it
+    is read from the database, then the page links and the footer.
+    '''
+    yield HTML_HEAD
+    # get one page of posts from database, plus one to see if there are more
+    posts = forumdb.IterPosts(before, forumdb.PAGE_SIZE + 1)
+    last = None
+    more = False
+    try:
+        for count, post in enumerate(posts):
+            if count == forumdb.PAGE_SIZE:
+                more = True
+                break
+            last = post
+            html = FRAGMENTS.get(post['id'])
+            if html is None:
+                html = POST % post
+                FRAGMENTS.put(post['id'], html, len(html))
+            yield html
+    finally:
+        posts.close()
+    links = []
+    if before is not None:
+        links.append(LINK % {'href': '/', 'text': '&laquo; Newest posts'})
+    if more:
+        links.append(LINK % {'href': '/?before=' + EncodeCursor(last),
+                             'text': 'Older posts &raquo;'})
+    if links:
+        yield NAV % ' | '.join(links)
+    yield HTML_FOOT
+
+## Deepest page of search results shown; the database ranks every match
+## before the page, so deeper pages are not worth their cost
+MAX_SEARCH_PAGE = 1000
+
+## Request handler for searching posts
+def Search(env, resp):
+    '''Search shows the posts matching the words in the 'q' parameter, best
+    matches first, one page at a time.
+    '''
+    fields = cgi.parse_qs(env.get('QUERY_STRING', ''))
+    query = fields.get('q', [''])[0].strip()
+    try:
+        page = min(max(int(fields.get('page', ['1'])[0]), 1), MAX_SEARCH_PAGE)
+    except ValueError:
+        page = 1
+    parts = [HTML_HEAD]
+    if query:
+        # get one page of results, plus one to see if there are more
+        posts = forumdb.SearchPosts(query, forumdb.PAGE_SIZE + 1,
+                                    (page - 1) * forumdb.PAGE_SIZE)
+        more = len(posts) > forumdb.PAGE_SIZE
+        parts.extend(RESULT % post for post in posts[:forumdb.PAGE_SIZE])
+        if not posts:
+            parts.append(NO_RESULTS)
+        href = '/search?q=%s&amp;page=%%d' % urllib.quote_plus(query)
+        links = []
+        if page > 1:
+            links.append(LINK % {'href': href % (page - 1),
+                                 'text': '&laquo; Better matches'})
+        if more:
+            links.append(LINK % {'href': href % (page + 1),
+                                 'text': 'More matches &raquo;'})
+        if links:
+            parts.append(NAV % ' | '.join(links))
+    parts.append(HTML_FOOT)
+    body = ''.join(parts)
+    headers = [('Content-type', 'text/html'),
+               ('Content-Length', str(len(body)))]
     resp('200 OK', headers)
-    return [HTML_WRAP % ''.join(POST % p for p in posts)]
+    return [body]
+
+## Request handler for the server's statistics
+def Stats(env, resp):
+    '''Stats shows, as JSON, the database work done by each forumdb
+    function, the post batches and the page caches of this server process.
+    '''
+    body = json.dumps({'queries': forumdb.QueryStats(),
+                       'batches': forumdb.BatchStats(),
+                       'caches': CacheStats(),
+                       'events': events.hub.stats()}, indent=2, sort_keys=True)
+    headers = [('Content-type', 'application/json'),
+               ('Content-Length', str(len(body)))]
+    resp('200 OK', headers)
+    return [body]
+
+## Request handler for the live event stream
+def Events(env, resp):
+    '''Events streams new posts to the client as server-sent events, and the
+    standings of the tournament named by the 'registration' parameter, if
+    any; see fanout.Fanout for the events sent.
+
+    The stream holds one of the server's threads for as long as the client
+    stays connected, so only events.MAX_STREAMS clients are streamed to at a
+    time; others get a 503.
+    '''
+    fields = cgi.parse_qs(env.get('QUERY_STRING', ''))
+    registration = fields.get('registration', [None])[0]
+    subscriber = events.hub.subscribe(registration)
+    if subscriber is None:
+        body = 'Too many event streams, try again later'
+        headers = [('Content-type', 'text/plain'),
+                   ('Content-Length', str(len(body))),
+                   ('Retry-After', str(events.RECONNECT))]
+        resp('503 Service Unavailable', headers)
+        return [body]
+    headers = [('Content-type', 'text/event-stream'),
+               ('Cache-Control', 'no-cache')]
+    resp('200 OK', headers)
+    return StreamEvents(subscriber)
+
+def StreamEvents(subscriber):
+    '''Yields the events of subscriber until it is disconnected.'''
+    try:
+        # Clients reconnect after this many milliseconds if the stream ends
+        yield 'retry: %d\n\n' % (events.RECONNECT * 1000)
+        while True:
+            message = subscriber.next()
+            if message is None:
+                return
+            yield message
+    finally:
+        events.hub.unsubscribe(subscriber)
 
 ## Request handler for posting - inserts to database
 def Post(env, resp):
@@ -75,7 +292,16 @@ def Post(env, resp):
         content = content.strip()
         if content:
             # Save it in the database
-            forumdb.AddPost(content)
+            try:
+                forumdb.AddPost(content)
+            except ValueError as e:
+                body = str(e)
+                headers = [('Content-type', 'text/plain'),
+                           ('Content-Length', str(len(body)))]
+                resp('400 Bad Request', headers)
+                return [body]
+            # Only the newest page shows the new post
+            PAGES.invalidate(None)
     # 302 redirect back to the main page
     headers = [('Location', '/'),
                ('Content-type', 'text/plain')]
@@ -85,6 +311,9 @@ def Post(env, resp):
 ## Dispatch table - maps URL prefixes to request handlers
 DISPATCH = {'': View,
             'post': Post,
+            'search': Search,
+            'stats': Stats,
+            'events': Events,
 	    }
 
 ## Dispatcher forwards requests according to the DISPATCH table.
@@ -101,7 +330,7 @@ def Dispatcher(env, resp):
 
 
 # Run this bad server only on localhost!
-httpd = make_server('', 8000, Dispatcher)
-print "Serving HTTP on port 8000..."
-httpd.serve_forever()
+if __name__ == '__main__':
+    import server
+    server.main(Dispatcher, onStop=Stop)
 
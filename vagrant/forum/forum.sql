@@ -1,5 +1,16 @@
-
 CREATE TABLE posts ( content TEXT,
                      time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                     id SERIAL );
+                     id SERIAL,
+                     search TSVECTOR );
+
+-- Posts are listed newest first, one page at a time: each page continues
+-- below the (time, id) of the last post on the previous one.
+CREATE INDEX posts_time_id_idx ON posts (time, id);
 
+-- Full-text search: search holds the words of content, kept up to date by a
+-- trigger, and the GIN index finds the posts containing the searched words.
+CREATE TRIGGER posts_search_update BEFORE INSERT OR UPDATE OF content ON posts
+    FOR EACH ROW
+    EXECUTE PROCEDURE tsvector_update_trigger(search, 'pg_catalog.english',
+                                              content);
+CREATE INDEX posts_search_idx ON posts USING GIN (search);
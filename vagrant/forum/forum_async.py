@@ -0,0 +1,213 @@
+#
+# DB Forum on asyncio - the same forum as forum.py, for Python 3
+#
+# One process serves every connection from a single event loop, so thousands
+# of idle keep-alive clients cost a little memory each rather than a thread.
+# That includes the clients of /events, which stay connected to be pushed new
+# posts and tournament standings; use this server rather than forum.py for
+# more of them than forum.py has threads.
+#
+# Requires Python 3.6 or later, aiohttp 3 and aiopg 1 (pg_config.sh installs
+# them where the box's python3 is recent enough; trusty's 3.4 is not, so run
+# it on a newer release or with a newer python3 installed).
+#
+# Usage: python3 forum_async.py [--host HOST] [--port PORT] [--keepalive SECONDS]
+#
+
+# The forumdb_async module is where the database interface code goes.
+import forumdb_async
+# The events_async module pushes new posts and tournament standings to clients.
+import events_async
+
+# Other modules used to run a web server.
+import argparse
+import urllib.parse
+from datetime import datetime
+
+from aiohttp import web
+
+# HTML templates for the forum page, the posts and the page links
+from forumhtml import HTML_HEAD, HTML_FOOT, POST, NAV, LINK
+from forumhtml import RESULT, NO_RESULTS
+
+## Page cursors - the (time, id) of the last post on a page, as used in links
+def EncodeCursor(post):
+    '''Returns the URL parameter that continues below the given post.'''
+    return urllib.parse.quote_plus('%s,%d' % (post['time'], post['id']))
+
+def DecodeCursor(request):
+    '''Returns the (time, id) cursor given in the request, or None if there is
+    none or it is malformed.
+    '''
+    try:
+        time, id = request.query['before'].rsplit(',', 1)
+        return (ParseTime(time), int(id))
+    except (KeyError, ValueError):
+        return None
+
+## Formats of a post's time as written by EncodeCursor()
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
+def ParseTime(text):
+    '''Returns the datetime written in text; raises ValueError if it is not
+    one of the TIME_FORMATS.
+    '''
+    for format in TIME_FORMATS:
+        try:
+            return datetime.strptime(text, format)
+        except ValueError:
+            pass
+    raise ValueError('Not a post time: %r' % text)
+
+## Request handler for main page
+async def View(request):
+    '''View is the 'main page' of the forum.
+
+    It displays the submission form and one page of the previously posted
+    messages, with links to the newer and older pages.
+    '''
+    before = DecodeCursor(request)
+    # get one page of posts from database, plus one to see if there are more
+    posts = await forumdb_async.GetPosts(before, forumdb_async.PAGE_SIZE + 1)
+    more = len(posts) > forumdb_async.PAGE_SIZE
+    posts = posts[:forumdb_async.PAGE_SIZE]
+    parts = [HTML_HEAD]
+    parts.extend(POST % post for post in posts)
+    links = []
+    if before is not None:
+        links.append(LINK % {'href': '/', 'text': '&laquo; Newest posts'})
+    if more:
+        links.append(LINK % {'href': '/?before=' + EncodeCursor(posts[-1]),
+                             'text': 'Older posts &raquo;'})
+    if links:
+        parts.append(NAV % ' | '.join(links))
+    parts.append(HTML_FOOT)
+    # send results
+    return web.Response(text=''.join(parts), content_type='text/html')
+
+## Deepest page of search results shown, see forum.py
+MAX_SEARCH_PAGE = 1000
+
+## Request handler for searching posts
+async def Search(request):
+    '''Search shows the posts matching the words in the 'q' parameter, best
+    matches first, one page at a time.
+    '''
+    query = request.query.get('q', '').strip()
+    try:
+        page = min(max(int(request.query.get('page', '1')), 1),
+                   MAX_SEARCH_PAGE)
+    except ValueError:
+        page = 1
+    parts = [HTML_HEAD]
+    if query:
+        # get one page of results, plus one to see if there are more
+        posts = await forumdb_async.SearchPosts(
+            query, forumdb_async.PAGE_SIZE + 1,
+            (page - 1) * forumdb_async.PAGE_SIZE)
+        more = len(posts) > forumdb_async.PAGE_SIZE
+        parts.extend(RESULT % post for post in posts[:forumdb_async.PAGE_SIZE])
+        if not posts:
+            parts.append(NO_RESULTS)
+        href = '/search?q=%s&amp;page=%%d' % urllib.parse.quote_plus(query)
+        links = []
+        if page > 1:
+            links.append(LINK % {'href': href % (page - 1),
+                                 'text': '&laquo; Better matches'})
+        if more:
+            links.append(LINK % {'href': href % (page + 1),
+                                 'text': 'More matches &raquo;'})
+        if links:
+            parts.append(NAV % ' | '.join(links))
+    parts.append(HTML_FOOT)
+    return web.Response(text=''.join(parts), content_type='text/html')
+
+## Request handler for posting - inserts to database
+async def Post(request):
+    '''Post handles a submission of the forum's form.
+
+    The message the user posted is saved in the database, then it sends a 302
+    Redirect back to the main page so the user can see their new post.
+    '''
+    fields = await request.post()
+    # If the post is just whitespace, don't save it.
+    content = fields.get('content', '').strip()
+    if content:
+        # Save it in the database
+        try:
+            await forumdb_async.AddPost(content)
+        except ValueError as e:
+            return web.Response(status=400, text=str(e))
+    # 302 redirect back to the main page
+    return web.Response(status=302, headers={'Location': '/'},
+                        text='Redirecting')
+
+## Request handler for the live event stream
+async def Events(request):
+    '''Events streams new posts to the client as server-sent events, and the
+    standings of the tournament named by the 'registration' parameter, if
+    any; see fanout.Fanout for the events sent.
+    '''
+    subscriber = events_async.hub.subscribe(request.query.get('registration'))
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    try:
+        await response.prepare(request)
+        # Clients reconnect after this many milliseconds if the stream ends
+        await response.write(b'retry: %d\n\n' % (events_async.RECONNECT * 1000))
+        while True:
+            message = await subscriber.next()
+            if message is None:
+                break
+            await response.write(message.encode('utf-8'))
+    except ConnectionResetError:
+        # The client went away
+        pass
+    finally:
+        events_async.hub.unsubscribe(subscriber)
+    return response
+
+## Dispatch table - maps URL prefixes to request handlers
+DISPATCH = {'': View,
+            'post': Post,
+            'search': Search,
+            'events': Events,
+            }
+
+## Dispatcher forwards requests according to the DISPATCH table.
+async def Dispatcher(request):
+    '''Send requests to handlers based on the first path component.'''
+    page = request.path.lstrip('/').split('/', 1)[0]
+    if page in DISPATCH:
+        return await DISPATCH[page](request)
+    else:
+        return web.Response(status=404, text='Not Found: ' + page)
+
+async def ClosePool(app):
+    await forumdb_async.Close()
+
+async def CloseEvents(app):
+    # Ends the event streams, which would otherwise keep the server waiting
+    await events_async.hub.close()
+
+def App():
+    '''Returns the forum as an aiohttp application.'''
+    app = web.Application()
+    app.router.add_route('*', '/{path:.*}', Dispatcher)
+    app.on_shutdown.append(CloseEvents)
+    app.on_cleanup.append(ClosePool)
+    return app
+
+
+# Run this bad server only on localhost!
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the asyncio forum server.')
+    parser.add_argument('--host', default=None,
+                        help='address to listen on (default: all)')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--keepalive', type=float, default=75,
+                        help='seconds an idle connection is kept open '
+                             '(default: 75)')
+    args = parser.parse_args()
+    web.run_app(App(), host=args.host, port=args.port,
+                keepalive_timeout=args.keepalive)
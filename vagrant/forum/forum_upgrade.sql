@@ -0,0 +1,37 @@
+-- Brings a forum database created from an earlier forum.sql up to date with
+-- it, in place; each step is skipped if it was done already, so this is safe
+-- to run more than once:
+--
+--   psql forum -f forum_upgrade.sql
+
+DO $$
+BEGIN
+    -- Keyset pagination of the front page
+    IF NOT EXISTS (SELECT 1 FROM pg_class
+                   WHERE relname = 'posts_time_id_idx') THEN
+        CREATE INDEX posts_time_id_idx ON posts (time, id);
+    END IF;
+
+    -- Full-text search: the search column, filled in for the existing posts
+    -- as the trigger fills it in for new ones
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'posts' AND column_name = 'search') THEN
+        ALTER TABLE posts ADD COLUMN search TSVECTOR;
+        UPDATE posts SET search = to_tsvector('pg_catalog.english',
+                                              coalesce(content, ''));
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                   WHERE tgname = 'posts_search_update') THEN
+        CREATE TRIGGER posts_search_update
+            BEFORE INSERT OR UPDATE OF content ON posts
+            FOR EACH ROW
+            EXECUTE PROCEDURE tsvector_update_trigger(search,
+                                                      'pg_catalog.english',
+                                                      content);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_class
+                   WHERE relname = 'posts_search_idx') THEN
+        CREATE INDEX posts_search_idx ON posts USING GIN (search);
+    END IF;
+END
+$$;
@@ -1,15 +1,107 @@
 #
 # Database access functions for the web forum.
-# 
+#
 
+import os
+import Queue
+import sys
+import threading
 import time
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.pool
+
+# The instrument module records the database work of each call; it is shared
+# with the tournament, in ../shared.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'shared'))
+import instrument
+
+## Database connection settings
+DSN = os.environ.get('FORUM_DSN', 'dbname=forum')
+POOL_MIN = int(os.environ.get('FORUM_POOL_MIN', 1))
+POOL_MAX = int(os.environ.get('FORUM_POOL_MAX', 10))
+
+## Number of posts shown per page
+PAGE_SIZE = 20
+
+## Number of rows fetched per round trip when streaming posts
+ITERSIZE = 100
+
+## New posts are written in batches: the first post of a batch waits up to
+## BATCH_WINDOW_MS milliseconds for others, up to BATCH_MAX posts in all, and
+## the batch is saved with one insert and one commit.  0 writes every post on
+## its own.
+BATCH_WINDOW_MS = float(os.environ.get('FORUM_BATCH_WINDOW_MS', 5))
+BATCH_MAX = int(os.environ.get('FORUM_BATCH_MAX', 100))
 
-## Database connection
-DB = psycopg2.connect("dbname=forum")
-c = DB.cursor()
+## New posts are announced on this channel with NOTIFY, their ids separated
+## by commas, when they are committed; see events.py.  A notification carries
+## the ids of up to NOTIFY_IDS posts, well within PostgreSQL's payload limit.
+NOTIFY_CHANNEL = 'forum_posts'
+NOTIFY_IDS = 500
+
+## Statistics of the database work of every call to the functions below, see
+## QueryStats().  Calls that take FORUM_SLOW_MS milliseconds or more are logged
+## to the 'forumdb.slow' logger with the plans of their slow statements.
+_instrument = instrument.Instrument(
+    'forumdb',
+    slowMs=float(os.environ['FORUM_SLOW_MS'])
+    if os.environ.get('FORUM_SLOW_MS') else None)
+
+## Database connection pool, created when the first request needs it
+_pool = None
+_poolLock = threading.Lock()
+# psycopg2's pool raises an error when it is exhausted; this makes callers
+# wait for a free connection instead.
+_slots = threading.BoundedSemaphore(POOL_MAX)
+
+def _getPool():
+    '''Returns the connection pool, creating it on first use.'''
+    global _pool
+    if _pool is None:
+        with _poolLock:
+            if _pool is None:
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    POOL_MIN, POOL_MAX, DSN,
+                    cursor_factory=_instrument.cursorFactory)
+    return _pool
+
+@contextmanager
+def cursor(name=None):
+    '''Borrow a pooled connection for one transaction.
+
+    Yields a new cursor on the connection; if a name is given, it is a named
+    (server-side) cursor that fetches rows from the server as they are read.
+    The transaction is committed when the block exits normally and rolled back
+    if it raises, so a failed request never leaves a broken transaction behind
+    for the next one.
+    '''
+    started = time.time()
+    pool = _getPool()
+    _slots.acquire()
+    try:
+        conn = pool.getconn()
+        _instrument.acquired(time.time() - started)
+        broken = False
+        try:
+            c = conn.cursor(name) if name else conn.cursor()
+            yield c
+            conn.commit()
+        except:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            raise
+        finally:
+            pool.putconn(conn, close=broken or bool(conn.closed))
+    finally:
+        _slots.release()
 
 ## Get posts from database.
+@_instrument.call
 def GetAllPosts():
     '''Get all the posts from the database, sorted with the newest first.
 
@@ -18,21 +110,277 @@ def GetAllPosts():
       pointing to the post content, and 'time' key pointing to the time
       it was posted.
     '''
-    # posts = [{'content': str(row[1]), 'time': str(row[0])} for row in DB]
-    # posts.sort(key=lambda row: row['time'], reverse=True)
-    # return posts
-    c.execute("select content, time from posts order by time")
-    posts = [{'content': str(row[0]), 'time': str(row[1])} for row in c.fetchall()]
+    with cursor() as c:
+        c.execute("select content, time from posts order by time")
+        posts = [{'content': str(row[0]), 'time': str(row[1])}
+                 for row in c.fetchall()]
+    return posts
+
+## Get one page of posts from the database.
+@_instrument.call
+def GetPosts(before=None, limit=PAGE_SIZE):
+    '''Get a page of posts from the database, sorted with the newest first.
+
+    Pages are found by their position in the (time, id) index rather than by
+    an offset, so every page costs the same however far back it is.
+
+    Args:
+      before: None for the newest posts, or the (time, id) of the last post on
+        the previous page to get the posts older than it.
+      limit: The maximum number of posts to return.
+
+    Returns:
+      A list of dictionaries like GetAllPosts(), which also have an 'id' key
+      pointing to the post's id.
+    '''
+    with cursor() as c:
+        if before is None:
+            c.execute("select content, time, id from posts "
+                      "order by time desc, id desc limit %s", (limit,))
+        else:
+            c.execute("select content, time, id from posts "
+                      "where (time, id) < (%s, %s) "
+                      "order by time desc, id desc limit %s",
+                      (before[0], before[1], limit))
+        posts = [{'content': str(row[0]), 'time': str(row[1]), 'id': row[2]}
+                 for row in c.fetchall()]
+    return posts
+
+## Stream posts from the database.
+@_instrument.call
+def IterPosts(before=None, limit=None):
+    '''Generate posts from the database, sorted with the newest first.
+
+    The posts are read through a server-side cursor, ITERSIZE rows at a time,
+    so only a few of them are in memory at once however many are read.  The
+    connection is held until the generator is exhausted or closed.
+
+    Args:
+      before, limit: As for GetPosts(); limit None reads every post.
+
+    Yields:
+      Dictionaries like GetPosts() returns.
+    '''
+    query = "select content, time, id from posts "
+    params = []
+    if before is not None:
+        query += "where (time, id) < (%s, %s) "
+        params.extend(before)
+    query += "order by time desc, id desc"
+    if limit is not None:
+        query += " limit %s"
+        params.append(limit)
+    with cursor('posts') as c:
+        c.itersize = ITERSIZE
+        c.execute(query, params)
+        for row in c:
+            yield {'content': str(row[0]), 'time': str(row[1]), 'id': row[2]}
+
+## Search posts in the database.
+@_instrument.call
+def SearchPosts(query, limit=PAGE_SIZE, offset=0):
+    '''Find the posts that contain the words of a query, best matches first.
+
+    The query is plain text: the posts must contain every word in it, in any
+    form of the word (e.g. "posting" finds "posted").  Posts are found through
+    the GIN index on their search column and ranked by how well they match;
+    the highlighted snippets are only made for the posts returned.
+
+    Args:
+      query: The words to search for.
+      limit: The maximum number of posts to return.
+      offset: The number of better matches to skip, for the later pages.
+
+    Returns:
+      A list of dictionaries like GetPosts(), which also have a 'snippet' key
+      pointing to the parts of the post that match, with the matching words
+      in <b> tags.
+    '''
+    with cursor() as c:
+        c.execute("select content, time, id, "
+                  "    ts_headline('english', content, q, "
+                  "                'MaxFragments=2, MaxWords=30, MinWords=10') "
+                  "from (select content, time, id, q, "
+                  "             ts_rank(search, q) as rank "
+                  "      from posts, plainto_tsquery('english', %s) q "
+                  "      where search @@ q "
+                  "      order by rank desc, id desc limit %s offset %s) page "
+                  "order by rank desc, id desc",
+                  (query, limit, offset))
+        posts = [{'content': str(row[0]), 'time': str(row[1]), 'id': row[2],
+                  'snippet': str(row[3])}
+                 for row in c.fetchall()]
     return posts
 
+## Group commit of new posts
+class PostBatcher(object):
+    '''Saves posts submitted by many threads with one commit per batch.
+
+    add() queues a post and returns once the batch it was written in has been
+    committed, so the caller knows the post is durable.  A background thread,
+    started by the first add(), collects the posts that arrive within window
+    seconds of the first one, up to maxsize of them, and inserts them in one
+    statement.  If that fails, the posts of the batch are inserted one at a
+    time, so that a post the database rejects only fails its own add().
+    '''
+
+    def __init__(self, window, maxsize):
+        self.window = window
+        self.maxsize = maxsize
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._writer = None
+        self._stats = {'batches': 0, 'posts': 0, 'max_batch': 0,
+                       'retried': 0, 'errors': 0, 'latency': 0.0,
+                       'max_latency': 0.0}
+
+    def add(self, content):
+        '''Saves a post, waiting until it is committed.
+
+        Raises the database error if the post could not be saved.
+        '''
+        item = _PendingPost(content)
+        self._start()
+        self._queue.put(item)
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+
+    def stats(self):
+        '''Returns a snapshot of the batch counters as a dictionary.
+
+        retried counts the batches that failed and were saved one post at a
+        time, errors the posts that could not be saved.  latency is the total
+        seconds from add() to commit over every post, and
+        max_latency the longest; mean_batch and mean_latency are derived.
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+        stats['mean_batch'] = (float(stats['posts']) / stats['batches']
+                               if stats['batches'] else 0.0)
+        stats['mean_latency'] = (stats['latency'] / stats['posts']
+                                 if stats['posts'] else 0.0)
+        return stats
+
+    def _start(self):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write)
+                    self._writer.daemon = True
+                    self._writer.start()
+
+    def _collect(self):
+        '''Waits for the next batch of posts.'''
+        batch = [self._queue.get()]
+        deadline = time.time() + self.window
+        while len(batch) < self.maxsize:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _write(self):
+        '''Background thread: saves the queued posts in batches.'''
+        while True:
+            batch = self._collect()
+            retried = False
+            try:
+                _SavePosts([item.content for item in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].error = e
+                else:
+                    retried = True
+                    for item in batch:
+                        try:
+                            _SavePosts([item.content])
+                        except Exception as e:
+                            item.error = e
+            now = time.time()
+            with self._lock:
+                self._stats['batches'] += 1
+                self._stats['max_batch'] = max(self._stats['max_batch'],
+                                               len(batch))
+                if retried:
+                    self._stats['retried'] += 1
+                for item in batch:
+                    if item.error is not None:
+                        self._stats['errors'] += 1
+                        continue
+                    self._stats['posts'] += 1
+                    latency = now - item.queued
+                    self._stats['latency'] += latency
+                    self._stats['max_latency'] = max(
+                        self._stats['max_latency'], latency)
+            for item in batch:
+                item.done.set()
+
+def _InsertPosts(c, contents):
+    '''Insert posts, and notify their ids, with one statement.'''
+    values = ','.join(c.mogrify('(%s)', (content,)) for content in contents)
+    # The quoted values are escaped from the second round of parameters
+    values = values.replace('%', '%%')
+    c.execute("WITH new AS (INSERT INTO posts (content) VALUES " + values +
+              " RETURNING id) "
+              "SELECT pg_notify(%s, string_agg(id::text, ',')) "
+              "FROM (SELECT id, (row_number() OVER () - 1) / %s AS chunk "
+              "FROM new) AS ids GROUP BY chunk",
+              (NOTIFY_CHANNEL, NOTIFY_IDS))
+
+@_instrument.call
+def _SavePosts(contents):
+    '''Insert a batch of posts with one statement and one commit.'''
+    with cursor() as c:
+        _InsertPosts(c, contents)
+
+class _PendingPost(object):
+    __slots__ = ('content', 'queued', 'done', 'error')
+
+    def __init__(self, content):
+        self.content = content
+        self.queued = time.time()
+        self.done = threading.Event()
+        self.error = None
+
+_batcher = PostBatcher(BATCH_WINDOW_MS / 1000.0, BATCH_MAX)
+
+def BatchStats():
+    '''Returns the counters of the post batcher, see PostBatcher.stats().'''
+    return _batcher.stats()
+
+def QueryStats():
+    '''Returns the database work done by each function of this module so far,
+    see instrument.Instrument.stats().  Posts saved in batches are counted
+    under _SavePosts, as the batches are written by another thread.
+    '''
+    return _instrument.stats()
+
 ## Add a post to the database.
+@_instrument.call
 def AddPost(content):
     '''Add a new post to the database.
 
+    Unless batching is turned off, the post is saved together with the others
+    submitted at about the same time, see PostBatcher; either way AddPost
+    returns once the post has been committed.
+
     Args:
       content: The text content of the new post.
+
+    Raises:
+      ValueError: content holds a NUL character, which PostgreSQL does not
+        store in text.
     '''
-    # t = time.strftime('%c', time.localtime())
-    # DB.append((t, content))
-    c.execute("INSERT INTO posts (content) VALUES ('%s')" % content)
-    DB.commit()
+    if '\0' in content:
+        raise ValueError('A post cannot contain NUL characters')
+    if BATCH_WINDOW_MS > 0 and BATCH_MAX > 1:
+        _batcher.add(content)
+        return
+    with cursor() as c:
+        _InsertPosts(c, [content])
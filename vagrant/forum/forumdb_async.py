@@ -0,0 +1,153 @@
+#
+# Database access functions for the web forum, for asyncio (Python 3).
+#
+# The same queries as forumdb.py, run through aiopg so that a request waiting
+# on PostgreSQL does not hold a thread.
+#
+
+import asyncio
+import os
+
+import aiopg
+
+## Database connection settings, shared with forumdb.py
+DSN = os.environ.get('FORUM_DSN', 'dbname=forum')
+POOL_MIN = int(os.environ.get('FORUM_POOL_MIN', 1))
+POOL_MAX = int(os.environ.get('FORUM_POOL_MAX', 10))
+
+## Number of posts shown per page
+PAGE_SIZE = 20
+
+## Channel new posts are announced on with NOTIFY, shared with forumdb.py
+NOTIFY_CHANNEL = 'forum_posts'
+
+## Database connection pool, created when the first request needs it.  Callers
+## wait for a free connection when every one of them is in use.  The lock is
+## made along with it, in the running event loop: before Python 3.10 a lock
+## made at import belongs to the loop current then, not to the server's.
+_pool = None
+_poolLock = None
+
+async def _getPool():
+    '''Returns the connection pool, creating it on first use.'''
+    global _pool, _poolLock
+    if _pool is None:
+        if _poolLock is None:
+            _poolLock = asyncio.Lock()
+        async with _poolLock:
+            if _pool is None:
+                _pool = await aiopg.create_pool(DSN, minsize=POOL_MIN,
+                                                maxsize=POOL_MAX)
+    return _pool
+
+async def Close():
+    '''Close the connection pool, waiting for the connections in use.'''
+    global _pool, _poolLock
+    _poolLock = None
+    if _pool is not None:
+        pool, _pool = _pool, None
+        pool.close()
+        await pool.wait_closed()
+
+## Get posts from database.
+async def GetAllPosts():
+    '''Get all the posts from the database, sorted with the newest first.
+
+    Returns:
+      A list of dictionaries, where each dictionary has a 'content' key
+      pointing to the post content, and 'time' key pointing to the time
+      it was posted.
+    '''
+    pool = await _getPool()
+    async with pool.acquire() as conn:
+        async with conn.cursor() as c:
+            await c.execute("select content, time from posts order by time")
+            rows = await c.fetchall()
+    return [{'content': str(row[0]), 'time': str(row[1])} for row in rows]
+
+## Get one page of posts from the database.
+async def GetPosts(before=None, limit=PAGE_SIZE):
+    '''Get a page of posts from the database, sorted with the newest first.
+
+    Args:
+      before: None for the newest posts, or the (time, id) of the last post on
+        the previous page to get the posts older than it.
+      limit: The maximum number of posts to return.
+
+    Returns:
+      A list of dictionaries like GetAllPosts(), which also have an 'id' key
+      pointing to the post's id.
+    '''
+    pool = await _getPool()
+    async with pool.acquire() as conn:
+        async with conn.cursor() as c:
+            if before is None:
+                await c.execute("select content, time, id from posts "
+                                "order by time desc, id desc limit %s",
+                                (limit,))
+            else:
+                await c.execute("select content, time, id from posts "
+                                "where (time, id) < (%s, %s) "
+                                "order by time desc, id desc limit %s",
+                                (before[0], before[1], limit))
+            rows = await c.fetchall()
+    return [{'content': str(row[0]), 'time': str(row[1]), 'id': row[2]}
+            for row in rows]
+
+## Search posts in the database.
+async def SearchPosts(query, limit=PAGE_SIZE, offset=0):
+    '''Find the posts that contain the words of a query, best matches first;
+    see forumdb.SearchPosts().
+
+    Args:
+      query: The words to search for.
+      limit: The maximum number of posts to return.
+      offset: The number of better matches to skip, for the later pages.
+
+    Returns:
+      A list of dictionaries like GetPosts(), which also have a 'snippet' key
+      pointing to the parts of the post that match, with the matching words
+      in <b> tags.
+    '''
+    pool = await _getPool()
+    async with pool.acquire() as conn:
+        async with conn.cursor() as c:
+            await c.execute(
+                "select content, time, id, "
+                "    ts_headline('english', content, q, "
+                "                'MaxFragments=2, MaxWords=30, MinWords=10') "
+                "from (select content, time, id, q, "
+                "             ts_rank(search, q) as rank "
+                "      from posts, plainto_tsquery('english', %s) q "
+                "      where search @@ q "
+                "      order by rank desc, id desc limit %s offset %s) page "
+                "order by rank desc, id desc",
+                (query, limit, offset))
+            rows = await c.fetchall()
+    return [{'content': str(row[0]), 'time': str(row[1]), 'id': row[2],
+             'snippet': str(row[3])}
+            for row in rows]
+
+## Add a post to the database.
+async def AddPost(content):
+    '''Add a new post to the database.
+
+    aiopg connections are in autocommit mode, so the post is saved as soon as
+    the statement completes.
+
+    Args:
+      content: The text content of the new post.
+
+    Raises:
+      ValueError: content holds a NUL character, which PostgreSQL does not
+        store in text.
+    '''
+    if '\0' in content:
+        raise ValueError('A post cannot contain NUL characters')
+    pool = await _getPool()
+    async with pool.acquire() as conn:
+        async with conn.cursor() as c:
+            await c.execute("WITH new AS (INSERT INTO posts (content) "
+                            "VALUES (%s) RETURNING id) "
+                            "SELECT pg_notify(%s, id::text) FROM new",
+                            (content, NOTIFY_CHANNEL))
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+#
+# Test cases for forumdb.py's post batching and forum.py's page cache
+#
+# The posts added are marked with MARKER and deleted again at the end.
+
+import os
+import re
+import threading
+from cStringIO import StringIO
+
+import psycopg2
+
+import forum
+import forumdb
+
+MARKER = 'forumdb_test %d:' % os.getpid()
+
+def Committed(contents):
+    '''Returns the contents among the given ones that another connection
+    sees in the posts table, i.e. that are committed.
+    '''
+    conn = psycopg2.connect(forumdb.DSN)
+    try:
+        c = conn.cursor()
+        c.execute("select content from posts where content = any(%s)",
+                  (list(contents),))
+        return set(row[0] for row in c.fetchall())
+    finally:
+        conn.close()
+
+def AddPosts(contents):
+    '''Adds the posts from a thread each, at the same time.  Returns a
+    dictionary of the exception raised for each post, or None.
+    '''
+    errors = {}
+    def add(content):
+        try:
+            forumdb.AddPost(content)
+            errors[content] = None
+        except Exception as e:
+            errors[content] = e
+    threads = [threading.Thread(target=add, args=(content,))
+               for content in contents]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+def WithBatcher(test):
+    '''Runs test with a batcher whose window is long enough for the posts
+    of a test to share a batch.
+    '''
+    def run():
+        batcher = forumdb._batcher
+        forumdb._batcher = forumdb.PostBatcher(0.2, forumdb.BATCH_MAX)
+        try:
+            test()
+        finally:
+            forumdb._batcher = batcher
+    return run
+
+@WithBatcher
+def testBadPostInBatch():
+    '''A post the database rejects fails only its own AddPost, not the others
+    saved in the same batch; a post with a NUL character is rejected before
+    it is queued.
+    '''
+    good = [MARKER + ' good %d' % i for i in range(3)]
+    nul = MARKER + ' with a \0'
+    invalid = MARKER + ' rejected'
+    savePosts = forumdb._SavePosts
+    def rejecting(contents):
+        # As the database rejects a post, e.g. one not in its encoding
+        if invalid in contents:
+            raise psycopg2.DataError('invalid byte sequence')
+        savePosts(contents)
+    forumdb._SavePosts = rejecting
+    try:
+        errors = AddPosts(good + [nul, invalid])
+    finally:
+        forumdb._SavePosts = savePosts
+    if [errors[content] for content in good] != [None] * 3:
+        raise ValueError(
+            "Good posts should be saved despite a bad one in their batch.")
+    if not isinstance(errors[nul], ValueError):
+        raise ValueError("A post with a NUL character should be rejected.")
+    if not isinstance(errors[invalid], psycopg2.DataError):
+        raise ValueError("The database's error should reach its own post.")
+    if Committed(good) != set(good):
+        raise ValueError("Good posts should be committed.")
+    stats = forumdb._batcher.stats()
+    if not (stats['posts'] == 3 and stats['errors'] == 1 and
+            stats['retried'] == 1):
+        raise ValueError("Batch stats should count the saved and failed "
+                         "posts: %r" % stats)
+    print "1. A bad post only fails its own submission."
+
+@WithBatcher
+def testCommittedOnReturn():
+    '''AddPost returns only once the post is committed.'''
+    contents = [MARKER + ' committed %d' % i for i in range(5)]
+    seen = {}
+    def add(content):
+        forumdb.AddPost(content)
+        seen[content] = content in Committed([content])
+    threads = [threading.Thread(target=add, args=(content,))
+               for content in contents]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if seen != dict((content, True) for content in contents):
+        raise ValueError("AddPost should return once the post is committed.")
+    print "2. AddPost returns once the post is committed."
+
+@WithBatcher
+def testRedirectAfterCommit():
+    '''The forum redirects after a post only once it is committed, so the
+    page the browser then loads shows it.
+    '''
+    content = MARKER + ' redirected'
+    body = 'content=' + content.replace(' ', '+')
+    env = {'wsgi.input': StringIO(body), 'CONTENT_LENGTH': str(len(body))}
+    statuses = []
+    def resp(status, headers):
+        statuses.append((status, content in Committed([content])))
+    forum.Post(env, resp)
+    if statuses != [('302 REDIRECT', True)]:
+        raise ValueError("The redirect should be sent after the commit.")
+
+    body = 'content=' + MARKER.replace(' ', '+') + '%00'
+    env = {'wsgi.input': StringIO(body), 'CONTENT_LENGTH': str(len(body))}
+    statuses = []
+    forum.Post(env, lambda status, headers: statuses.append(status))
+    if statuses != ['400 Bad Request']:
+        raise ValueError("A post with a NUL character should get a 400.")
+    print "3. The forum redirects after a post once it is committed."
+
+def Get(path, **headers):
+    '''Requests path from the forum, with the given CGI headers.  Returns the
+    status, the response headers as a dictionary and the body.
+    '''
+    env = {'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': ''}
+    env['PATH_INFO'], _, env['QUERY_STRING'] = path.partition('?')
+    env.update(headers)
+    response = []
+    def resp(status, headers):
+        response.extend([status, dict(headers)])
+    body = ''.join(forum.Dispatcher(env, resp))
+    return response[0], response[1], body
+
+def AddPost(content):
+    '''Submits a post through the forum's form, as a browser does.'''
+    body = 'content=' + content.replace(' ', '+')
+    env = {'wsgi.input': StringIO(body), 'CONTENT_LENGTH': str(len(body))}
+    forum.Post(env, lambda status, headers: None)
+
+def testNotModified():
+    '''The front page is served from the cache once rendered, and answered
+    with 304 Not Modified when the client's ETag is current.
+    '''
+    forum.PAGES.invalidate()
+    status, headers, body = Get('/')
+    if status != '200 OK' or 'ETag' in headers:
+        raise ValueError("The first request should render the page.")
+    status, headers, cached = Get('/')
+    if status != '200 OK' or cached != body or 'ETag' not in headers:
+        raise ValueError("The rendered page should be served from the cache.")
+    status, headers, body = Get('/', HTTP_IF_NONE_MATCH=headers['ETag'])
+    if status != '304 Not Modified' or body:
+        raise ValueError("A current ETag should get 304 Not Modified.")
+    status, headers, body = Get('/', HTTP_IF_NONE_MATCH='"stale"')
+    if status != '200 OK' or body != cached:
+        raise ValueError("Another ETag should get the page.")
+    print "4. Cached pages are answered with 304 when the ETag is current."
+
+@WithBatcher
+def testPostInvalidates():
+    '''A post drops the cached front page, so the page loaded after the
+    redirect shows it and a client's old ETag no longer matches.
+    '''
+    Get('/')
+    etag = Get('/')[1]['ETag']
+    content = MARKER + ' invalidates'
+    AddPost(content)
+    status, headers, body = Get('/', HTTP_IF_NONE_MATCH=etag)
+    if status != '200 OK' or content not in body:
+        raise ValueError("A post should drop the cached front page.")
+    print "5. A post drops the cached front page."
+
+@WithBatcher
+def testOlderPages():
+    '''The link to the older posts carries a cursor that decodes to the last
+    post on the page, and the page it leads to continues right below it.
+    '''
+    AddPosts([MARKER + ' page %d' % i
+              for i in range(forumdb.PAGE_SIZE + 5)])
+    newest = forumdb.GetPosts(None, forumdb.PAGE_SIZE + 1)
+    last = newest[forumdb.PAGE_SIZE - 1]
+    cursor = forum.EncodeCursor(last)
+    if forum.DecodeCursor({'QUERY_STRING': 'before=' + cursor}) != (
+            forum.ParseTime(last['time']), last['id']):
+        raise ValueError("A page cursor should decode to its post.")
+    forum.PAGES.invalidate()
+    links = re.findall(r'href="(/\?before=[^"]*)"', Get('/')[2])
+    if links != ['/?before=' + cursor]:
+        raise ValueError("The front page should link below its last post.")
+    body = Get(links[0])[2]
+    following = newest[forumdb.PAGE_SIZE]['content']
+    if following not in body or last['content'] in body:
+        raise ValueError("The older page should continue below the cursor.")
+    print "6. Older pages continue below the cursor of the page above."
+
+def DeletePosts():
+    with forumdb.cursor() as c:
+        c.execute("delete from posts where content like %s",
+                  (MARKER.replace('%', r'\%') + '%',))
+
+if __name__ == '__main__':
+    try:
+        testBadPostInBatch()
+        testCommittedOnReturn()
+        testRedirectAfterCommit()
+        testNotModified()
+        testPostInvalidates()
+        testOlderPages()
+    finally:
+        DeletePosts()
+    print "Success!  All tests pass!"
@@ -0,0 +1,59 @@
+#
+# HTML templates shared by the forum servers, forum.py and forum_async.py
+#
+
+# HTML template for the forum page
+HTML_WRAP = '''\
+<!DOCTYPE html>
+<html>
+  <head>
+    <title>DB Forum</title>
+    <style>
+      h1, form { text-align: center; }
+      textarea { width: 400px; height: 100px; }
+      div.post { border: 1px solid #999;
+                 padding: 10px 10px;
+		 margin: 10px 20%%; }
+      hr.postbound { width: 50%%; }
+      em.date { color: #999 }
+      div.nav { text-align: center; }
+    </style>
+  </head>
+  <body>
+    <h1>DB Forum</h1>
+    <form method=post action="/post">
+      <div><textarea id="content" name="content"></textarea></div>
+      <div><button id="go" type="submit">Post message</button></div>
+    </form>
+    <form method=get action="/search">
+      <div><input id="q" name="q"> <button type="submit">Search</button></div>
+    </form>
+    <!-- post content will go here -->
+%s
+  </body>
+</html>
+'''
+
+# The page before and after the posts, so that it can be sent in pieces
+HTML_HEAD, HTML_FOOT = HTML_WRAP.replace('%%', '%').split('%s')
+
+# HTML template for an individual comment
+POST = '''\
+    <div class=post><em class=date>%(time)s</em><br>%(content)s</div>
+'''
+
+# HTML template for the links to the newer and older pages of posts
+NAV = '''\
+    <div class=nav>%s</div>
+'''
+LINK = '<a href="%(href)s">%(text)s</a>'
+
+# HTML template for a post found by a search, showing the matching parts
+RESULT = '''\
+    <div class=post><em class=date>%(time)s</em><br>%(snippet)s</div>
+'''
+
+# HTML shown when a search finds nothing
+NO_RESULTS = '''\
+    <div class=nav>No posts match your search.</div>
+'''
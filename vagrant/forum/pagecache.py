@@ -0,0 +1,93 @@
+#
+# Memory-bounded LRU cache for rendered pages and page fragments.
+#
+
+import collections
+import threading
+import time
+
+class LRUCache(object):
+    '''A thread-safe cache whose entries are evicted least recently used first
+    once their total size goes over a budget.
+
+    Every entry has a size, e.g. the length of the rendered HTML, and may have
+    a time to live.  invalidate() drops entries and bumps a generation number;
+    a value computed before an invalidation can be refused by passing the
+    generation read before computing it to put().
+    '''
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+                       'invalidations': 0}
+
+    def get(self, key):
+        '''Returns the value cached for key, or None.'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[2] is not None and entry[2] < time.time():
+                self._size -= entry[1]
+                entry = None
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            # Re-inserting moves the entry to the most recently used end
+            self._entries[key] = entry
+            self._stats['hits'] += 1
+            return entry[0]
+
+    def put(self, key, value, size, ttl=None, generation=None):
+        '''Caches value under key.
+
+        Args:
+          size: The number of bytes the entry counts against the budget.
+          ttl: Seconds after which the entry expires, or None.
+          generation: If given and the cache has been invalidated since, the
+            value is stale and is not cached.
+
+        Returns:
+          True if the value was cached.
+        '''
+        if size > self.maxbytes:
+            return False
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (value, size, expires)
+            self._size += size
+            while self._size > self.maxbytes:
+                oldest, entry = self._entries.popitem(last=False)
+                self._size -= entry[1]
+                self._stats['evictions'] += 1
+        return True
+
+    def invalidate(self, *keys):
+        '''Drops the given keys, or every entry if no key is given.'''
+        with self._lock:
+            self.generation += 1
+            self._stats['invalidations'] += 1
+            if not keys:
+                self._entries.clear()
+                self._size = 0
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._size -= entry[1]
+
+    def stats(self):
+        '''Returns a snapshot of the cache's counters as a dictionary.'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._size
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+        return stats
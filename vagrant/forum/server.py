@@ -0,0 +1,238 @@
+#
+# HTTP servers for the forum: single-threaded, thread pool and pre-fork.
+#
+# Usage: python forum.py [--mode single|threaded|prefork] [--threads N]
+#                        [--workers N] [--keepalive SECONDS] [--port PORT]
+#
+
+import argparse
+import errno
+import logging
+import multiprocessing
+import os
+import Queue
+import signal
+import socket
+import sys
+import threading
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+from wsgiref.simple_server import ServerHandler
+
+class KeepAliveServerHandler(ServerHandler):
+    '''Remembers whether the response had a Content-Length, which is
+    forgotten once the response has been sent, and does not log clients that
+    close the connection before the end of the response.
+    '''
+
+    hadLength = False
+
+    def close(self):
+        self.hadLength = (self.headers is not None and
+                          'Content-Length' in self.headers)
+        ServerHandler.close(self)
+
+    def log_exception(self, exc_info):
+        # Clients going away in the middle of a streamed response is normal
+        if (issubclass(exc_info[0], socket.error) and
+                exc_info[1].errno in (errno.EPIPE, errno.ECONNRESET)):
+            return
+        ServerHandler.log_exception(self, exc_info)
+
+class KeepAliveHandler(WSGIRequestHandler):
+    '''Serves several HTTP/1.1 requests over one connection.
+
+    The connection stays open after a response that has a Content-Length, as
+    long as the client did not ask to close it.  It is closed after streamed
+    responses, whose end is marked by closing the connection, after requests
+    with a body, and when it has been idle for the server's keepalive seconds.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.timeout = self.server.keepalive or None
+        WSGIRequestHandler.setup(self)
+
+    def handle(self):
+        try:
+            while self.handle_one():
+                if self.server.stopping:
+                    break
+        except socket.timeout:
+            pass
+
+    def handle_one(self):
+        '''Serves one request; returns True if the connection can be reused.'''
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline:
+            return False
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return False
+        if not self.parse_request():
+            return False
+
+        handler = KeepAliveServerHandler(self.rfile, self.wfile,
+                                         self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        if self.request_version == 'HTTP/1.1':
+            handler.http_version = '1.1'
+        handler.run(self.server.get_app())
+
+        return (self.server.keepalive > 0 and
+                not self.close_connection and
+                self.request_version == 'HTTP/1.1' and
+                handler.hadLength and
+                int(self.headers.get('Content-Length') or 0) == 0)
+
+class ThreadPoolWSGIServer(WSGIServer):
+    '''A WSGI server that hands connections to a fixed pool of threads.
+
+    The threads are started by serve_forever(), so that a pre-forked worker
+    process starts its own.  server_close() lets them finish the connections
+    already accepted before it returns.
+    '''
+
+    def __init__(self, address, handler, threads, keepalive):
+        WSGIServer.__init__(self, address, handler)
+        self.keepalive = keepalive
+        self.stopping = False
+        self.threads = threads
+        self._connections = Queue.Queue()
+        self._threads = []
+
+    def serve_forever(self, poll_interval=0.5):
+        while len(self._threads) < self.threads:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        WSGIServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        self._connections.put((request, client_address))
+
+    def _work(self):
+        while True:
+            item = self._connections.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        self.stopping = True
+        WSGIServer.server_close(self)
+        for thread in self._threads:
+            self._connections.put(None)
+        for thread in self._threads:
+            thread.join()
+
+def StopOnSignals(httpd):
+    '''Shut the server down gracefully on SIGTERM or SIGINT.
+
+    serve_forever() returns once the current request has been served; the
+    signal handler cannot call shutdown() itself because it runs on the same
+    thread as serve_forever().
+    '''
+    def stop(signum, frame):
+        threading.Thread(target=httpd.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+def Serve(httpd, onStop=None):
+    '''Serve until a stop signal, then finish in-flight requests.
+
+    onStop, if given, is called before waiting for the requests, to end the
+    responses that would otherwise stream forever.
+    '''
+    StopOnSignals(httpd)
+    try:
+        httpd.serve_forever()
+    finally:
+        if onStop is not None:
+            onStop()
+        httpd.server_close()
+
+def ServePrefork(httpd, workers, onStop=None):
+    '''Fork worker processes that all accept connections on httpd's socket.
+
+    The parent only supervises: on SIGTERM or SIGINT it passes SIGTERM on to
+    the workers and waits for them to finish their requests.
+    '''
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                Serve(httpd, onStop)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError:
+            # Interrupted by a signal
+            continue
+        if pid in children:
+            children.remove(pid)
+    httpd.socket.close()
+
+def main(app, argv=None, onStop=None):
+    '''Run the WSGI application app with the server chosen on the command line.
+
+    onStop is called when the server stops, see Serve().
+    '''
+    parser = argparse.ArgumentParser(description='Run the forum server.')
+    parser.add_argument('--host', default='',
+                        help='address to listen on (default: all)')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--mode', choices=['single', 'threaded', 'prefork'],
+                        default='threaded',
+                        help='single: one request at a time; threaded: a pool '
+                             'of threads; prefork: several processes, each '
+                             'with a pool of threads')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads per process (default: 8)')
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='processes in prefork mode (default: one per CPU)')
+    parser.add_argument('--keepalive', type=float, default=5,
+                        help='seconds an idle connection is kept open, 0 to '
+                             'close after every request (default: 5)')
+    args = parser.parse_args(argv)
+    # Slow database calls are logged to standard error, see forumdb.py
+    logging.basicConfig(format='%(asctime)s %(name)s: %(message)s')
+
+    if args.mode == 'single':
+        httpd = make_server(args.host, args.port, app)
+    else:
+        httpd = ThreadPoolWSGIServer((args.host, args.port), KeepAliveHandler,
+                                     args.threads, args.keepalive)
+        httpd.set_app(app)
+
+    print "Serving HTTP on port %d (%s)..." % (args.port, args.mode)
+    sys.stdout.flush()
+    if args.mode == 'prefork':
+        ServePrefork(httpd, args.workers, onStop)
+    else:
+        Serve(httpd, onStop)
@@ -1,5 +1,5 @@
 apt-get -qqy update
-apt-get -qqy install postgresql python-psycopg2
+apt-get -qqy install postgresql python-psycopg2 python-numpy
 apt-get -qqy install python-flask python-sqlalchemy
 apt-get -qqy install python-pip
 pip install bleach
@@ -10,10 +10,19 @@ pip install redis
 pip install passlib
 pip install itsdangerous
 pip install flask-httpauth
+# The asyncio forum server (forum/forum_async.py) needs Python 3.6 or later
+apt-get -qqy install python3-pip
+if python3 -c 'import sys; sys.exit(sys.version_info < (3, 6))'; then
+  pip3 install 'aiohttp>=3,<4' 'aiopg>=1,<2'
+else
+  echo "python3 is older than 3.6: forum/forum_async.py will not run"
+fi
 su postgres -c 'createuser -dRS vagrant'
 su vagrant -c 'createdb'
 su vagrant -c 'createdb forum'
 su vagrant -c 'psql forum -f /vagrant/forum/forum.sql'
+# Brings a forum database made by an earlier provisioning up to date
+su vagrant -c 'psql forum -f /vagrant/forum/forum_upgrade.sql'
 
 vagrantTip="[35m[1mThe shared directory is located at /vagrant\nTo access your shared files: cd /vagrant(B[m"
 echo -e $vagrantTip > /etc/motd
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+#
+# instrument.py -- per-call statistics of the database work done by a module
+#
+# Shared by the tournament and the forum, which put this directory on
+# sys.path before importing it.
+#
+# Functions wrapped with Instrument.call() record, for every call, how many
+# statements they sent, how long the database took to answer them, how many
+# rows they fetched and how long they waited for a connection.  The totals per
+# function are kept in memory; stats() returns a snapshot of them.
+#
+
+import functools
+import inspect
+import logging
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+
+# Statements whose plan can be shown with EXPLAIN
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """A cursor that reports its statements and fetches to an Instrument.
+
+    Do not use it directly: each Instrument makes its own subclass, its
+    cursorFactory, bound to it.
+    """
+
+    instrument = None
+
+    def execute(self, query, vars=None):
+        started = time.time()
+        result = super(InstrumentedCursor, self).execute(query, vars)
+        elapsed = time.time() - started
+        rows = 0
+        if self.name is None and self.rowcount > 0 and self.description is None:
+            # Rows changed by INSERT, UPDATE or DELETE; fetched rows are
+            # counted as they are fetched.
+            rows = self.rowcount
+        self.instrument._statement(self, query, vars, elapsed, rows)
+        return result
+
+    def executemany(self, query, vars_list):
+        for vars in vars_list:
+            self.execute(query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.time()
+        result = super(InstrumentedCursor, self).copy_expert(sql, file, size)
+        self.instrument._statement(self, sql, None, time.time() - started,
+                                   max(self.rowcount, 0), explain=False)
+        return result
+
+    def fetchone(self):
+        started = time.time()
+        row = super(InstrumentedCursor, self).fetchone()
+        self.instrument._fetched(time.time() - started, int(row is not None))
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.time()
+        if size is None:
+            size = self.arraysize
+        rows = super(InstrumentedCursor, self).fetchmany(size)
+        self.instrument._fetched(time.time() - started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.time()
+        rows = super(InstrumentedCursor, self).fetchall()
+        self.instrument._fetched(time.time() - started, len(rows))
+        return rows
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+
+class _Call(object):
+    """The database work done by one call of an instrumented function."""
+
+    __slots__ = ('name', 'statements', 'dbTime', 'rows', 'acquireTime',
+                 'elapsed', 'resumed', 'plans')
+
+    def __init__(self, name):
+        self.name = name
+        self.statements = 0
+        self.dbTime = 0.0
+        self.rows = 0
+        self.acquireTime = 0.0
+        self.elapsed = 0.0
+        self.resumed = None
+        # (seconds, statement, plan) of the statements that were slow
+        self.plans = []
+
+    def summary(self):
+        return {'function': self.name,
+                'statements': self.statements,
+                'rows': self.rows,
+                'db_ms': self.dbTime * 1000,
+                'acquire_ms': self.acquireTime * 1000,
+                'elapsed_ms': self.elapsed * 1000}
+
+
+class Instrument(object):
+    """Collects the database statistics of a module's functions.
+
+    Usage:
+      instrument = Instrument('tournament', slowMs=100)
+      pool = ConnectionPool(dsn, cursor_factory=instrument.cursorFactory)
+
+      @instrument.call
+      def playerStandings():
+          ...
+
+    Calls may be nested; the statements of an inner call count towards the
+    outer calls as well.  A call that takes slowMs milliseconds or more is
+    logged with its statistics and the EXPLAIN plan of every statement in it
+    that took slowMs on its own.  slowMs None turns this off.
+    """
+
+    def __init__(self, name, slowMs=None):
+        self.name = name
+        self.slowMs = slowMs
+        self.log = logging.getLogger(name + '.slow')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.cursorFactory = type('InstrumentedCursor', (InstrumentedCursor,),
+                                  {'instrument': self})
+
+    def call(self, function):
+        """Decorator that records the database work of each call to function.
+
+        A generator function is measured while it runs, from its first item
+        until it is exhausted or closed, but not while its caller holds it.
+        """
+        name = function.__name__
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                return self._generate(name, function(*args, **kwargs))
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                call = _Call(name)
+                self._enter(call)
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self._leave(call)
+                    self._finish(call)
+        return wrapper
+
+    def _generate(self, name, generator):
+        call = _Call(name)
+        try:
+            while True:
+                self._enter(call)
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    self._leave(call)
+                yield item
+        finally:
+            generator.close()
+            self._finish(call)
+
+    def acquired(self, seconds):
+        """Records that the current calls waited seconds for a connection."""
+        for call in self._calls():
+            call.acquireTime += seconds
+
+    def lastCall(self):
+        """Returns the statistics of the last outermost call this thread made,
+        as a dictionary, or None.
+        """
+        return getattr(self._local, 'last', None)
+
+    def stats(self):
+        """Returns a snapshot of the totals per function as a dictionary.
+
+        For each function: calls, slow_calls, statements, rows, db_ms
+        (database time), acquire_ms (waiting for connections), elapsed_ms and
+        max_ms (whole calls), and the same per call in mean_*.
+        """
+        with self._lock:
+            stats = dict((name, dict(totals))
+                         for name, totals in self._stats.iteritems())
+        for totals in stats.itervalues():
+            for key in ('statements', 'rows', 'db_ms', 'acquire_ms',
+                        'elapsed_ms'):
+                totals['mean_' + key] = float(totals[key]) / totals['calls']
+        return stats
+
+    def reset(self):
+        """Clears the totals."""
+        with self._lock:
+            self._stats.clear()
+
+    def _calls(self):
+        calls = getattr(self._local, 'calls', None)
+        if calls is None:
+            calls = self._local.calls = []
+        return calls
+
+    def _enter(self, call):
+        call.resumed = time.time()
+        self._calls().append(call)
+
+    def _leave(self, call):
+        self._calls().remove(call)
+        call.elapsed += time.time() - call.resumed
+
+    def _statement(self, cursor, query, vars, seconds, rows, explain=True):
+        calls = self._calls()
+        for call in calls:
+            call.statements += 1
+            call.dbTime += seconds
+            call.rows += rows
+        if (calls and explain and self.slowMs is not None and
+                seconds * 1000 >= self.slowMs and cursor.name is None):
+            plan = self._explain(cursor, query, vars)
+            if plan is not None:
+                calls[0].plans.append((seconds, plan[0], plan[1]))
+
+    def _fetched(self, seconds, rows):
+        for call in self._calls():
+            call.dbTime += seconds
+            call.rows += rows
+
+    def _explain(self, cursor, query, vars):
+        """Returns the statement and its EXPLAIN plan, or None."""
+        statement = query
+        try:
+            statement = cursor.mogrify(query, vars)
+            if statement.lstrip().split(None, 1)[0].upper() not in EXPLAINABLE:
+                return None
+            # A plain cursor, so that EXPLAIN is not counted as a statement
+            c = psycopg2.extensions.cursor(cursor.connection)
+            # In a savepoint, so that an EXPLAIN that fails does not abort
+            # the caller's transaction
+            savepoint = not cursor.connection.autocommit
+            try:
+                if savepoint:
+                    c.execute('SAVEPOINT instrument_explain;')
+                c.execute('EXPLAIN ' + statement)
+                plan = '\n'.join(row[0] for row in c.fetchall())
+            finally:
+                if savepoint:
+                    c.execute('ROLLBACK TO SAVEPOINT instrument_explain;')
+                    c.execute('RELEASE SAVEPOINT instrument_explain;')
+                c.close()
+            return statement, plan
+        except psycopg2.Error as e:
+            return statement, 'EXPLAIN failed: %s' % e
+
+    def _finish(self, call):
+        summary = call.summary()
+        slow = self.slowMs is not None and summary['elapsed_ms'] >= self.slowMs
+        with self._lock:
+            totals = self._stats.setdefault(call.name, {
+                'calls': 0, 'slow_calls': 0, 'statements': 0, 'rows': 0,
+                'db_ms': 0.0, 'acquire_ms': 0.0, 'elapsed_ms': 0.0,
+                'max_ms': 0.0})
+            totals['calls'] += 1
+            totals['slow_calls'] += int(slow)
+            for key in ('statements', 'rows', 'db_ms', 'acquire_ms',
+                        'elapsed_ms'):
+                totals[key] += summary[key]
+            totals['max_ms'] = max(totals['max_ms'], summary['elapsed_ms'])
+        if self._calls():
+            return
+        self._local.last = summary
+        if slow:
+            self.log.warning('%s took %.1f ms: %d statements, %.1f ms in the '
+                             'database, %d rows, %.1f ms waiting for a '
+                             'connection', call.name, summary['elapsed_ms'],
+                             call.statements, summary['db_ms'], call.rows,
+                             summary['acquire_ms'])
+            for seconds, statement, plan in call.plans:
+                self.log.warning('%.1f ms: %s\n%s', seconds * 1000, statement,
+                                 plan)
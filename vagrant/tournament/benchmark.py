@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# benchmark.py -- measures how playerStandings() and the pairing engine scale
+# with player count
+#
+# WARNING: the standings benchmark deletes every player and match in the
+# tournament database.  The pairings benchmark runs in memory only.
+#
+# Usage: python benchmark.py [standings|pairings] [player counts...]
+#
+
+import random
+import sys
+import time
+
+import pairing
+import tournament
+from tournament import *
+
+
+DEFAULT_SIZES = [100, 250, 500, 1000, 2000]
+PAIRING_SIZES = [1000, 10000, 20000]
+ROUNDS = 3
+PAIRING_ROUNDS = 10
+REPEAT = 5
+
+
+def legacyStandings():
+    """The original standings code: one OMW query per player, for comparison."""
+    with transaction() as c:
+        c.execute('SELECT id, name, points, matches, bye FROM standings')
+        standings = []
+        for player in c.fetchall():
+            query = 'SELECT sum(player_totals.points) \
+                        FROM player_totals, matches \
+                        WHERE player_totals.id=matches.loser \
+                            AND matches.winner=%s \
+                            AND matches.draw=FALSE \
+                            AND matches.bye=FALSE'
+            c.execute(query, [player[0],])
+            standings.append(player + (c.fetchone()[0] or 0,))
+    standings.sort(key=lambda tup: (tup[2], tup[5]))
+    return standings
+
+
+def setUp(size):
+    """Registers size players and plays ROUNDS random Swiss rounds."""
+    deleteMatches()
+    deletePlayers()
+    registerPlayers('Player %d' % n for n in range(size))
+    for round in range(ROUNDS):
+        results = []
+        for (id1, name1, id2, name2) in swissPairings():
+            if id1 == id2:
+                results.append((id1, id1, False, True))
+            elif random.random() < 0.1:
+                results.append((id1, id2, True))
+            else:
+                results.append(random.sample([id1, id2], 2))
+        reportRound(results)
+
+
+def timeCall(function):
+    """Returns the median wall clock time of REPEAT calls, in milliseconds."""
+    timings = []
+    for i in range(REPEAT):
+        started = time.time()
+        function()
+        timings.append((time.time() - started) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def benchStandings(sizes):
+    print "%8s %16s %16s %16s" % ('players', 'standings (ms)', 'per-player (ms)',
+                                  'cached (ms)')
+    for size in sizes:
+        setUp(size)
+        tournament.CACHE_STANDINGS = False
+        uncached = timeCall(playerStandings)
+        tournament.CACHE_STANDINGS = True
+        playerStandings()
+        print "%8d %16.2f %16.2f %16.2f" % (size, uncached,
+                                            timeCall(legacyStandings),
+                                            timeCall(playerStandings))
+        sys.stdout.flush()
+    deleteMatches()
+    deletePlayers()
+
+
+def benchPairings(sizes):
+    """Plays PAIRING_ROUNDS random rounds in memory and times each pairing."""
+    print "%8s %8s %16s %16s" % ('players', 'rounds', 'slowest (ms)',
+                                 'rematches')
+    for size in sizes:
+        points = dict((id, 0) for id in range(1, size + 1))
+        byes = set()
+        played = {}
+        slowest = 0
+        rematches = 0
+        for round in range(PAIRING_ROUNDS):
+            standings = sorted((id, 'Player %d' % id, points[id], round,
+                                id in byes, 0) for id in points)
+            standings.sort(key=lambda row: row[2])
+            started = time.time()
+            pairings = pairing.pairPlayers(standings, played)
+            slowest = max(slowest, (time.time() - started) * 1000)
+            for (id1, name1, id2, name2) in pairings:
+                if id1 == id2:
+                    byes.add(id1)
+                    points[id1] += 2
+                    continue
+                if id2 in played.get(id1, ()):
+                    rematches += 1
+                played.setdefault(id1, set()).add(id2)
+                played.setdefault(id2, set()).add(id1)
+                points[random.choice([id1, id2])] += 2
+        print "%8d %8d %16.2f %16d" % (size, PAIRING_ROUNDS, slowest, rematches)
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    mode = 'standings'
+    if args and args[0] in ('standings', 'pairings'):
+        mode = args.pop(0)
+    sizes = [int(arg) for arg in args]
+    if mode == 'pairings':
+        benchPairings(sizes or PAIRING_SIZES)
+    else:
+        benchStandings(sizes or DEFAULT_SIZES)
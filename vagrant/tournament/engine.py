@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# engine.py -- in-memory tournament engine with write-behind to PostgreSQL
+#
+
+import logging
+import Queue
+import threading
+
+import tournament
+
+
+# The most results the writer records in one transaction
+BATCH_SIZE = 500
+
+log = logging.getLogger('tournament.engine')
+
+
+class Tournament(object):
+    """A tournament, the current one by default, loaded into memory once.
+
+    Standings and pairings are computed from memory, and results are applied
+    to the in-memory state as soon as they are reported.  They are written to
+    the players and matches tables by a background thread, which records
+    whatever results have queued up in one transaction, so the database
+    remains the system of record.
+
+    Results are validated in memory before they are accepted.  If writing them
+    fails anyway, e.g. because another process changed the same tournament,
+    the error is raised by the next call to flush() or close() and the
+    in-memory state should be discarded by loading a new Tournament.  When
+    the with block raises an exception of its own, that exception is raised
+    instead and the error is logged.
+
+    Usage:
+      with Tournament() as event:
+          for (id1, name1, id2, name2) in event.swissPairings():
+              ...
+          event.reportMatch(winner, loser)
+    """
+
+    def __init__(self, registration=None):
+        self.registration = registration
+        self.state = tournament.loadEvent(registration)
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._error = None
+        self._writer = threading.Thread(target=self._write)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+            return
+        # The block's exception is the one raised; a failed write is logged
+        try:
+            self.close()
+        except Exception:
+            log.exception('Writing the results failed')
+
+    def countPlayers(self):
+        """Returns the number of players registered, see countPlayers()."""
+        return self.state.countPlayers()
+
+    def registerPlayer(self, name):
+        """Registers a player, see registerPlayer().
+
+        Registration is written through immediately, because the player's id
+        is assigned by the database.  Returns the new player's id.
+        """
+        return self.registerPlayers([name])[0]
+
+    def registerPlayers(self, names):
+        """Registers many players at once, see registerPlayers()."""
+        names = list(names)
+        ids = tournament.registerPlayers(names, self.registration)
+        with self._lock:
+            for id, name in zip(ids, names):
+                self.state.addPlayer(id, name)
+        return ids
+
+    def reportMatch(self, winner, loser, draw=False, bye=False):
+        """Records the outcome of a single match, see reportMatch()."""
+        self.reportRound([(winner, loser, draw, bye)])
+
+    def reportRound(self, results):
+        """Records the outcomes of several matches, see reportRound()."""
+        results = [(tuple(result) + (False, False))[:4] for result in results]
+        with self._lock:
+            self.state.reportRound(results)
+        for result in results:
+            self._queue.put(result)
+
+    def playerStandings(self):
+        """Returns the standings, see playerStandings()."""
+        with self._lock:
+            return self.state.standings()
+
+    def swissPairings(self):
+        """Returns the next round's pairings, see swissPairings()."""
+        with self._lock:
+            return self.state.swissPairings()
+
+    def flush(self):
+        """Waits until every reported result has been written.
+
+        Raises the error that stopped the writer, if there was one.
+        """
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        """Writes any pending results and stops the background writer."""
+        self._queue.put(None)
+        self._writer.join()
+        if self._error is not None:
+            raise self._error
+
+    def _write(self):
+        """Background thread: records queued results in batches."""
+        while True:
+            results = [self._queue.get()]
+            while len(results) < BATCH_SIZE:
+                try:
+                    results.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            stop = None in results
+            results = [result for result in results if result is not None]
+            try:
+                if results and self._error is None:
+                    tournament.reportRound(results, self.registration)
+            except Exception as e:
+                self._error = e
+            finally:
+                for i in range(len(results) + int(stop)):
+                    self._queue.task_done()
+            if stop:
+                return
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+# export.py -- streams the standings, pairings and matches of a tournament as
+# newline delimited JSON or CSV, for systems that consume them downstream
+#
+# Rows are streamed straight from the database, through a server-side cursor
+# for JSON or COPY TO STDOUT for CSV, so an export takes the same memory
+# however large the tournament is.  Matches can be exported incrementally:
+# every export of the matches returns a cursor, and an export given that
+# cursor only writes the matches reported since.
+#
+# Usage: python export.py standings|pairings|matches [--format ndjson|csv]
+#                         [--registration NAME] [--round N] [--since CURSOR]
+#                         [--output FILE]
+#
+
+import argparse
+import csv
+import json
+import sys
+from collections import OrderedDict
+
+import tiebreaks
+import tournament
+
+
+FORMATS = ('ndjson', 'csv')
+
+# Rows fetched from a server-side cursor at a time
+ITERSIZE = 2000
+
+STANDINGS_COLUMNS = ('rank', 'id', 'name', 'points', 'matches', 'bye', 'omw')
+
+
+def _writeRows(out, columns, rows, format):
+    """Writes rows, tuples of the given columns, to out."""
+    if format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        # Booleans as PostgreSQL's COPY writes them
+        writer.writerows([{True: 't', False: 'f'}.get(value, value)
+                          if isinstance(value, bool) else value
+                          for value in row] for row in rows)
+    else:
+        for row in rows:
+            out.write(json.dumps(OrderedDict(zip(columns, row))) + '\n')
+
+
+def _stream(c, out, query, params, format):
+    """Writes the result of query to out, without holding it in memory, and
+    returns the number of rows written.
+
+    Args:
+      c: a cursor in a transaction on a pooled connection
+    """
+    if format == 'csv':
+        c.copy_expert('COPY (%s) TO STDOUT WITH CSV HEADER'
+                      % c.mogrify(query, params), out)
+        return c.rowcount
+    rows = c.connection.cursor('export')
+    rows.itersize = ITERSIZE
+    rows.execute(query, params)
+    count = 0
+    columns = None
+    for row in rows:
+        if columns is None:
+            columns = [column[0] for column in rows.description]
+        out.write(json.dumps(OrderedDict(zip(columns, row))) + '\n')
+        count += 1
+    rows.close()
+    return count
+
+
+@tournament._instrument.call
+def exportStandings(out, registration=None, format='ndjson'):
+    """Writes the standings of a tournament to out, first place first.
+
+    Each row holds the player's rank, id, name, points, matches, bye and OMW,
+    as in playerStandings().  With a tiebreak chain other than OMW alone, see
+    tiebreaks.CHAIN, the standings are ranked in memory by
+    playerStandings() first.
+
+    Returns:
+      The number of players written.
+    """
+    assert format in FORMATS, "Unknown export format: %s" % format
+    registration = tournament._event(registration)
+    if tiebreaks.CHAIN != ('omw',):
+        standings = tournament.playerStandings(registration)[::-1]
+        _writeRows(out, STANDINGS_COLUMNS,
+                   ((rank,) + tuple(row)
+                    for rank, row in enumerate(standings, 1)), format)
+        return len(standings)
+
+    query = 'SELECT row_number() OVER ( \
+                        ORDER BY points DESC, omw DESC, id DESC) AS rank, \
+                    id, name, points, matches, bye, omw \
+                FROM standings \
+                WHERE registration=%s \
+                ORDER BY points DESC, omw DESC, id DESC'
+    with tournament.transaction() as c:
+        return _stream(c, out, query, [registration,], format)
+
+
+@tournament._instrument.call
+def exportPairings(out, registration=None, round=None, format='ndjson'):
+    """Writes the pairings recorded by startRound() to out, round by round.
+
+    Each row holds the round's number, the pairing's id, both players' ids
+    and names, and whether the result was reported.  Only the pairings of
+    round number round are written if it is given.
+
+    Returns:
+      The number of pairings written.
+    """
+    assert format in FORMATS, "Unknown export format: %s" % format
+    query = 'SELECT rounds.number AS round, pairings.id AS pairing, \
+                    player1, one.name AS name1, player2, two.name AS name2, \
+                    pairings.reported \
+                FROM pairings \
+                    JOIN rounds ON rounds.id=pairings.round \
+                    JOIN players AS one ON one.id=player1 \
+                    JOIN players AS two ON two.id=player2 \
+                WHERE rounds.registration=%s'
+    params = [tournament._event(registration),]
+    if round is not None:
+        query += ' AND rounds.number=%s'
+        params.append(round)
+    query += ' ORDER BY rounds.number, pairings.id'
+    with tournament.transaction() as c:
+        return _stream(c, out, query, params, format)
+
+
+@tournament._instrument.call
+def exportMatches(out, registration=None, since=None, format='ndjson'):
+    """Writes the matches of a tournament to out, in the order they were
+    reported.
+
+    Each row holds the round's number and the pairing's id, if the match was
+    reported with reportPairing(), the winner's and the loser's ids and names
+    (the loser's are null for a bye), and the draw and bye flags.
+
+    Args:
+      since: a cursor returned by an earlier export of the same tournament;
+        only the matches reported after that export are written
+
+    Returns:
+      The cursor to continue from: the database snapshot the matches were
+      read from, as a string.  Every match reported after the snapshot, even
+      by a transaction that was still running when it was taken, is written
+      by the next export given it.
+    """
+    assert format in FORMATS, "Unknown export format: %s" % format
+    query = 'SELECT rounds.number AS round, matches.pairing, \
+                    winner, one.name AS winner_name, \
+                    loser, two.name AS loser_name, matches.draw, matches.bye \
+                FROM matches \
+                    JOIN players AS one ON one.id=winner \
+                    LEFT JOIN players AS two ON two.id=loser \
+                    LEFT JOIN pairings ON pairings.id=matches.pairing \
+                    LEFT JOIN rounds ON rounds.id=pairings.round \
+                WHERE matches.registration=%s'
+    params = [tournament._event(registration),]
+    if since is not None:
+        # Matches visible in the earlier snapshot were exported then; those
+        # committed before its xmin are visible in it
+        query += ' AND matches.txid >= txid_snapshot_xmin(%s::txid_snapshot) \
+                   AND NOT txid_visible_in_snapshot(matches.txid, \
+                                                    %s::txid_snapshot)'
+        params.extend([since, since])
+    query += ' ORDER BY matches.txid'
+    with tournament.transaction() as c:
+        # The snapshot returned must be the one the matches are read from
+        c.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;')
+        c.execute('SELECT txid_current_snapshot();')
+        snapshot = c.fetchone()[0]
+        _stream(c, out, query, params, format)
+    return snapshot
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export the standings, pairings or matches of a '
+                    'tournament.')
+    parser.add_argument('table', choices=['standings', 'pairings', 'matches'])
+    parser.add_argument('--format', choices=FORMATS, default='ndjson',
+                        help='newline delimited JSON or CSV (default: ndjson)')
+    parser.add_argument('--registration',
+                        help='the tournament to export (default: the current '
+                             'one)')
+    parser.add_argument('--round', type=int,
+                        help='only export the pairings of this round')
+    parser.add_argument('--since', metavar='CURSOR',
+                        help='only export the matches reported after the '
+                             'export that printed CURSOR')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write to FILE instead of standard output')
+    args = parser.parse_args(argv)
+
+    out = open(args.output, 'wb') if args.output else sys.stdout
+    try:
+        if args.table == 'standings':
+            exportStandings(out, args.registration, args.format)
+        elif args.table == 'pairings':
+            exportPairings(out, args.registration, args.round, args.format)
+        else:
+            cursor = exportMatches(out, args.registration, args.since,
+                                   args.format)
+            # The cursor goes to standard error, out of the exported data
+            print >> sys.stderr, 'cursor: %s' % cursor
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#
+# loadtest.py -- plays synthetic tournaments of a given size through the
+# tournament module and reports how each operation performs
+#
+# Every event is played in its own registration, which is deleted afterwards,
+# so the other tournaments in the database are left alone.  For each
+# operation the report gives the latency percentiles of its calls and how
+# many statements and round trips to the server each call took.
+#
+# Usage: python loadtest.py [--rounds N] [--batch] [--no-cache]
+#                           [--json FILE] [player counts...]
+#
+
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+import tournament
+
+
+DEFAULT_SIZES = [1000, 10000]
+# Players registered one at a time with registerPlayer(); the rest of an event
+# is registered with registerPlayers()
+SINGLE_REGISTRATIONS = 200
+# Extra playerStandings() calls timed after every round
+STANDINGS_CALLS = 5
+DRAW_RATE = 0.1
+
+
+class Counters(object):
+    """Statements and round trips made through the counting connections."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.roundTrips = 0
+
+    def add(self, queries, roundTrips):
+        with self._lock:
+            self.queries += queries
+            self.roundTrips += roundTrips
+
+    def snapshot(self):
+        with self._lock:
+            return self.queries, self.roundTrips
+
+
+counters = Counters()
+
+
+class CountingCursor(tournament._instrument.cursorFactory):
+    """A cursor that counts every statement it sends."""
+
+    def execute(self, query, vars=None):
+        counters.add(1, 1)
+        return super(CountingCursor, self).execute(query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        counters.add(1, 1)
+        return super(CountingCursor, self).copy_expert(sql, file, size)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    """A connection that counts commits and rollbacks as round trips.
+
+    Ending a transaction only reaches the server when one was started.
+    """
+
+    def commit(self):
+        if self.status != psycopg2.extensions.STATUS_READY:
+            counters.add(0, 1)
+        return super(CountingConnection, self).commit()
+
+    def rollback(self):
+        if self.status != psycopg2.extensions.STATUS_READY:
+            counters.add(0, 1)
+        return super(CountingConnection, self).rollback()
+
+
+class Operation(object):
+    """The latencies and statement counts of the calls to one function."""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.queries = 0
+        self.roundTrips = 0
+
+    def call(self, function, *args):
+        """Calls function(*args), recording its cost, and returns its result."""
+        queries, roundTrips = counters.snapshot()
+        started = time.time()
+        result = function(*args)
+        self.latencies.append((time.time() - started) * 1000)
+        after = counters.snapshot()
+        self.queries += after[0] - queries
+        self.roundTrips += after[1] - roundTrips
+        return result
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        calls = len(latencies)
+        return {'calls': calls,
+                'total_ms': sum(latencies),
+                'mean_ms': sum(latencies) / calls,
+                'p50_ms': percentile(latencies, 50),
+                'p90_ms': percentile(latencies, 90),
+                'p99_ms': percentile(latencies, 99),
+                'max_ms': latencies[-1],
+                'queries_per_call': float(self.queries) / calls,
+                'round_trips_per_call': float(self.roundTrips) / calls}
+
+
+def percentile(values, p):
+    """Returns the pth percentile of sorted values, by the nearest rank."""
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def swissRounds(size):
+    """The number of rounds that leaves a single undefeated player."""
+    return max(int(math.ceil(math.log(size, 2))), 1)
+
+
+def playEvent(size, rounds, batch):
+    """Plays a synthetic event and returns its results as a dictionary."""
+    registration = 'loadtest-%d' % size
+    tournament.deleteMatches(registration)
+    tournament.deletePlayers(registration)
+    operations = {}
+
+    def op(name):
+        if name not in operations:
+            operations[name] = Operation(name)
+        return operations[name]
+
+    started = time.time()
+    single = min(size, SINGLE_REGISTRATIONS)
+    for n in range(single):
+        op('registerPlayer').call(tournament.registerPlayer,
+                                  'Player %d' % n, registration)
+    if size > single:
+        op('registerPlayers').call(tournament.registerPlayers,
+                                   ['Player %d' % n for n in range(single, size)],
+                                   registration)
+
+    for round in range(rounds):
+        pairings = op('swissPairings').call(tournament.swissPairings,
+                                            registration)
+        results = []
+        for (id1, name1, id2, name2) in pairings:
+            if id1 == id2:
+                results.append((id1, id1, False, True))
+            elif random.random() < DRAW_RATE:
+                results.append((id1, id2, True, False))
+            else:
+                winner, loser = random.sample([id1, id2], 2)
+                results.append((winner, loser, False, False))
+        if batch:
+            op('reportRound').call(tournament.reportRound, results,
+                                   registration)
+        else:
+            for result in results:
+                op('reportMatch').call(tournament.reportMatch,
+                                       *(result + (registration,)))
+        for i in range(STANDINGS_CALLS):
+            op('playerStandings').call(tournament.playerStandings,
+                                       registration)
+    elapsed = time.time() - started
+
+    tournament.deleteMatches(registration)
+    tournament.deletePlayers(registration)
+    return {'players': size,
+            'rounds': rounds,
+            'elapsed_s': elapsed,
+            'operations': dict((name, operation.summary())
+                               for name, operation in operations.iteritems())}
+
+
+def serverVersion():
+    with tournament.transaction() as c:
+        c.execute('SHOW server_version')
+        return c.fetchone()[0]
+
+
+def printEvent(event):
+    print "%d players, %d rounds, %.1f s" % (event['players'], event['rounds'],
+                                             event['elapsed_s'])
+    print "  %-16s %8s %10s %10s %10s %10s %9s %9s" % (
+        'operation', 'calls', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'max (ms)',
+        'queries', 'trips')
+    for name, summary in sorted(event['operations'].iteritems()):
+        print "  %-16s %8d %10.2f %10.2f %10.2f %10.2f %9.1f %9.1f" % (
+            name, summary['calls'], summary['p50_ms'], summary['p90_ms'],
+            summary['p99_ms'], summary['max_ms'], summary['queries_per_call'],
+            summary['round_trips_per_call'])
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Play synthetic tournaments and time each operation.')
+    parser.add_argument('sizes', metavar='players', type=int, nargs='*',
+                        default=DEFAULT_SIZES,
+                        help='event sizes (default: %s)' %
+                             ' '.join(map(str, DEFAULT_SIZES)))
+    parser.add_argument('--rounds', type=int,
+                        help='rounds per event (default: enough to leave one '
+                             'undefeated player)')
+    parser.add_argument('--batch', action='store_true',
+                        help='report each round with reportRound() instead of '
+                             'one reportMatch() per match')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='turn the standings cache off')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for the results (default: 0)')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results as JSON to FILE, or to '
+                             'standard output if FILE is -')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    tournament.CACHE_STANDINGS = not args.no_cache
+    tournament.configurePool(connection_factory=CountingConnection,
+                             cursor_factory=CountingCursor)
+    report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'postgresql': serverVersion(),
+              'batch': args.batch,
+              'cache': tournament.CACHE_STANDINGS,
+              'seed': args.seed,
+              'events': []}
+    for size in args.sizes:
+        event = playEvent(size, args.rounds or swissRounds(size), args.batch)
+        report['events'].append(event)
+        if args.json != '-':
+            printEvent(event)
+
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
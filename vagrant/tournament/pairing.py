@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#
+# pairing.py -- Swiss pairing engine that avoids rematches
+#
+# The engine works on standings rows in memory and never touches the database,
+# so it can be used on live data as well as on simulated events.
+#
+
+# How many not yet paired players below a player are considered as opponents.
+# Players are ranked by points, so this bounds the score difference of a pair.
+WINDOW = 16
+
+# How many candidate opponents the search may examine per player before it
+# gives up on avoiding every rematch.
+BUDGET_PER_PLAYER = 20
+
+
+def playedOpponents(matches):
+    """Returns a dictionary mapping each player's id to the set of ids of the
+    players he or she has already played.
+
+    Args:
+      matches: an iterable of (winner, loser) tuples; byes are left out
+    """
+    played = {}
+    for winner, loser in matches:
+        played.setdefault(winner, set()).add(loser)
+        played.setdefault(loser, set()).add(winner)
+    return played
+
+
+def pairPlayers(standings, played, window=WINDOW, budget=None):
+    """Pairs the players in standings for the next round.
+
+    If there is an odd number of players, the lowest ranked player without a
+    bye gets one.  The others are paired top down: every player is paired with
+    the nearest player below him or her in the standings that he or she has
+    not played yet.  When that leads to a dead end further down, the search
+    backtracks and tries the next candidates, so a rematch is only accepted
+    when no pairing without one is found within the window and budget.
+
+    Args:
+      standings: rows as returned by playerStandings(), lowest ranked first;
+        only the id (0), name (1) and bye (4) columns are used
+      played: a dictionary as returned by playedOpponents()
+      window: how many candidate opponents to consider for each player
+      budget: how many candidates the search may examine in total before
+        falling back to a greedy pairing that allows rematches; defaults to
+        BUDGET_PER_PLAYER per player
+
+    Returns:
+      A list of (id1, name1, id2, name2) tuples as described in
+      swissPairings(), the bye (if any) first.
+
+    Raises:
+      ValueError: there is an odd number of players and all of them already
+        received a bye.
+    """
+    pairings = []
+    players = standings
+    if len(standings) % 2 != 0:
+        for i, player in enumerate(standings):
+            if not player[4]:
+                pairings.append((player[0], player[1], player[0], player[1]))
+                players = standings[:i] + standings[i+1:]
+                break
+        else:
+            raise ValueError("Every player has already received a bye")
+
+    # Highest ranked first, so that the top tables get the best pairings
+    players = players[::-1]
+    opponents = [played.get(player[0], ()) for player in players]
+    if budget is None:
+        budget = BUDGET_PER_PLAYER * len(players)
+
+    mate = _search(players, opponents, window, budget)
+    if mate is None:
+        mate = _greedy(players, opponents, window)
+
+    # Lowest tables first, lower ranked player first, like the standings
+    for i in range(len(players) - 1, -1, -1):
+        j = mate[i]
+        if j > i:
+            pairings.append((players[j][0], players[j][1],
+                             players[i][0], players[i][1]))
+    return pairings
+
+
+def _search(players, opponents, window, budget):
+    """Depth first search for a pairing without rematches.
+
+    Returns a list mapping each index in players to the index of its opponent,
+    or None if no such pairing was found within the budget.
+    """
+    n = len(players)
+    mate = [-1] * n
+    # The pairs made so far as (i, j, seen): seen is how many candidates for
+    # i had been considered up to and including j, so the search can resume
+    # after j when it backtracks.
+    stack = []
+    i, k, seen = 0, 1, 0
+    steps = 0
+
+    while i < n:
+        if mate[i] != -1:
+            i += 1
+            k, seen = i + 1, 0
+            continue
+
+        partner = -1
+        while k < n and seen < window:
+            if mate[k] == -1:
+                seen += 1
+                steps += 1
+                if players[k][0] not in opponents[i]:
+                    partner = k
+                    break
+            k += 1
+
+        if partner != -1:
+            mate[i] = partner
+            mate[partner] = i
+            stack.append((i, partner, seen))
+            i += 1
+            k, seen = i + 1, 0
+            continue
+
+        # Dead end: undo the most recent pair and try its next candidate
+        if not stack or steps > budget:
+            return None
+        i, j, seen = stack.pop()
+        mate[i] = mate[j] = -1
+        k = j + 1
+
+    return mate
+
+
+def _greedy(players, opponents, window):
+    """Pairs every player with the nearest player below that he or she has not
+    played yet, or with the nearest one if they have all been played.
+    """
+    n = len(players)
+    mate = [-1] * n
+    for i in range(n):
+        if mate[i] != -1:
+            continue
+        partner = -1
+        seen = 0
+        for k in range(i + 1, n):
+            if mate[k] != -1:
+                continue
+            if partner == -1:
+                partner = k
+            if players[k][0] not in opponents[i]:
+                partner = k
+                break
+            seen += 1
+            if seen >= window:
+                break
+        mate[i] = partner
+        mate[partner] = i
+    return mate
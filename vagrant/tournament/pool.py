@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#
+# pool.py -- a small thread-safe psycopg2 connection pool
+#
+
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+
+class PoolError(psycopg2.Error):
+    """Raised when a connection cannot be checked out of the pool."""
+
+
+class PooledConnection(object):
+    """Wraps a psycopg2 connection that belongs to a ConnectionPool.
+
+    Everything except close() is forwarded to the real connection, so code
+    written against a plain psycopg2 connection keeps working.  Calling close()
+    hands the connection back to the pool instead of closing the socket.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None:
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.putconn(conn)
+
+
+class ConnectionPool(object):
+    """A bounded pool of psycopg2 connections shared between threads.
+
+    Connections are opened lazily, so creating a pool never touches the
+    database.  At most maxconn connections exist at any time; a checkout
+    blocks until one is returned when they are all in use.  Up to minconn idle
+    connections are kept open between checkouts, anything beyond that is
+    closed when it is returned.
+
+    Args:
+      dsn: the libpq connection string, e.g. "dbname=tournament"
+      minconn: the number of idle connections to keep open
+      maxconn: the maximum number of connections open at once
+      timeout: seconds to wait for a free connection (None waits forever)
+      check_after: idle seconds after which a connection is pinged with
+        'SELECT 1' on checkout; 0 pings on every checkout
+      connection_factory, cursor_factory: passed through to psycopg2.connect
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=None,
+                 check_after=30, connection_factory=None,
+                 cursor_factory=None):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Pool sizes must satisfy 0 <= minconn <= maxconn"
+                             " and maxconn >= 1")
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_after = check_after
+        self.connection_factory = connection_factory
+        self.cursor_factory = cursor_factory
+
+        self._lock = threading.Condition()
+        # Idle connections as (connection, time it was returned)
+        self._idle = []
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+        self._stats = {'checkouts': 0, 'waits': 0, 'wait_time': 0.0,
+                       'created': 0, 'discarded': 0, 'failed_checks': 0}
+
+    def _connect(self):
+        kwargs = {}
+        if self.connection_factory is not None:
+            kwargs['connection_factory'] = self.connection_factory
+        if self.cursor_factory is not None:
+            kwargs['cursor_factory'] = self.cursor_factory
+        return psycopg2.connect(self.dsn, **kwargs)
+
+    def _healthy(self, conn, idle_since):
+        """Returns True if an idle connection can be handed out again."""
+        if conn.closed:
+            return False
+        if time.time() - idle_since < self.check_after:
+            return True
+        try:
+            c = conn.cursor()
+            c.execute('SELECT 1;')
+            c.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, timeout=None):
+        """Checks a connection out of the pool.
+
+        Returns a PooledConnection; close() it (or use it in a with block) to
+        give it back.  Raises PoolError if no connection became free within
+        the timeout.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        started = time.time()
+        waited = False
+
+        while True:
+            with self._lock:
+                while True:
+                    if self._closed:
+                        raise PoolError("Connection pool is closed")
+                    if self._idle:
+                        conn, idle_since = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        # Reserve the slot, the connection is opened below
+                        # without holding the lock.
+                        self._size += 1
+                        conn, idle_since = None, None
+                        break
+                    remaining = None
+                    if timeout is not None:
+                        remaining = timeout - (time.time() - started)
+                        if remaining <= 0:
+                            self._stats['waits'] += 1
+                            self._stats['wait_time'] += time.time() - started
+                            raise PoolError("Timed out waiting for a database"
+                                            " connection")
+                    waited = True
+                    self._waiting += 1
+                    try:
+                        self._lock.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+                created = True
+            elif self._healthy(conn, idle_since):
+                created = False
+            else:
+                self._discard(conn, failed_check=True)
+                continue
+
+            with self._lock:
+                if created:
+                    self._stats['created'] += 1
+                self._stats['checkouts'] += 1
+                if waited:
+                    self._stats['waits'] += 1
+                self._stats['wait_time'] += time.time() - started
+            return PooledConnection(self, conn)
+
+    def putconn(self, conn, close=False):
+        """Returns a raw connection to the pool.
+
+        Any transaction still open on it is rolled back first.  The connection
+        is closed instead of kept if close is True, if it is broken, or if the
+        pool already holds minconn idle connections and nobody is waiting.
+        """
+        if isinstance(conn, PooledConnection):
+            conn.close()
+            return
+        if not close and not conn.closed:
+            try:
+                status = conn.get_transaction_status()
+                if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+        if close or conn.closed:
+            self._discard(conn)
+            return
+
+        with self._lock:
+            # Surplus connections are kept while other threads are waiting
+            # for one, so a busy pool does not keep reconnecting.
+            if not self._closed and (len(self._idle) < self.minconn or
+                                     self._waiting):
+                self._idle.append((conn, time.time()))
+                self._lock.notify()
+                return
+        self._discard(conn)
+
+    def _discard(self, conn, failed_check=False):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._lock:
+            self._stats['discarded'] += 1
+            if failed_check:
+                self._stats['failed_checks'] += 1
+        self._release_slot()
+
+    def _release_slot(self):
+        with self._lock:
+            self._size -= 1
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context manager that checks out a connection for one transaction.
+
+        The transaction is committed when the block exits normally and rolled
+        back if it raises; either way the connection goes back to the pool.
+        """
+        conn = self.getconn(timeout)
+        with conn:
+            yield conn
+
+    @contextmanager
+    def cursor(self, timeout=None):
+        """Like connection(), but yields a cursor on the checked out
+        connection.
+        """
+        with self.connection(timeout) as conn:
+            c = conn.cursor()
+            try:
+                yield c
+            finally:
+                c.close()
+
+    def stats(self):
+        """Returns a snapshot of the pool's counters as a dictionary.
+
+        checkouts: connections handed out so far
+        waits: checkouts that had to wait for a connection to be returned
+        wait_time: total seconds spent inside getconn()
+        created: connections opened to the server
+        discarded: connections closed, e.g. surplus or broken ones
+        failed_checks: idle connections that failed the health check
+        size, idle, in_use: current number of open, idle and busy connections
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+        return stats
+
+    def closeall(self):
+        """Closes every idle connection and refuses further checkouts.
+
+        Connections that are checked out are closed when they are returned.
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._lock.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
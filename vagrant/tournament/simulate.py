@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# simulate.py -- Monte Carlo simulation of the remaining rounds of a tournament
+#
+# The tournament is read from the database once, with tournament.loadEvent();
+# every playout then pairs and plays the remaining rounds on its own copy of
+# that state.EventState, with the same pairing and standings rules as the
+# live tournament, and notes who finishes in the top cut.  The playouts are
+# spread over a pool of worker processes and never touch the database.
+#
+# Usage: python simulate.py [--cut N] [--playouts N] [--processes N]
+#                           [--seed N] [--registration NAME] rounds
+#
+
+import argparse
+import multiprocessing
+import random
+import sys
+import time
+
+import tournament
+
+
+# The share of simulated matches that end in a draw, unless the tournament
+# has had some matches already; then its own share of draws is used
+DRAW_RATE = 0.1
+# Playouts handed to a worker process at a time
+CHUNK_SIZE = 50
+
+
+def playout(event, rounds, cut, drawRate, rng):
+    """Plays the remaining rounds on event, which is changed, and returns the
+    ids of the players in the top cut.
+
+    Every match is won by either player with even chances, or drawn with a
+    probability of drawRate.
+    """
+    for round in range(rounds):
+        # Pairings are valid results by construction, so each match is
+        # recorded on its own rather than checked again as a round
+        for (id1, name1, id2, name2) in event.swissPairings():
+            if id1 == id2:
+                event.reportMatch(id1, id1, False, True)
+            elif rng.random() < drawRate:
+                event.reportMatch(id1, id2, True)
+            elif rng.random() < 0.5:
+                event.reportMatch(id1, id2)
+            else:
+                event.reportMatch(id2, id1)
+    # The standings are lowest ranked first
+    return [row[0] for row in event.standings()[-cut:]]
+
+
+# The snapshot every worker process simulates; set by _startWorker(), or
+# directly when the playouts are run in this process
+_snapshot = None
+
+
+def _startWorker(event, rounds, cut, drawRate):
+    global _snapshot
+    _snapshot = (event, rounds, cut, drawRate)
+
+
+def _playChunk(args):
+    """Runs count playouts of the snapshot and returns how many times each
+    player made the cut, as a dictionary.
+    """
+    count, seed = args
+    event, rounds, cut, drawRate = _snapshot
+    rng = random.Random(seed)
+    qualified = {}
+    for i in range(count):
+        for id in playout(event.copy(), rounds, cut, drawRate, rng):
+            qualified[id] = qualified.get(id, 0) + 1
+    return qualified
+
+
+def observedDrawRate(event):
+    """Returns the share of the played matches of event that were drawn, or
+    DRAW_RATE if none were played yet.
+    """
+    players = event.players.values()
+    # Both players of a draw count it, and a bye counts as a win
+    draws = sum(player.draws for player in players) / 2.0
+    decided = sum(player.wins - player.bye for player in players)
+    if draws + decided == 0:
+        return DRAW_RATE
+    return draws / (draws + decided)
+
+
+def simulate(rounds, cut=8, playouts=1000, processes=None, seed=None,
+             registration=None, event=None):
+    """Estimates each player's chances of finishing in the top cut.
+
+    Args:
+      rounds: the number of rounds still to be played
+      cut: how many of the best ranked players qualify
+      playouts: how many times the remaining rounds are played out
+      processes: the number of worker processes, one per CPU by default; with
+        1 the playouts run in this process
+      seed: seeds the random results, so a simulation can be repeated
+      registration: the tournament to simulate, the current one by default
+      event: a state.EventState to simulate instead of reading the tournament
+        from the database
+
+    Returns:
+      A list of (id, name, points, probability) tuples, one per player, the
+      likeliest to qualify first; probability is the share of the playouts in
+      which the player made the cut.
+    """
+    if event is None:
+        event = tournament.loadEvent(registration)
+    assert rounds >= 0, "The number of rounds can't be negative"
+    assert playouts > 0, "At least one playout is required"
+    cut = min(cut, event.countPlayers())
+    rate = observedDrawRate(event)
+    seeds = random.Random(seed)
+    chunks = []
+    for start in range(0, playouts, CHUNK_SIZE):
+        chunks.append((min(CHUNK_SIZE, playouts - start),
+                       seeds.randint(0, sys.maxint)))
+
+    qualified = dict((id, 0) for id in event.players)
+    if processes == 1:
+        _startWorker(event, rounds, cut, rate)
+        counts = map(_playChunk, chunks)
+    else:
+        # The workers inherit the snapshot when they start, rather than
+        # receiving a copy of it with every chunk
+        workers = multiprocessing.Pool(processes, _startWorker,
+                                       (event, rounds, cut, rate))
+        try:
+            counts = workers.map(_playChunk, chunks, chunksize=1)
+        finally:
+            workers.terminate()
+    for count in counts:
+        for id, n in count.iteritems():
+            qualified[id] += n
+
+    chances = [(id, player.name, player.points,
+                float(qualified[id]) / playouts)
+               for id, player in event.players.iteritems()]
+    chances.sort(key=lambda row: (-row[3], -row[2], row[0]))
+    return chances
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Estimate who can still make the top cut of a tournament.')
+    parser.add_argument('rounds', type=int,
+                        help='the number of rounds still to be played')
+    parser.add_argument('--cut', type=int, default=8,
+                        help='how many players qualify (default: 8)')
+    parser.add_argument('--playouts', type=int, default=1000,
+                        help='how many times to play the remaining rounds '
+                             '(default: 1000)')
+    parser.add_argument('--processes', type=int,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--seed', type=int,
+                        help='random seed for the results')
+    parser.add_argument('--registration',
+                        help='the tournament to simulate (default: the '
+                             'current one)')
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    chances = simulate(args.rounds, args.cut, args.playouts, args.processes,
+                       args.seed, args.registration)
+    elapsed = time.time() - started
+    print "%d playouts of %d rounds, %d players, %.1f s" % (
+        args.playouts, args.rounds, len(chances), elapsed)
+    print "  %8s  %-30s %6s %12s" % ('id', 'name', 'points', 'top cut (%)')
+    for id, name, points, probability in chances:
+        if probability == 0:
+            break
+        print "  %8d  %-30s %6d %12.1f" % (id, name[:30], points,
+                                           probability * 100)
+    print "  %d players did not make the top %d in any playout" % (
+        sum(1 for row in chances if row[3] == 0), args.cut)
+
+
+if __name__ == '__main__':
+    main()
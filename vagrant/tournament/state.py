@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# state.py -- in-memory standings of a tournament
+#
+# EventState keeps every player's record in memory and updates it as results
+# come in, following the same rules as tournament.py, so standings and
+# pairings can be computed without reading the database again.
+#
+
+import pairing
+import tiebreaks
+
+
+def checkResult(winner, loser, draw=False, bye=False):
+    """Asserts that a single match result follows the tournament's rules."""
+    if bye:
+        assert winner == loser, "Only one player can receive a bye in a single match"
+        assert not draw, "There can't be a bye and a draw in the same match"
+    elif draw:
+        assert winner != loser, "Two distinct players are required for a draw"
+    else:
+        assert winner != loser, "Two distinct players are required for a normal match"
+
+
+class PlayerState(object):
+    """The record of a single player.
+
+    beatenBy lists the players who defeated this player, once per match, so
+    that their OMW can be updated when this player's points change.
+    """
+
+    __slots__ = ('id', 'name', 'wins', 'losses', 'draws', 'points', 'bye',
+                 'omw', 'beatenBy')
+
+    def __init__(self, id, name, wins=0, losses=0, draws=0, points=0,
+                 bye=False):
+        self.id = id
+        self.name = name
+        self.wins = wins
+        self.losses = losses
+        self.draws = draws
+        self.points = points
+        self.bye = bye
+        self.omw = 0
+        self.beatenBy = []
+
+    def row(self):
+        """Returns the player's standings row, see playerStandings()."""
+        return (self.id, self.name, self.points,
+                self.wins + self.losses + self.draws, self.bye, self.omw)
+
+
+class EventState(object):
+    """The players and results of one tournament, held in memory.
+
+    Build it with fromRows() from the players and matches tables, then keep
+    it up to date with addPlayer() and reportMatch().
+    """
+
+    def __init__(self):
+        # Player id -> PlayerState
+        self.players = {}
+        # Player id -> set of the ids of the opponents he or she has played
+        self.played = {}
+        # Every (winner, loser, draw, bye) result, for the tiebreaks
+        self.matches = []
+
+    @classmethod
+    def fromRows(cls, players, matches):
+        """Builds the state of a tournament from database rows.
+
+        Args:
+          players: (id, name, wins, losses, draws, points, bye) rows
+          matches: (winner, loser, draw, bye) rows
+        """
+        state = cls()
+        for row in players:
+            state.players[row[0]] = PlayerState(*row)
+        for winner, loser, draw, bye in matches:
+            state.matches.append((winner, loser, draw, bye))
+            if bye:
+                continue
+            state.played.setdefault(winner, set()).add(loser)
+            state.played.setdefault(loser, set()).add(winner)
+            if not draw:
+                state.players[loser].beatenBy.append(winner)
+        for player in state.players.itervalues():
+            for winner in player.beatenBy:
+                state.players[winner].omw += player.points
+        return state
+
+    def copy(self):
+        """Returns an independent copy of this state."""
+        state = EventState()
+        for id, player in self.players.iteritems():
+            clone = PlayerState(id, player.name, player.wins, player.losses,
+                                player.draws, player.points, player.bye)
+            clone.omw = player.omw
+            clone.beatenBy = list(player.beatenBy)
+            state.players[id] = clone
+        state.played = dict((id, set(opponents))
+                            for id, opponents in self.played.iteritems())
+        state.matches = list(self.matches)
+        return state
+
+    def countPlayers(self):
+        return len(self.players)
+
+    def addPlayer(self, id, name):
+        self.players[id] = PlayerState(id, name)
+
+    def checkMatch(self, winner, loser, draw=False, bye=False):
+        """Asserts that a result may be recorded, like reportMatch() does."""
+        checkResult(winner, loser, draw, bye)
+        if bye:
+            assert not self.players[winner].bye, "Each player can only receive one bye in one tournament"
+
+    def reportMatch(self, winner, loser, draw=False, bye=False):
+        """Records a result; only the two players and the players who
+        defeated them are updated.
+        """
+        self.checkMatch(winner, loser, draw, bye)
+        first = self.players[winner]
+        self.matches.append((winner, loser, draw, bye))
+        if bye:
+            first.wins += 1
+            first.bye = True
+            self._addPoints(first, 2)
+            return
+
+        second = self.players[loser]
+        self.played.setdefault(winner, set()).add(loser)
+        self.played.setdefault(loser, set()).add(winner)
+        if draw:
+            first.draws += 1
+            second.draws += 1
+            self._addPoints(first, 1)
+            self._addPoints(second, 1)
+        else:
+            first.wins += 1
+            second.losses += 1
+            second.beatenBy.append(winner)
+            first.omw += second.points
+            self._addPoints(first, 2)
+
+    def reportRound(self, results):
+        """Records a whole round; nothing is recorded if any result is
+        invalid.
+        """
+        results = [(tuple(result) + (False, False))[:4] for result in results]
+        byes = set()
+        for winner, loser, draw, bye in results:
+            self.checkMatch(winner, loser, draw, bye)
+            if bye:
+                assert winner not in byes, "Each player can only receive one bye in one tournament"
+                byes.add(winner)
+        for result in results:
+            self.reportMatch(*result)
+
+    def _addPoints(self, player, points):
+        player.points += points
+        for winner in player.beatenBy:
+            self.players[winner].omw += points
+
+    def standings(self):
+        """Returns the standings in the same form and order as
+        playerStandings(), ranked with the tiebreaks.CHAIN tiebreaks.
+        """
+        rows = [player.row() for player in self.players.itervalues()]
+        return tiebreaks.sortStandings(rows, self.matches)
+
+    def swissPairings(self):
+        """Returns the next round's pairings, see swissPairings()."""
+        return pairing.pairPlayers(self.standings(), self.played)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# tiebreaks.py -- tiebreak systems for ranking players with equal points
+#
+# The matches of a tournament are loaded once into NumPy arrays, as a list of
+# edges from each player to each opponent, and every tiebreak is computed for
+# all players at once from those arrays.  Standings are ranked by points, then
+# by each tiebreak of the configured chain in turn, then by id.
+#
+# Points are those of playerStandings(): 2 for a win or a bye, 1 for a draw.
+#
+
+import os
+
+import numpy
+
+
+# Tiebreaks, each higher is better:
+#   omw: the sum of the points of the opponents a player defeated, as shown
+#     in the standings
+#   buchholz: the sum of the points of every opponent a player met
+#   median-buchholz: the same without the best and the worst opponent, for
+#     players who met at least three opponents
+#   sonneborn-berger: the points of every defeated opponent plus half the
+#     points of every opponent drawn with
+#   omw-percentage: the mean match-win percentage of a player's opponents,
+#     each counted as at least a third
+# Byes are not matches against an opponent and count towards none of them.
+TIEBREAKS = ('omw', 'buchholz', 'median-buchholz', 'sonneborn-berger',
+             'omw-percentage')
+
+# The lowest match-win percentage an opponent counts for in omw-percentage
+MIN_MATCH_WIN_PERCENTAGE = 1.0 / 3
+
+
+def parseChain(text):
+    """Returns the tiebreak chain named in a comma separated string."""
+    chain = tuple(name.strip() for name in text.split(',') if name.strip())
+    for name in chain:
+        assert name in TIEBREAKS, "Unknown tiebreak: %s" % name
+    return chain
+
+
+# The tiebreaks that rank players with equal points, in order.  Standings and
+# pairings follow it everywhere, so after changing it call
+# tournament.invalidateStandings() to re-sort cached standings.
+CHAIN = parseChain(os.environ.get('TOURNAMENT_TIEBREAKS', 'omw'))
+
+
+class Results(object):
+    """The matches of a tournament as NumPy arrays, indexed like the
+    standings rows they were built with.
+
+    Every match between two players is an edge from each of them to the
+    other: player[k] met opponent[k] and scored score[k] of it, 1 for a win,
+    0.5 for a draw and 0 for a loss.
+    """
+
+    def __init__(self, standings, matches):
+        """Args:
+          standings: rows as returned by playerStandings()
+          matches: (winner, loser, draw, bye) tuples of the same players
+        """
+        self.size = len(standings)
+        self.ids = numpy.array([row[0] for row in standings], dtype=numpy.int64)
+        self.points = numpy.array([row[2] for row in standings], dtype=float)
+        self.matches = numpy.array([row[3] for row in standings], dtype=float)
+        self.omw = numpy.array([row[5] for row in standings], dtype=float)
+        self._byId = numpy.argsort(self.ids)
+
+        played = [match for match in matches if not match[3]]
+        winners = self._index([match[0] for match in played])
+        losers = self._index([match[1] for match in played])
+        draws = numpy.array([bool(match[2]) for match in played], dtype=bool)
+        self.player = numpy.concatenate([winners, losers])
+        self.opponent = numpy.concatenate([losers, winners])
+        self.score = numpy.concatenate([numpy.where(draws, 0.5, 1.0),
+                                        numpy.where(draws, 0.5, 0.0)])
+        self.opponents = numpy.bincount(self.player, minlength=self.size)
+
+    def _index(self, ids):
+        """Returns the positions in the standings of the players with ids."""
+        ids = numpy.array(ids, dtype=numpy.int64)
+        return self._byId[numpy.searchsorted(self.ids, ids, sorter=self._byId)]
+
+    def _sum(self, weights):
+        """Sums weights, given per edge, for each player."""
+        return numpy.bincount(self.player, weights=weights,
+                              minlength=self.size)
+
+    def tiebreak(self, name):
+        """Returns the named tiebreak of every player as an array."""
+        assert name in TIEBREAKS, "Unknown tiebreak: %s" % name
+        if name == 'omw':
+            return self.omw
+        opponentPoints = self.points[self.opponent]
+        if name == 'buchholz':
+            return self._sum(opponentPoints)
+        if name == 'median-buchholz':
+            best = numpy.zeros(self.size)
+            worst = numpy.full(self.size, numpy.inf)
+            numpy.maximum.at(best, self.player, opponentPoints)
+            numpy.minimum.at(worst, self.player, opponentPoints)
+            cut = numpy.where(self.opponents >= 3, best + worst, 0)
+            return self._sum(opponentPoints) - cut
+        if name == 'sonneborn-berger':
+            return self._sum(self.score * opponentPoints)
+        # omw-percentage
+        percentage = numpy.maximum(
+            self.points / numpy.maximum(2 * self.matches, 1),
+            MIN_MATCH_WIN_PERCENTAGE)
+        total = self._sum(percentage[self.opponent])
+        return total / numpy.maximum(self.opponents, 1)
+
+
+def compute(standings, matches, chain=None):
+    """Returns the tiebreaks of the chain, CHAIN by default, for the players
+    in standings as a dictionary of arrays in the same order as standings.
+    """
+    results = Results(standings, matches)
+    return dict((name, results.tiebreak(name))
+                for name in (CHAIN if chain is None else chain))
+
+
+def sortStandings(standings, matches, chain=None):
+    """Returns standings ranked by points, then by the tiebreaks of the
+    chain, CHAIN by default, then by id; lowest ranked player first, like
+    playerStandings().
+
+    Args:
+      standings: rows as returned by playerStandings(), in any order
+      matches: (winner, loser, draw, bye) tuples of the same tournament
+    """
+    if chain is None:
+        chain = CHAIN
+    if tuple(chain) == ('omw',):
+        # The OMW is in the rows already
+        return sorted(standings, key=lambda row: (row[2], row[5], row[0]))
+    if not standings:
+        return []
+    results = Results(standings, matches)
+    # lexsort sorts by the last key first
+    keys = [results.ids]
+    keys.extend(results.tiebreak(name) for name in reversed(chain))
+    keys.append(results.points)
+    return [standings[i] for i in numpy.lexsort(keys)]
+
+
+def places(standings, matches, chain=None):
+    """Returns the place of every player in the order of sortStandings(), as
+    a dictionary keyed by id: 1 for the best ranked player, with the players
+    equal on points and on every tiebreak of the chain sharing a place.
+
+    Args:
+      standings: rows as returned by playerStandings(), in any order
+      matches: (winner, loser, draw, bye) tuples of the same tournament
+    """
+    if chain is None:
+        chain = CHAIN
+    if not standings:
+        return {}
+    if tuple(chain) == ('omw',):
+        keys = [(row[2], row[5]) for row in standings]
+    else:
+        results = Results(standings, matches)
+        columns = [results.points]
+        columns.extend(results.tiebreak(name) for name in chain)
+        keys = zip(*[column.tolist() for column in columns])
+    place = {}
+    for i, key in enumerate(sorted(keys, reverse=True)):
+        place.setdefault(key, i + 1)
+    return dict((row[0], place[key]) for row, key in zip(standings, keys))
@@ -3,73 +3,440 @@
 # tournament.py -- implementation of a Swiss-system tournament
 #
 
+import csv
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from cStringIO import StringIO
+
 import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extensions
+
+# instrument.py is shared with the forum
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'shared'))
+import instrument
+import pairing
+import pool
+import state
+import tiebreaks
+
+
+DSN = os.environ.get('TOURNAMENT_DSN', 'dbname=tournament')
+
+# The tournament that functions work on when no registration is given
+CURRENT = 'current'
+
+# The statements, database time, rows and connection waits of every call to
+# the functions below are recorded, see queryStats().  Calls that take
+# TOURNAMENT_SLOW_MS milliseconds or more are logged to the 'tournament.slow'
+# logger with the plans of their slow statements.
+_instrument = instrument.Instrument(
+    'tournament',
+    slowMs=float(os.environ['TOURNAMENT_SLOW_MS'])
+    if os.environ.get('TOURNAMENT_SLOW_MS') else None)
+
+# Every function in this module borrows its connection from this pool rather
+# than opening a new one.  Connections are only opened when first needed.
+_pool = pool.ConnectionPool(DSN,
+                            minconn=int(os.environ.get('TOURNAMENT_POOL_MIN', 1)),
+                            maxconn=int(os.environ.get('TOURNAMENT_POOL_MAX', 10)),
+                            cursor_factory=_instrument.cursorFactory)
+
+
+# Changes to a tournament's players or results are announced on this channel
+# with NOTIFY, the tournament's registration as the payload, when they are
+# committed; the forum pushes the new standings to its clients, see
+# forum/events.py
+NOTIFY_CHANNEL = 'tournament_results'
+
+
+# How many times a report is attempted when PostgreSQL aborts it to break a
+# deadlock with another report, see record_results in tournament.sql
+REPORT_ATTEMPTS = 5
+
+
+# Standings of each tournament are kept in memory between calls, keyed by
+# registration, and updated in place by the functions below that change them.
+# Only changes made through this module are seen, so call invalidateStandings()
+# after changing the tables by any other means.
+CACHE_STANDINGS = os.environ.get('TOURNAMENT_CACHE', '1') != '0'
+
+# _cacheLock guards the dictionaries below and is only held to look them up
+# or change them.  Each tournament's entry is read, updated and paired under
+# that tournament's own lock in _eventLocks, so a slow read of one tournament
+# never holds up the others.
+_cache = {}
+_cacheLock = threading.Lock()
+_cacheStats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'updates': 0,
+               'invalidations': 0}
+_eventLocks = {}
+# Counts the calls to invalidateStandings(), so that a tournament read while
+# it was invalidated is not cached
+_cacheGeneration = 0
+
+
+class _CacheEntry(object):
+    """A cached tournament: its state.EventState, the database snapshot it was
+    read from and, until the next change, its sorted standings.
+    """
+
+    __slots__ = ('event', 'snapshot', 'standings')
+
+    def __init__(self, event, snapshot):
+        self.event = event
+        self.snapshot = snapshot
+        self.standings = None
+
+    def includes(self, txid):
+        """Returns True if the changes of transaction txid, which has
+        committed, were read into the entry already.
+        """
+        xmin, xmax, running = self.snapshot
+        return txid < xmin or (txid < xmax and txid not in running)
+
+
+def _parseSnapshot(text):
+    """Returns a txid_snapshot as (xmin, xmax, set of running txids)."""
+    xmin, xmax, running = text.split(':')
+    return (int(xmin), int(xmax),
+            frozenset(int(txid) for txid in running.split(',') if txid))
+
+
+def configurePool(dsn=None, minconn=None, maxconn=None, **kwargs):
+    """Replaces the shared connection pool, e.g. to change its size.
+
+    Arguments that are not given keep their current value.  Any extra keyword
+    arguments (timeout, check_after, ...) are passed on to
+    pool.ConnectionPool.  Idle connections of the old pool are closed.
+
+    A cursor_factory should subclass _instrument.cursorFactory, which is used
+    by default, or the statements will not show in queryStats().
+    """
+    global _pool
+    old = _pool
+    kwargs.setdefault('cursor_factory', _instrument.cursorFactory)
+    _pool = pool.ConnectionPool(dsn or old.dsn,
+                                minconn=old.minconn if minconn is None else minconn,
+                                maxconn=old.maxconn if maxconn is None else maxconn,
+                                **kwargs)
+    old.closeall()
+
+
+def poolStats():
+    """Returns the shared pool's counters, see pool.ConnectionPool.stats()."""
+    return _pool.stats()
 
 
 def connect():
-    """Connect to the PostgreSQL database.  Returns a database connection."""
-    return psycopg2.connect("dbname=tournament")
+    """Connect to the PostgreSQL database.  Returns a database connection.
 
+    The connection is checked out of the shared pool; calling close() on it
+    returns it to the pool.
+    """
+    started = time.time()
+    conn = _pool.getconn()
+    _instrument.acquired(time.time() - started)
+    return conn
+
+
+@contextmanager
+def transaction():
+    """Context manager yielding a cursor on a pooled connection.
+
+    The work done in the block is committed when it exits normally and rolled
+    back if it raises.
+    """
+    with connect() as conn:
+        c = conn.cursor()
+        try:
+            yield c
+        finally:
+            c.close()
+
+
+def queryStats():
+    """Returns the database work done by each function of this module so far,
+    see instrument.Instrument.stats().
+    """
+    return _instrument.stats()
+
+
+def lastQueryStats():
+    """Returns the statements, rows, database time and connection wait of the
+    last call this thread made to this module, as a dictionary.
+    """
+    return _instrument.lastCall()
 
-def deleteMatches(registration=None):
-    """Remove all the match records FROM the database."""
 
-    conn = connect()
-    c = conn.cursor()
+def resetQueryStats():
+    """Clears the totals returned by queryStats()."""
+    _instrument.reset()
 
+
+def cacheStats():
+    """Returns a snapshot of the standings cache's counters as a dictionary.
+
+    hits: standings served from the cache without any work
+    misses: tournaments read from the database into the cache
+    refreshes: standings re-sorted from memory after a change
+    updates: changes applied to a cached tournament in place
+    invalidations: cached tournaments dropped
+    """
+    with _cacheLock:
+        return dict(_cacheStats)
+
+
+def invalidateStandings(registration=None):
+    """Drops the cached standings of one tournament, or of every tournament if
+    registration is not given.
+    """
+    global _cacheGeneration
+    with _cacheLock:
+        _cacheGeneration += 1
+        if registration==None:
+            _cacheStats['invalidations'] += len(_cache)
+            _cache.clear()
+        elif _cache.pop(registration, None) is not None:
+            _cacheStats['invalidations'] += 1
+
+
+def _eventLock(registration):
+    """Returns the lock held while using a tournament's cache entry."""
+    with _cacheLock:
+        lock = _eventLocks.get(registration)
+        if lock is None:
+            lock = _eventLocks[registration] = threading.RLock()
+        return lock
+
+
+def _countCache(counter):
+    with _cacheLock:
+        _cacheStats[counter] += 1
+
+
+def _cachedEntry(registration):
+    """Returns the cache entry of a tournament, reading it from the database
+    if it is not cached yet.  Must be called holding _eventLock(registration).
+    """
+    with _cacheLock:
+        entry = _cache.get(registration)
+        generation = _cacheGeneration
+        if entry is None:
+            _cacheStats['misses'] += 1
+    if entry is None:
+        with transaction() as c:
+            c.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;')
+            entry = _CacheEntry(*_readEvent(c, registration))
+        with _cacheLock:
+            # Otherwise the tables may have changed since they were read
+            if generation == _cacheGeneration:
+                _cache[registration] = entry
+    return entry
+
+
+def _updateCache(registration, txid, update):
+    """Applies update(event) to a cached tournament, if it is cached, for a
+    change committed by transaction txid.
+
+    A change is only applied once it has committed, so the tournament may
+    have been read into the cache after it committed; the update is skipped
+    then, as the change was read with the rest.  If the update does not fit
+    the cached state, e.g. because the tables were changed by another
+    process, the tournament is dropped from the cache.
+    """
+    with _eventLock(registration):
+        with _cacheLock:
+            entry = _cache.get(registration)
+        if entry is None or entry.includes(txid):
+            return
+        try:
+            update(entry.event)
+        except (AssertionError, KeyError):
+            invalidateStandings(registration)
+            return
+        entry.standings = None
+        _countCache('updates')
+
+
+def _event(registration):
+    """Returns the registration to work on, CURRENT unless one is given."""
     if registration==None:
-        query = 'DELETE FROM matches *;'
-        c.execute(query)
-    else:
-        query = 'DELETE FROM matches * WHERE registration=%s'
-        c.execute(query, [registration,])
+        return CURRENT
+    return registration
+
+
+def _lockEvent(c, registration):
+    """Takes a transaction-level advisory lock on a tournament.
+
+    Changes to the same tournament that must not interleave take this lock;
+    changes to different tournaments take different locks and never wait for
+    each other.
+    """
+    c.execute('SELECT pg_advisory_xact_lock(hashtext(%s));', [registration,])
+
+
+def _shareEvent(c, registration):
+    """Takes the shared form of a tournament's advisory lock.
+
+    Reports take this lock, so any number of them run at the same time, but
+    not while the tournament is deleted, completed or paired by startRound().
+    """
+    c.execute('SELECT pg_advisory_xact_lock_shared(hashtext(%s));',
+              [registration,])
+
+
+def _notify(c, *registrations):
+    """Announces changes to the tournaments on NOTIFY_CHANNEL, once the
+    transaction of cursor c commits.
+
+    Returns:
+      The id of the transaction, to pass to _updateCache().
+    """
+    query = 'SELECT txid_current(), count(pg_notify(%s, registration)) \
+                FROM unnest(%s::text[]) AS registration;'
+    c.execute(query, [NOTIFY_CHANNEL, list(registrations)])
+    return c.fetchone()[0]
+
+
+def _lockAll(c):
+    """Takes the lock of every tournament with players, in the order of
+    completeTournament(), and returns their registrations.
+    """
+    c.execute('SELECT DISTINCT registration FROM players;')
+    registrations = sorted(row[0] for row in c.fetchall())
+    for registration in registrations:
+        _lockEvent(c, registration)
+    return registrations
+
+
+def _report(work):
+    """Runs work(c) in a transaction and returns its result, starting over if
+    PostgreSQL aborts the transaction to break a deadlock.
+    """
+    for attempt in range(REPORT_ATTEMPTS):
+        try:
+            with transaction() as c:
+                return work(c)
+        except psycopg2.extensions.TransactionRollbackError:
+            if attempt == REPORT_ATTEMPTS - 1:
+                raise
 
-    conn.commit()
-    conn.close()
 
+def _recordResults(c, results, registration):
+    """Adds results, already inserted into matches, to the players' records.
 
+    Args:
+      c: a cursor in the reporting transaction
+      results: (winner, loser, draw, bye) tuples
+      registration: the tournament every player must be registered for
+
+    Returns:
+      The id of the reporting transaction, see _notify().
+    """
+    # Per player record increments: [wins, losses, draws, points, bye]
+    totals = {}
+    for winner, loser, draw, bye in results:
+        if bye:
+            totals.setdefault(winner, [0, 0, 0, 0, False])
+            totals[winner][0] += 1
+            totals[winner][3] += 2
+            totals[winner][4] = True
+        elif draw:
+            for player in (winner, loser):
+                totals.setdefault(player, [0, 0, 0, 0, False])
+                totals[player][2] += 1
+                totals[player][3] += 1
+        else:
+            totals.setdefault(winner, [0, 0, 0, 0, False])
+            totals.setdefault(loser, [0, 0, 0, 0, False])
+            totals[winner][0] += 1
+            totals[winner][3] += 2
+            totals[loser][1] += 1
+
+    # Also brings the OMW of the players who have defeated any of these
+    # players up to date, see tournament.sql
+    ids = sorted(totals)
+    query = 'SELECT record_results(%s, %s, %s, %s, %s, %s);'
+    c.execute(query, [ids] + [[totals[id][i] for id in ids]
+                              for i in range(5)])
+    assert [row[0] for row in c.fetchall()] == [registration] * len(ids), "Players must be registered for the tournament they play in"
+    return _notify(c, registration)
+
+
+@_instrument.call
+def deleteMatches(registration=None):
+    """Remove all the match records FROM the database.
+
+    If registration is specified, only the matches of that tournament are
+    removed.  The players' records are reset to no matches played, and the
+    rounds started with startRound() are removed along with their pairings.
+    """
+
+    reset = 'UPDATE player_totals \
+                SET wins=0, losses=0, draws=0, points=0, bye=FALSE, omw=0'
+    with transaction() as c:
+        if registration==None:
+            _notify(c, *_lockAll(c))
+            query = 'DELETE FROM matches *;'
+            c.execute(query)
+            c.execute(reset + ';')
+            c.execute('DELETE FROM rounds *;')
+        else:
+            _lockEvent(c, registration)
+            query = 'DELETE FROM matches * WHERE registration=%s'
+            c.execute(query, [registration,])
+            c.execute(reset + ' WHERE registration=%s;', [registration,])
+            query = 'DELETE FROM rounds * WHERE registration=%s;'
+            c.execute(query, [registration,])
+            _notify(c, registration)
+    invalidateStandings(registration)
+
+
+@_instrument.call
 def deletePlayers(registration=None):
     """By default, this removes all the player records FROM the database.
     If registration is specified, player records pertaining to a particular
     tournament will be removed instead
     """
 
-    conn = connect()
-    c = conn.cursor()
-
-    if registration==None:
-        query = 'DELETE FROM players *;'
-        c.execute(query)
-    else:
-        query = 'DELETE FROM players * WHERE registration=%s'
-        c.execute(query, [registration,])
-
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        if registration==None:
+            _notify(c, *_lockAll(c))
+            c.execute('DELETE FROM rounds *;')
+            query = 'DELETE FROM players *;'
+            c.execute(query)
+        else:
+            _lockEvent(c, registration)
+            query = 'DELETE FROM rounds * WHERE registration=%s;'
+            c.execute(query, [registration,])
+            query = 'DELETE FROM players * WHERE registration=%s'
+            c.execute(query, [registration,])
+            _notify(c, registration)
+    invalidateStandings(registration)
 
 
+@_instrument.call
 def countPlayers(registration=None):
     """Returns the number of players currently registered.
     If registration is specified, returns the number of players registered for
     that particular tournament
     """
 
-    conn = connect()
-    c = conn.cursor()
-
-    query = 'SELECT COUNT(id) FROM players WHERE registration=%s;'
-    if registration==None:
-        c.execute(query, ['current',])
-    else:
-        c.execute(query, [registration,])
-    numPlayers = c.fetchone()[0]
-    conn.close()
+    with transaction() as c:
+        query = 'SELECT COUNT(id) FROM players WHERE registration=%s;'
+        c.execute(query, [_event(registration),])
+        numPlayers = c.fetchone()[0]
 
     # print(numPlayers[0])
     return numPlayers
 
 
-def registerPlayer(name):
+@_instrument.call
+def registerPlayer(name, registration=None):
     """Adds a player to the tournament database.
   
     The database assigns a unique serial id number for the player.  (This
@@ -77,19 +444,105 @@ def registerPlayer(name):
   
     Args:
       name: the player's full name (need not be unique).
+      registration: the tournament to register for, the current one by
+        default.
+
+    Returns:
+      The new player's id.
+    """
+    registration = _event(registration)
+    with transaction() as c:
+        query = 'WITH player AS ( \
+                        INSERT into players(name, registration) VALUES (%s, %s) \
+                        RETURNING id, registration) \
+                    INSERT into player_totals(id, registration) \
+                        SELECT id, registration FROM player \
+                    RETURNING id;'
+        c.execute(query, [name, registration])
+        id = c.fetchone()[0]
+        txid = _notify(c, registration)
+    _updateCache(registration, txid, lambda event: event.addPlayer(id, name))
+    return id
+
+
+@_instrument.call
+def registerPlayers(names, registration=None):
+    """Adds many players to the tournament database at once.
+
+    Ids for all of the players are reserved from the players' serial sequence
+    up front, the players are then loaded with a single COPY and their empty
+    records created with a single INSERT, so this costs four statements, with
+    the notification of the change, however many players there are.
+
+    Args:
+      names: an iterable of the players' full names.
+      registration: the tournament to register for, the current one by
+        default.
+
+    Returns:
+      A list of the ids assigned to the players, in the same order as names.
     """
-    conn = connect()
-    c = conn.cursor()
+    registration = _event(registration)
+    names = list(names)
+    if not names:
+        return []
+
+    with transaction() as c:
+        query = "SELECT nextval('players_id_seq') FROM generate_series(1, %s);"
+        c.execute(query, [len(names),])
+        ids = sorted(row[0] for row in c.fetchall())
+
+        # Strings are quoted so that an empty name is not loaded as NULL
+        data = StringIO()
+        writer = csv.writer(data, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerows((id, name, registration)
+                         for id, name in zip(ids, names))
+        data.seek(0)
+        query = 'COPY players (id, name, registration) FROM STDIN WITH CSV'
+        c.copy_expert(query, data)
+        query = 'INSERT into player_totals (id, registration) \
+                    SELECT unnest(%s), %s;'
+        c.execute(query, [ids, registration])
+        txid = _notify(c, registration)
 
-    query = 'INSERT into players(name) VALUES (%s);'    
-    c.execute(query, [name])
-    conn.commit()
-    conn.close()
+    def update(event):
+        for id, name in zip(ids, names):
+            event.addPlayer(id, name)
+    _updateCache(registration, txid, update)
+    return ids
+
+
+@_instrument.call
+def importPlayers(csvfile, column=0, header=False, registration=None):
+    """Registers every player listed in a CSV file, see registerPlayers().
+
+    Args:
+      csvfile: a file or any other iterable of CSV lines
+      column: the index of the column holding the names, or the name of that
+        column in the header row
+      header: true if the first row is a header; implied when column is a name
+      registration: the tournament to register for, the current one by
+        default.
+
+    Returns:
+      A list of the ids assigned to the players, in the same order as the rows.
+    """
+    reader = csv.reader(csvfile)
+    if header or not isinstance(column, int):
+        headings = next(reader, [])
+        if not isinstance(column, int):
+            column = headings.index(column)
+    return registerPlayers((row[column] for row in reader if row),
+                           registration)
 
 
-def playerStandings():
+@_instrument.call
+def playerStandings(registration=None):
     """Returns a list of the players and their win records, sorted by points.
 
+    The standings are those of the tournament given by registration, the
+    current one by default.
+
     The first entry in the list should be the player in first place, or a player
     tied for first place if there is currently a tie.
 
@@ -109,51 +562,86 @@ def playerStandings():
     1. Award 2 points for a win, 1 point for a draw, 0 points for a loss
     2. Group players with the same overall points together
     3. Rank them again, for groups with more than 1 player, calculate the OMW
+       or each of the other tiebreaks configured in tiebreaks.CHAIN in turn
     """
 
-    conn = connect()
-    c = conn.cursor()
+    registration = _event(registration)
+    if not CACHE_STANDINGS:
+        # The standings view holds points, matches, bye and OMW for every
+        # player, read in one query.
+        chain = tiebreaks.CHAIN
+        with transaction() as c:
+            if chain != ('omw',):
+                c.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;')
+            query = 'SELECT id, name, points, matches, bye, omw \
+                        FROM standings \
+                        WHERE registration=%s \
+                        ORDER BY points, omw, id;'
+            c.execute(query, [registration,])
+            standings = c.fetchall()
+            if chain == ('omw',):
+                return standings
+            # The other tiebreaks are computed from the matches
+            query = 'SELECT winner, loser, draw, bye \
+                        FROM matches WHERE registration=%s;'
+            c.execute(query, [registration,])
+            matches = c.fetchall()
+        return tiebreaks.sortStandings(standings, matches, chain)
 
-    query = 'SELECT * from standings'
-    c.execute(query)
-    
-    # Players are grouped by the total points they have earned so far
-    standings = c.fetchall()
-    values = set(map(lambda x:x[2], standings))
-    groupByPoints = [[y for y in standings if y[2]==x] for x in values]
-
-    standings = []
-    for group in groupByPoints:
-        groupSorted = []
-        # print("group is %s") % group
-        for player in group:
-            query = 'SELECT sum(players.points) \
-                        FROM players, matches \
-                        WHERE players.id=matches.loser \
-                            AND matches.winner=%s \
-                            AND matches.draw=FALSE \
-                            AND matches.bye=FALSE'
-            c.execute(query, [player[0],])
-            points = c.fetchone()[0]
-            if points == None:
-                points = long(0)
-            modPlayer = (player[0], player[1], player[2], player[3], player[4],
-                         points)
-            groupSorted.append(modPlayer)
-
-        # print("Before sorting, group is %s") % groupSorted
-        groupSorted.sort(key=lambda tup: tup[5])
-        # print("After sorting, group is %s") % groupSorted
-        standings.extend(groupSorted)
-
-    conn.close()
-
-    # print("standings are %s") % standings
-    return standings
-
-
-
-def reportMatch(winner, loser, draw=False, bye=False):
+    with _eventLock(registration):
+        entry = _cachedEntry(registration)
+        if entry.standings is None:
+            _countCache('refreshes')
+            entry.standings = entry.event.standings()
+        else:
+            _countCache('hits')
+        return list(entry.standings)
+
+
+
+@_instrument.call
+def loadEvent(registration=None):
+    """Reads a tournament into memory, the current one by default.
+
+    Returns:
+      A state.EventState holding every player's record and the match history,
+      read from a single consistent snapshot of the database.
+    """
+    registration = _event(registration)
+    with transaction() as c:
+        c.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;')
+        return _readEvent(c, registration)[0]
+
+
+def _readEvent(c, registration):
+    """Reads a tournament through cursor c.
+
+    Both queries must see the same state of the tournament, so c must be in a
+    REPEATABLE READ transaction, or hold the tournament's lock, _lockEvent():
+    every change to its players and matches takes that lock, except new
+    registrations, which are consistent whether they are read or not.
+
+    Returns:
+      The tournament's state.EventState and the snapshot it was read from,
+      see _CacheEntry; the snapshot is only that of the first query unless
+      c is in a REPEATABLE READ transaction.
+    """
+    c.execute('SELECT txid_current_snapshot();')
+    snapshot = _parseSnapshot(c.fetchone()[0])
+    query = 'SELECT id, name, wins, losses, draws, points, player_totals.bye \
+                FROM player_totals JOIN players USING (id) \
+                WHERE player_totals.registration=%s;'
+    c.execute(query, [registration,])
+    players = c.fetchall()
+    query = 'SELECT winner, loser, draw, bye \
+                FROM matches WHERE registration=%s;'
+    c.execute(query, [registration,])
+    matches = c.fetchall()
+    return state.EventState.fromRows(players, matches), snapshot
+
+
+@_instrument.call
+def reportMatch(winner, loser, draw=False, bye=False, registration=None):
     """Records the outcome of a single match between two players.
 
     Args:
@@ -161,57 +649,85 @@ def reportMatch(winner, loser, draw=False, bye=False):
       loser:  the id number of the player who lost
       bye: if bye is true, player id=winner=loser
       draw: if draw is true, 'winner' and 'loser' actually got a draw
+      registration: the tournament both players are registered for, the
+        current one by default
+    """
+
+    reportRound([(winner, loser, draw, bye)], registration)
+
+
+@_instrument.call
+def reportRound(results, registration=None):
+    """Records the outcomes of a whole round of matches in one transaction.
+
+    The results are checked against the same rules as reportMatch() before
+    anything is written; if any of them is invalid, none of them is recorded.
+    All matches are then inserted with a single statement, and every player's
+    record, along with the OMW of every player who has defeated one of them,
+    is updated with a single statement.  A second bye for a player is
+    rejected by the database even when it is reported at the same time.
+
+    Args:
+      results: an iterable of (winner, loser, draw, bye) tuples, with the same
+      meaning as the arguments of reportMatch().  draw and bye may be left out
+      and default to False.
+      registration: the tournament the players are registered for, the
+        current one by default
+
+    Reports for the same tournament run at the same time, only waiting for
+    each other while they update the records of the same players.
     """
 
-    conn = connect()
-    c = conn.cursor()
-
-    if bye == True:
-        assert winner == loser, "Only one player can receive a bye in a single match"
-        assert draw == False, "There can't be a bye and a draw in the same match"
-        query = 'SELECT bye FROM players where id=%s;'
-        c.execute(query, [winner,])
-        assert c.fetchone()[0] == False, "Each player can only receive one bye in one tournament"
-        query = 'INSERT into matches (winner, bye) VALUES (%s, TRUE);'
-        c.execute(query, [winner,])
-        query = 'UPDATE players \
-                    SET wins=wins+1, points=points+2, bye=TRUE \
-                    WHERE id=%s;'
-        c.execute(query, [winner,])
-
-    elif draw == True:
-        assert winner != loser, "Two distinct players are required for a draw"
-        query = 'INSERT into matches VALUES (%s, %s, TRUE);'
-        c.execute(query, [winner, loser])
-        query = 'UPDATE players \
-                    SET draws=draws+1, points=points+1 \
-                    WHERE id=%s OR id=%s;'
-        c.execute(query, [winner, loser])
-
-    else:
-        assert winner != loser, "Two distinct players are required for a normal match"
-        query = 'INSERT into matches VALUES (%s, %s);'
-        c.execute(query, [winner, loser])
-        query = 'UPDATE players \
-                    SET wins=wins+1, points=points+2 \
-                    WHERE id=%s;'
-        c.execute(query, [winner,])
-        query = 'UPDATE players \
-                    SET losses=losses+1 \
-                    WHERE id=%s;'
-        c.execute(query, [loser,])
-
-    conn.commit()
-    conn.close()
+    reported = []
+    matches = []
+    byes = set()
+    for result in results:
+        winner, loser, draw, bye = (tuple(result) + (False, False))[:4]
+        state.checkResult(winner, loser, draw, bye)
+        reported.append((winner, loser, draw, bye))
+        if bye:
+            assert winner not in byes, "Each player can only receive one bye in one tournament"
+            byes.add(winner)
+            matches.append((winner, None, False, True))
+        else:
+            matches.append((winner, loser, bool(draw), False))
+
+    if not matches:
+        return
+
+    registration = _event(registration)
+
+    def report(c):
+        _shareEvent(c, registration)
+        query = 'INSERT into matches (winner, loser, draw, bye, registration) \
+                    VALUES %s;'
+        values = ','.join(c.mogrify('(%s, %s, %s, %s, %s)',
+                                    match + (registration,))
+                          for match in matches)
+        try:
+            c.execute(query % values)
+        except psycopg2.IntegrityError as e:
+            # Only matches_bye_idx can be violated here
+            if e.pgcode != psycopg2.errorcodes.UNIQUE_VIOLATION:
+                raise
+            raise AssertionError("Each player can only receive one bye in one tournament")
+        return _recordResults(c, matches, registration)
+    txid = _report(report)
+
+    _updateCache(registration, txid,
+                 lambda event: event.reportRound(reported))
  
  
-def swissPairings():
+@_instrument.call
+def swissPairings(registration=None):
     """Returns a list of pairs of players for the next round of a match.
   
     Assuming that there are an even number of players registered, each player
     appears exactly once in the pairings.  Each player is paired with another
     player with an equal or nearly-equal win record, that is, a player adjacent
-    to him or her in the standings.
+    to him or her in the standings.  Players are not paired with an opponent
+    they have already played unless that cannot be avoided; see
+    pairing.pairPlayers().
   
     Returns:
       A list of tuples, each of which contains (id1, name1, id2, name2)
@@ -224,44 +740,339 @@ def swissPairings():
     If there are an odd number of players in a given round, award a bye to the
     lowest-ranked player without a bye.
     To award a bye, simply set id1=id2 and name1=name2
+
+    The players paired are those of the tournament given by registration, the
+    current one by default.
     """
 
-    standings = playerStandings()
-    pairings = []
-
-    # Determine if there's odd number of players; if there is, find someone to
-    # give a bye to
-    if len(standings)%2 != 0:
-        for i in range(len(standings)):
-            player = standings[i]
-            if player[4] == False:
-                pairings.append((player[0], player[1], player[0], player[1]))
-                standings.pop(i)
-                break
-    
-    # At this point there must be an even number of players left
-    # Simply pair them as per usual
-    i = 0
-    while i < len(standings):
-        pairings.append((standings[i][0], standings[i][1],
-                         standings[i+1][0], standings[i+1][1]));
-        i += 2
-    
-    # print "pairings are %s" % pairings
-    return pairings
- 
-def completeTournament(tournyName):
+    registration = _event(registration)
+    standings = playerStandings(registration)
+    if CACHE_STANDINGS:
+        with _eventLock(registration):
+            played = _cachedEntry(registration).event.played
+            return pairing.pairPlayers(standings, played)
+
+    with transaction() as c:
+        query = 'SELECT winner, loser FROM matches \
+                    WHERE registration=%s AND bye=FALSE;'
+        c.execute(query, [registration,])
+        played = pairing.playedOpponents(c.fetchall())
+
+    return pairing.pairPlayers(standings, played)
+
+@_instrument.call
+def startRound(registration=None):
+    """Pairs the next round and records its pairings.
+
+    The pairings are those of swissPairings(), stored as the tournament's
+    next round, so that each result can be reported against its pairing with
+    reportPairing().  Every pairing of the previous rounds must have been
+    reported first.  The tournament is read and paired on the connection
+    that records the round, while it is locked, so no report is missed.
+
+    Returns:
+      A list of tuples, each of which contains (pairing, id1, name1, id2,
+      name2): pairing is the pairing's unique id, the other fields are as
+      described in swissPairings().
+    """
+
+    registration = _event(registration)
+    with transaction() as c:
+        # No report can run until the round is recorded
+        _lockEvent(c, registration)
+        query = 'SELECT count(*) FROM pairings \
+                    JOIN rounds ON rounds.id=pairings.round \
+                    WHERE rounds.registration=%s AND NOT pairings.reported;'
+        c.execute(query, [registration,])
+        assert c.fetchone()[0] == 0, "Every pairing of the previous round must be reported first"
+
+        # Read on this connection: swissPairings() would take a second one
+        # from the pool while this one holds the lock.  The lock also keeps
+        # the tournament from changing between the reads, which REPEATABLE
+        # READ could not do here: its snapshot would be taken before the
+        # wait for the lock.
+        pairings = _readEvent(c, registration)[0].swissPairings()
+        query = 'WITH round AS ( \
+                        INSERT into rounds (registration, number) \
+                            SELECT %s, COALESCE(max(number), 0) + 1 \
+                            FROM rounds WHERE registration=%s \
+                        RETURNING id) \
+                    INSERT into pairings (round, player1, player2) \
+                        SELECT round.id, unnest(%s), unnest(%s) FROM round \
+                    RETURNING player1, id;'
+        c.execute(query, [registration, registration,
+                          [pair[0] for pair in pairings],
+                          [pair[2] for pair in pairings]])
+        ids = dict(c.fetchall())
+    return [(ids[id1], id1, name1, id2, name2)
+            for (id1, name1, id2, name2) in pairings]
+
+
+@_instrument.call
+def pendingPairings(registration=None):
+    """Returns the pairings of a tournament that are yet to be reported, in
+    the same form as startRound().
+    """
+
+    registration = _event(registration)
+    with transaction() as c:
+        query = 'SELECT pairings.id, player1, one.name, player2, two.name \
+                    FROM pairings \
+                        JOIN rounds ON rounds.id=pairings.round \
+                        JOIN players AS one ON one.id=player1 \
+                        JOIN players AS two ON two.id=player2 \
+                    WHERE rounds.registration=%s AND NOT pairings.reported \
+                    ORDER BY pairings.id;'
+        c.execute(query, [registration,])
+        return c.fetchall()
+
+
+@_instrument.call
+def reportPairing(pairing, winner, draw=False, registration=None):
+    """Records the outcome of a match paired by startRound().
+
+    The pairing is marked as reported and the match recorded with a single
+    conditional statement, which only succeeds if the pairing belongs to the
+    tournament, includes the winner and has not been reported yet; so a
+    result reported twice, even at the same time, is only counted once.
+    Reports of different pairings run at the same time.
+
+    Args:
+      pairing: the pairing's id, as returned by startRound()
+      winner: the id number of the player who won; for a bye, the player who
+        received it
+      draw: if draw is true, the two players got a draw
+      registration: the tournament the pairing belongs to, the current one by
+        default
+    """
+
+    registration = _event(registration)
+
+    def report(c):
+        _shareEvent(c, registration)
+        query = 'WITH claimed AS ( \
+                        UPDATE pairings SET reported=TRUE \
+                        FROM rounds \
+                        WHERE pairings.id=%(pairing)s \
+                            AND NOT pairings.reported \
+                            AND rounds.id=pairings.round \
+                            AND rounds.registration=%(registration)s \
+                            AND %(winner)s IN (player1, player2) \
+                            AND NOT (%(draw)s AND player1=player2) \
+                        RETURNING pairings.id, player1, player2) \
+                    INSERT into matches \
+                            (winner, loser, draw, bye, registration, pairing) \
+                        SELECT %(winner)s, \
+                               CASE WHEN player1=player2 THEN NULL \
+                                    WHEN player1=%(winner)s THEN player2 \
+                                    ELSE player1 END, \
+                               %(draw)s, player1=player2, %(registration)s, id \
+                        FROM claimed \
+                    RETURNING winner, loser, draw, bye;'
+        try:
+            c.execute(query, {'pairing': pairing, 'winner': winner,
+                              'draw': bool(draw),
+                              'registration': registration})
+        except psycopg2.IntegrityError as e:
+            if e.pgcode != psycopg2.errorcodes.UNIQUE_VIOLATION:
+                raise
+            raise AssertionError("Each player can only receive one bye in one tournament")
+        match = c.fetchone()
+        assert match is not None, "Pairing %s of %s does not exist, does not include player %s or was already reported" % (pairing, registration, winner)
+        return match, _recordResults(c, [match], registration)
+    (winner, loser, draw, bye), txid = _report(report)
+
+    if bye:
+        loser = winner
+    _updateCache(registration, txid,
+                 lambda event: event.reportMatch(winner, loser, draw, bye))
+
+
+@_instrument.call
+def completeTournament(tournyName, registration=None, archive=False):
     """Updates database accordingly when a tournament has been completed, 
     setting the 'registration' field of each player to tournyName
+
+    The tournament completed is the one given by registration, the current
+    one by default.
+
+    If archive is true, the tournament is instead moved out of the live tables
+    into the archive, under the name tournyName, which must not have been
+    archived before: its final standings and its matches are copied to the
+    archive tables and deleted from the live ones in a single transaction.
+    Archived tournaments are read with pastStandings(), headToHead() and
+    playerHistory(), and no longer slow down the live queries.
     """
 
-    conn = connect()
-    c = conn.cursor()
+    registration = _event(registration)
+    with transaction() as c:
+        for name in sorted([registration, tournyName]):
+            _lockEvent(c, name)
+        if archive:
+            _archive(c, tournyName, registration)
+        else:
+            query = 'UPDATE matches SET registration=%s WHERE registration=%s;'
+            c.execute(query, [tournyName, registration])
+            query = 'UPDATE players SET registration=%s WHERE registration=%s;'
+            c.execute(query, [tournyName, registration])
+            query = 'UPDATE player_totals SET registration=%s WHERE registration=%s;'
+            c.execute(query, [tournyName, registration])
+            query = 'UPDATE rounds SET registration=%s WHERE registration=%s;'
+            c.execute(query, [tournyName, registration])
+        _notify(c, registration, tournyName)
+    invalidateStandings(registration)
+    invalidateStandings(tournyName)
+
+
+def _archive(c, tournyName, registration):
+    """Moves a tournament into the archive tables, see completeTournament().
+
+    Each table is moved with a single statement that deletes the rows and
+    inserts them into the archive, so the rows are only read once.
+    """
+    query = 'INSERT into archived_tournaments (name) \
+                SELECT %s WHERE NOT EXISTS ( \
+                    SELECT 1 FROM archived_tournaments WHERE name=%s);'
+    c.execute(query, [tournyName, tournyName])
+    assert c.rowcount == 1, "A tournament called %s has already been archived" % tournyName
+
+    # The places follow the tiebreaks of the live standings, so they are
+    # worked out from the standings and matches before they are moved
+    query = 'SELECT id, name, points, matches, bye, omw \
+                FROM standings WHERE registration=%s;'
+    c.execute(query, [registration,])
+    standings = c.fetchall()
+    matches = []
+    if tiebreaks.CHAIN != ('omw',):
+        query = 'SELECT winner, loser, draw, bye \
+                    FROM matches WHERE registration=%s;'
+        c.execute(query, [registration,])
+        matches = c.fetchall()
+    ranks = tiebreaks.places(standings, matches)
+
+    # The matches go first, as they refer to the players
+    query = 'WITH moved AS ( \
+                    DELETE FROM matches WHERE registration=%s \
+                    RETURNING winner, loser, draw, bye) \
+                INSERT into archived_matches (tournament, winner, loser, draw, bye) \
+                    SELECT %s, winner, loser, draw, bye FROM moved;'
+    c.execute(query, [registration, tournyName])
+    query = 'DELETE FROM rounds WHERE registration=%s;'
+    c.execute(query, [registration,])
+
+    query = 'WITH totals AS ( \
+                    DELETE FROM player_totals WHERE registration=%s \
+                    RETURNING *), \
+                player AS ( \
+                    DELETE FROM players WHERE registration=%s \
+                    RETURNING id, name), \
+                ranked AS ( \
+                    SELECT unnest(%s::int[]) AS id, unnest(%s::int[]) AS place) \
+                INSERT into archived_standings \
+                        (tournament, id, name, points, matches, bye, omw, place) \
+                    SELECT %s, id, name, points, wins+losses+draws, bye, omw, place \
+                    FROM totals JOIN player USING (id) JOIN ranked USING (id);'
+    ids = sorted(ranks)
+    c.execute(query, [registration, registration, ids,
+                      [ranks[id] for id in ids], tournyName])
+
+
+@_instrument.call
+def deleteArchived(tournyName=None):
+    """Removes an archived tournament FROM the database, or every archived
+    tournament if tournyName is not given.
+    """
+
+    with transaction() as c:
+        if tournyName==None:
+            query = 'DELETE FROM archived_tournaments *;'
+            c.execute(query)
+        else:
+            query = 'DELETE FROM archived_tournaments * WHERE name=%s;'
+            c.execute(query, [tournyName,])
+
+
+@_instrument.call
+def archivedTournaments():
+    """Returns the archived tournaments as a list of (name, completed) tuples,
+    the most recently completed first.
+    """
+
+    with transaction() as c:
+        query = 'SELECT name, completed FROM archived_tournaments \
+                    ORDER BY completed DESC, name;'
+        c.execute(query)
+        return c.fetchall()
+
+
+@_instrument.call
+def pastStandings(tournyName):
+    """Returns the final standings of an archived tournament, in the same form
+    and order as playerStandings(); empty if no such tournament was archived.
+    """
+
+    with transaction() as c:
+        query = 'SELECT id, name, points, matches, bye, omw \
+                    FROM archived_standings \
+                    WHERE tournament=%s \
+                    ORDER BY place DESC, id;'
+        c.execute(query, [tournyName,])
+        return c.fetchall()
+
+
+@_instrument.call
+def headToHead(name1, name2):
+    """Returns the record of one player against another in every archived
+    tournament in which they met.
+
+    Players are matched by name, as a player registered for several
+    tournaments has a different id in each.
+
+    Returns:
+      A list of (tournament, wins, losses, draws) tuples from the first
+      player's point of view, the earliest tournament first.
+    """
+
+    with transaction() as c:
+        query = 'SELECT one.tournament, \
+                        sum(CASE WHEN NOT draw AND winner=one.id THEN 1 ELSE 0 END), \
+                        sum(CASE WHEN NOT draw AND winner=two.id THEN 1 ELSE 0 END), \
+                        sum(CASE WHEN draw THEN 1 ELSE 0 END) \
+                    FROM archived_standings AS one \
+                        JOIN archived_standings AS two \
+                            ON two.tournament=one.tournament \
+                        JOIN archived_matches \
+                            ON (winner=one.id AND loser=two.id) \
+                            OR (winner=two.id AND loser=one.id) \
+                        JOIN archived_tournaments \
+                            ON archived_tournaments.name=one.tournament \
+                    WHERE one.name=%s AND two.name=%s \
+                    GROUP BY one.tournament, completed \
+                    ORDER BY completed, one.tournament;'
+        c.execute(query, [name1, name2])
+        return [(tournament, int(wins), int(losses), int(draws))
+                for tournament, wins, losses, draws in c.fetchall()]
+
+
+@_instrument.call
+def playerHistory(name):
+    """Returns how a player finished in every archived tournament.
+
+    Returns:
+      A list of tuples, the earliest tournament first, each of which contains
+        (tournament, id, points, matches, bye, OMW, place):
+        tournament: the name the tournament was archived under
+        id: the player's id in that tournament
+        points, matches, bye, OMW: the final record, as in playerStandings()
+        place: the final place, 1 for the winner; tied players share a place
+    """
 
-    query = 'UPDATE matches SET registration=%s WHERE registration=%s;'
-    c.execute(query, [tournyName, 'current'])
-    query = 'UPDATE players SET registration=%s WHERE registration=%s;'
-    c.execute(query, [tournyName, 'current'])
-    
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    with transaction() as c:
+        query = 'SELECT tournament, id, points, matches, bye, omw, place \
+                    FROM archived_standings \
+                        JOIN archived_tournaments \
+                            ON archived_tournaments.name=tournament \
+                    WHERE archived_standings.name=%s \
+                    ORDER BY completed, tournament;'
+        c.execute(query, [name,])
+        return c.fetchall()
@@ -13,30 +13,199 @@ CREATE DATABASE tournament;
 CREATE TABLE players (
     id serial NOT NULL,
     name varchar(50) NOT NULL,
-    wins int DEFAULT 0,
-    losses int DEFAULT 0,
-    draws int DEFAULT 0,
-    points int DEFAULT 0,
-    bye boolean DEFAULT FALSE,
-    registration varchar(30) DEFAULT 'current',
+    registration varchar(30) NOT NULL DEFAULT 'current',
+    PRIMARY KEY(id)
+);
+
+-- Every query on players is scoped to one tournament
+CREATE INDEX players_registration_idx ON players (registration);
+
+-- Every player's record in his or her tournament, with the OMW tiebreak
+-- precomputed, so that reading the standings neither aggregates the matches
+-- nor rewrites the players table.  reportRound() brings the records of the
+-- players in a round, and the OMW of the players who defeated them, up to
+-- date as it records the round.  omw (opponent match wins) is the sum of the
+-- points of every opponent a player has defeated, draws and byes excluded.
+CREATE TABLE player_totals (
+    id int NOT NULL REFERENCES players (id) ON DELETE CASCADE,
+    registration varchar(30) NOT NULL,
+    wins int NOT NULL DEFAULT 0,
+    losses int NOT NULL DEFAULT 0,
+    draws int NOT NULL DEFAULT 0,
+    points int NOT NULL DEFAULT 0,
+    bye boolean NOT NULL DEFAULT FALSE,
+    omw int NOT NULL DEFAULT 0,
+    PRIMARY KEY(id)
+);
+
+-- Standings are read in rank order, lowest ranked player first
+CREATE INDEX player_totals_standings_idx
+    ON player_totals (registration, points, omw, id);
+
+-- The rounds of each tournament started with startRound(), numbered from 1
+CREATE TABLE rounds (
+    id serial NOT NULL,
+    registration varchar(30) NOT NULL,
+    number int NOT NULL,
+    started timestamp NOT NULL DEFAULT now(),
+    PRIMARY KEY(id),
+    UNIQUE(registration, number)
+);
+
+-- The pairings of each round, as returned by swissPairings(); player1 and
+-- player2 are the same player for a bye.  reportPairing() sets reported as it
+-- records the result, so each pairing is reported exactly once.
+CREATE TABLE pairings (
+    id serial NOT NULL,
+    round int NOT NULL REFERENCES rounds (id) ON DELETE CASCADE,
+    player1 int NOT NULL,
+    player2 int NOT NULL,
+    reported boolean NOT NULL DEFAULT FALSE,
     PRIMARY KEY(id)
 );
 
+CREATE INDEX pairings_round_idx ON pairings (round);
+
 CREATE TABLE matches (
     winner int NOT NULL,
     loser int,
     draw boolean DEFAULT FALSE,
     bye boolean DEFAULT FALSE,
-    registration varchar(30) DEFAULT 'current',
+    registration varchar(30) NOT NULL DEFAULT 'current',
+    pairing int,
+    -- The transaction that reported the match, for incremental exports
+    txid bigint NOT NULL DEFAULT txid_current(),
     FOREIGN KEY(winner) REFERENCES players (id),
     FOREIGN KEY(loser) REFERENCES players (id),
+    FOREIGN KEY(pairing) REFERENCES pairings (id),
     CHECK ((loser != winner AND loser > 0 AND winner > 0) OR loser = -1)
 );
 
+-- A pairing has at most one result, and a player at most one bye, however
+-- many reports are made at the same time
+CREATE UNIQUE INDEX matches_pairing_idx ON matches (pairing);
+CREATE UNIQUE INDEX matches_bye_idx ON matches (winner) WHERE bye;
+
+-- Matches are read per tournament and looked up by either player, which also
+-- keeps the foreign key checks on deleting players from scanning the table
+CREATE INDEX matches_registration_winner_idx ON matches (registration, winner);
+CREATE INDEX matches_winner_idx ON matches (winner);
+CREATE INDEX matches_loser_idx ON matches (loser);
+
+-- Incremental exports read the matches reported after a given snapshot, see
+-- export.py
+CREATE INDEX matches_registration_txid_idx ON matches (registration, txid);
+
+-- Adds the results of a round, already inserted into matches, to the
+-- records of the players in it: ids[i] won won[i], lost lost[i] and drew
+-- drawn[i] matches for scored[i] points, and received a bye if byes[i].  The
+-- omw of every player who has defeated one of them is summed again with their
+-- new points, in the same statement, so each record is written only once.
+-- The function is planned once per connection, not on every report.  Returns
+-- the registration of each of the players, which the caller checks.
+--
+-- Reports of the same tournament may run at the same time.  The records
+-- written here are locked first: the players' own, in id order, and then
+-- those of the players who defeated them, in id order.  Any report that
+-- changes the points of a player a record's OMW sums locks that record
+-- first, so the sums below are taken from a snapshot no other report can
+-- change until this one commits.  Reports that lock each other's records in
+-- the opposite order deadlock; the one PostgreSQL aborts may be retried.
+CREATE FUNCTION record_results(ids int[], won int[], lost int[], drawn int[],
+                               scored int[], byes boolean[])
+RETURNS SETOF varchar AS $$
+BEGIN
+    PERFORM 1 FROM player_totals WHERE id = ANY(ids) ORDER BY id FOR UPDATE;
+    PERFORM 1 FROM player_totals
+        WHERE id IN (SELECT winner FROM matches
+                     WHERE loser = ANY(ids) AND draw = FALSE AND bye = FALSE)
+        ORDER BY id FOR UPDATE;
+
+    RETURN QUERY
+    WITH results AS (
+        SELECT unnest(ids) AS id, unnest(won) AS wins, unnest(lost) AS losses,
+               unnest(drawn) AS draws, unnest(scored) AS points,
+               unnest(byes) AS bye
+    ), omw AS (
+        SELECT matches.winner AS id,
+               sum(defeated.points + COALESCE(results.points, 0)) AS omw
+        FROM matches
+            JOIN player_totals AS defeated ON defeated.id = matches.loser
+            LEFT JOIN results ON results.id = matches.loser
+        WHERE matches.winner IN (
+                SELECT winner FROM matches
+                WHERE loser = ANY(ids) AND draw = FALSE AND bye = FALSE)
+            AND matches.draw = FALSE
+            AND matches.bye = FALSE
+        GROUP BY matches.winner
+    ), changes AS (
+        SELECT id, results.wins, results.losses, results.draws,
+               results.points, results.bye, omw.omw
+        FROM results FULL JOIN omw USING (id)
+    ), updated AS (
+        UPDATE player_totals
+        SET wins = player_totals.wins + COALESCE(changes.wins, 0),
+            losses = player_totals.losses + COALESCE(changes.losses, 0),
+            draws = player_totals.draws + COALESCE(changes.draws, 0),
+            points = player_totals.points + COALESCE(changes.points, 0),
+            bye = player_totals.bye OR COALESCE(changes.bye, FALSE),
+            omw = COALESCE(changes.omw, player_totals.omw)
+        FROM changes
+        WHERE player_totals.id = changes.id
+        RETURNING player_totals.registration, changes.wins IS NOT NULL AS played
+    )
+    SELECT registration FROM updated WHERE played;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Standings of every tournament; select one registration and order by
+-- points, omw, id to rank it, lowest ranked player first.  This reads
+-- player_totals in index order, nothing is aggregated.
 CREATE VIEW standings AS
-SELECT id, name, points, wins+losses+draws, bye
-FROM players
-WHERE registration = 'current'
-ORDER by points;
+SELECT player_totals.registration, player_totals.id, players.name,
+       player_totals.points,
+       player_totals.wins+player_totals.losses+player_totals.draws AS matches,
+       player_totals.bye, player_totals.omw
+FROM player_totals JOIN players ON players.id = player_totals.id;
+
+-- Completed tournaments archived by completeTournament(..., archive=True).
+-- Their players and matches are moved out of the live tables above into the
+-- tables below, which only the historical queries read; players are known by
+-- their id within a tournament and by name across tournaments.
+CREATE TABLE archived_tournaments (
+    name varchar(30) NOT NULL,
+    completed timestamp NOT NULL DEFAULT now(),
+    PRIMARY KEY(name)
+);
+
+-- The final standings of each archived tournament; place 1 is the winner
+CREATE TABLE archived_standings (
+    tournament varchar(30) NOT NULL REFERENCES archived_tournaments (name)
+        ON DELETE CASCADE,
+    id int NOT NULL,
+    name varchar(50) NOT NULL,
+    points int NOT NULL,
+    matches int NOT NULL,
+    bye boolean NOT NULL,
+    omw int NOT NULL,
+    place int NOT NULL,
+    PRIMARY KEY(tournament, id)
+);
+
+CREATE INDEX archived_standings_name_idx ON archived_standings (name);
+
+CREATE TABLE archived_matches (
+    tournament varchar(30) NOT NULL REFERENCES archived_tournaments (name)
+        ON DELETE CASCADE,
+    winner int NOT NULL,
+    loser int,
+    draw boolean NOT NULL,
+    bye boolean NOT NULL
+);
+
+-- Player ids are never reused, so a pair of ids finds the matches of two
+-- players in one tournament without scanning the others
+CREATE INDEX archived_matches_tournament_idx ON archived_matches (tournament);
+CREATE INDEX archived_matches_players_idx ON archived_matches (winner, loser);
 
 ALTER SEQUENCE players_id_seq RESTART WITH 1;
\ No newline at end of file
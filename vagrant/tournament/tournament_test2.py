@@ -1,6 +1,21 @@
 # Additional test cases
 
+import csv
+import json
+import select
+import threading
+from cStringIO import StringIO
+
+import psycopg2
+import psycopg2.extensions
+
+import tournament
 from tournament import *
+import engine
+from engine import Tournament
+import export
+import simulate
+import tiebreaks
 
 def testOddPlayers():
     """
@@ -186,6 +201,815 @@ def testRegistration():
 
     print "6. Keeping of completed tournaments in database is checked."
 
+def testConnectionPool():
+    """
+    Test that the functions borrow connections from the shared pool.
+    Correct behavior:
+    1. Repeated calls reuse pooled connections instead of opening new ones
+    2. A call that fails part way rolls back and still returns its connection
+    """
+    deleteMatches()
+    deletePlayers()
+    registerPlayer("Alien 1")
+    [id1] = [row[0] for row in playerStandings()]
+    reportMatch(id1, id1, False, True)
+    before = poolStats()
+    for i in range(20):
+        countPlayers()
+    try:
+        reportMatch(id1, id1, False, True)
+    except AssertionError:
+        pass
+    after = poolStats()
+    if after['created'] != before['created']:
+        raise ValueError(
+            "Pooled connections should be reused between calls."
+            )
+    if after['checkouts'] - before['checkouts'] != 21 or after['in_use'] != 0:
+        raise ValueError(
+            "Every call should check out one connection and return it."
+            )
+    if playerStandings()[0][3] != 1:
+        raise ValueError(
+            "A failed call should roll back its transaction."
+            )
+
+    print "7. Connections are pooled and returned after every call."
+
+def testReportRound():
+    """
+    Test that a whole round can be reported at once.
+    Round 1: A win B lose. C draw D draw. E bye.
+    Round 2: A win E lose, D bye, B bye, E bye (E already had a bye).
+    Correct behavior:
+    1. Round 1 is recorded exactly like separate reportMatch() calls would be
+    2. Round 2 is rejected as a whole and nothing of it is recorded
+    """
+    deleteMatches()
+    deletePlayers()
+    registerPlayer("Pikachu")
+    registerPlayer("Charmander")
+    registerPlayer("Bulbasaur")
+    registerPlayer("Squirtle")
+    registerPlayer("MewTwo")
+    standings = playerStandings()
+    [id1, id2, id3, id4, id5] = [row[0] for row in standings]
+    reportRound([(id1, id2), (id3, id4, True), (id5, id5, False, True)])
+    try:
+        reportRound([(id1, id5), (id4, id4, False, True),
+                     (id2, id2, False, True), (id5, id5, False, True)])
+    except AssertionError:
+        pass
+    else:
+        raise ValueError(
+            "reportRound() should reject a second bye for the same player."
+            )
+    points = dict((row[0], (row[2], row[3], row[4])) for row in playerStandings())
+    if points != {id1: (2, 1, False), id2: (0, 1, False), id3: (1, 1, False),
+                  id4: (1, 1, False), id5: (2, 1, True)}:
+        raise ValueError(
+            "reportRound() should record valid rounds and nothing of invalid"
+            " ones."
+            )
+
+    print "8. Whole rounds are reported in one transaction."
+
+def testBulkRegistration():
+    """
+    Test that players can be registered in bulk, from a list or a CSV file.
+    Correct behavior: every player is registered and the returned ids match
+    the players' names in input order.
+    """
+    deleteMatches()
+    deletePlayers()
+    names = ["Red Ranger", "", "Blue Ranger", 'Pink "Power" Ranger, Jr.']
+    ids = registerPlayers(names)
+    ids.extend(importPlayers(["id,name", "7,Green Ranger", "8,Yellow Ranger"],
+                             column="name"))
+    names.extend(["Green Ranger", "Yellow Ranger"])
+    registered = dict((row[0], row[1]) for row in playerStandings())
+    if countPlayers() != 6 or [registered.get(i) for i in ids] != names:
+        raise ValueError(
+            "Bulk registration should return the players' ids in input order."
+            )
+
+    print "9. Players can be registered in bulk."
+
+def testNoRematches():
+    """
+    Test that players are not paired with an opponent they already played.
+    Round 1: A win B lose. C win D lose.
+    Round 2: A win C lose. B win D lose.
+    Correct behavior: adjacent players in the standings have all played each
+    other, so round 3 has to pair A with D and B with C.
+    """
+    deleteMatches()
+    deletePlayers()
+    registerPlayer("Pikachu")
+    registerPlayer("Charmander")
+    registerPlayer("Bulbasaur")
+    registerPlayer("Squirtle")
+    standings = playerStandings()
+    [id1, id2, id3, id4] = [row[0] for row in standings]
+    reportMatch(id1, id2)
+    reportMatch(id3, id4)
+    reportMatch(id1, id3)
+    reportMatch(id2, id4)
+    pairings = swissPairings()
+    actual_pairs = set(frozenset([pid1, pid2]) for (pid1, n1, pid2, n2) in pairings)
+    if actual_pairs != set([frozenset([id1, id4]), frozenset([id2, id3])]):
+        raise ValueError(
+            "swissPairings() should avoid rematches when possible."
+            )
+
+    print "10. Rematches are avoided in pairings."
+
+def testTournamentEngine():
+    """
+    Test that the in-memory engine agrees with the database.
+    Round 1 is reported to the database, round 2 and 3 to the engine.
+    Correct behavior: the engine's standings and pairings match the ones
+    computed by the database once its results have been written.  An error
+    raised in the with block is not replaced by a failed write.
+    """
+    deleteMatches()
+    deletePlayers()
+    ids = registerPlayers(["Alien %d" % i for i in range(1, 8)])
+    reportRound([(ids[0], ids[1]), (ids[2], ids[3], True),
+                 (ids[4], ids[5]), (ids[6], ids[6], False, True)])
+    with Tournament() as event:
+        for round in range(2):
+            results = []
+            for (id1, name1, id2, name2) in event.swissPairings():
+                results.append((id1, id2, False, id1 == id2))
+            event.reportRound(results)
+        event.flush()
+        invalidateStandings()
+        if event.playerStandings() != playerStandings():
+            raise ValueError(
+                "The engine's standings should match the database's."
+                )
+        if event.swissPairings() != swissPairings():
+            raise ValueError(
+                "The engine's pairings should match the database's."
+                )
+
+    def failing(results, registration=None):
+        raise psycopg2.OperationalError("connection lost")
+    writeRound = tournament.reportRound
+    tournament.reportRound = failing
+    engineLog = engine.log.disabled
+    engine.log.disabled = True
+    try:
+        with Tournament() as event:
+            id1, name1, id2, name2 = [pairing for pairing
+                                      in event.swissPairings()
+                                      if pairing[0] != pairing[2]][0]
+            event.reportMatch(id1, id2)
+            raise KeyError("from the block")
+    except KeyError:
+        pass
+    except psycopg2.OperationalError:
+        raise ValueError(
+            "A failed write should not replace the block's exception."
+            )
+    finally:
+        tournament.reportRound = writeRound
+        engine.log.disabled = engineLog
+
+    print "11. The in-memory engine agrees with the database."
+
+def testStandingsCache():
+    """
+    Test that standings are cached and updated in place by match reports.
+    Correct behavior:
+    1. Reading the standings twice in a row is served from the cache
+    2. Reporting a match updates the cached standings without a new load
+    3. The updated standings match the ones read from the database
+    """
+    tournament.CACHE_STANDINGS = True
+    deleteMatches()
+    deletePlayers()
+    ids = registerPlayers(["Pikachu", "Charmander", "Bulbasaur", "Squirtle"])
+    playerStandings()
+    before = cacheStats()
+    playerStandings()
+    reportMatch(ids[0], ids[1])
+    reportMatch(ids[2], ids[3], True)
+    registerPlayer("MewTwo")
+    cached = playerStandings()
+    after = cacheStats()
+    if after['hits'] != before['hits'] + 1:
+        raise ValueError(
+            "Repeated standings reads should be served from the cache."
+            )
+    if after['misses'] != before['misses'] or after['updates'] != before['updates'] + 3:
+        raise ValueError(
+            "Changes should update the cached standings in place."
+            )
+    invalidateStandings()
+    if cached != playerStandings():
+        raise ValueError(
+            "Cached standings should match the database's."
+            )
+
+    print "12. Standings are cached and kept up to date."
+
+def testConcurrentTournaments():
+    """
+    Test that several tournaments can run side by side.
+    Correct behavior:
+    1. Each tournament's standings and pairings only include its own players
+    2. A match between players of different tournaments is rejected
+    3. Completing one tournament leaves the others untouched
+    """
+    deleteMatches()
+    deletePlayers()
+    spring = registerPlayers(["Red Ranger", "Blue Ranger"], "Spring Open")
+    summer = registerPlayers(["Pikachu", "Charmander", "Bulbasaur"], "Summer Open")
+    reportMatch(spring[1], spring[0], registration="Spring Open")
+    reportMatch(summer[2], summer[2], False, True, "Summer Open")
+    try:
+        reportMatch(spring[0], summer[0], registration="Spring Open")
+    except AssertionError:
+        pass
+    else:
+        raise ValueError(
+            "Players of different tournaments should not be matched."
+            )
+    if [row[0] for row in playerStandings("Spring Open")] != spring:
+        raise ValueError(
+            "Standings should only include the tournament's own players."
+            )
+    paired = set()
+    for (id1, name1, id2, name2) in swissPairings("Summer Open"):
+        paired.update([id1, id2])
+    if paired != set(summer) or countPlayers() != 0:
+        raise ValueError(
+            "Pairings should only include the tournament's own players."
+            )
+    completeTournament("Spring Open 2016", "Spring Open")
+    if not (countPlayers("Spring Open 2016") == 2 and
+            countPlayers("Summer Open") == 3 and
+            playerStandings("Summer Open")[2][2] == 2):
+        raise ValueError(
+            "Completing a tournament should not affect other tournaments."
+            )
+
+    print "13. Several tournaments can run at the same time."
+
+
+def testQueryStats():
+    """
+    Test the statistics recorded for each call to the tournament module.
+    Correct behavior:
+    1. Uncached standings take one statement, which fetches one row per player
+    2. reportRound() takes the same number of statements for any round size
+    3. The totals count every call
+    4. An EXPLAIN of a slow call's statement that fails leaves the call's
+       transaction usable
+    """
+    deleteMatches()
+    deletePlayers()
+    cached = tournament.CACHE_STANDINGS
+    tournament.CACHE_STANDINGS = False
+    tournament.resetQueryStats()
+    try:
+        ids = registerPlayers(["Mario", "Luigi", "Peach", "Toad"])
+        playerStandings()
+        last = tournament.lastQueryStats()
+        if not (last['function'] == 'playerStandings' and
+                last['statements'] == 1 and last['rows'] == 4):
+            raise ValueError(
+                "Standings should take one statement fetching every player."
+                )
+        reportRound([(ids[0], ids[1])])
+        small = tournament.lastQueryStats()['statements']
+        reportRound([(ids[0], ids[2]), (ids[1], ids[3])])
+        if tournament.lastQueryStats()['statements'] != small:
+            raise ValueError(
+                "reportRound() should not send a statement per match."
+                )
+        stats = tournament.queryStats()
+        if not (stats['reportRound']['calls'] == 2 and
+                stats['playerStandings']['calls'] == 1 and
+                stats['playerStandings']['rows'] == 4):
+            raise ValueError(
+                "queryStats() should total every call."
+                )
+        with tournament.transaction() as c:
+            c.execute('SELECT 1;')
+            plan = tournament._instrument._explain(
+                c, 'SELECT no_such_column;', None)[1]
+            c.execute('SELECT 2;')
+        if not plan.startswith('EXPLAIN failed'):
+            raise ValueError(
+                "A failed EXPLAIN should be reported in place of the plan."
+                )
+    finally:
+        tournament.CACHE_STANDINGS = cached
+
+    print "14. The database work of each call is recorded."
+
+
+
+def testArchive():
+    """
+    Test archiving completed tournaments.
+    Correct behavior:
+    1. Archiving removes the tournament's players and matches from the live
+       tables
+    2. Its final standings and matches can still be read from the archive
+    3. Head-to-head records and player histories span archived tournaments
+    4. A name can only be archived once
+    """
+    deleteMatches()
+    deletePlayers()
+    deleteArchived()
+    for event in ["Winter Cup", "Spring Cup"]:
+        [mario, luigi, peach] = registerPlayers(["Mario", "Luigi", "Peach"],
+                                                event)
+        reportRound([(mario, luigi), (peach, peach, False, True)], event)
+        if event == "Winter Cup":
+            reportRound([(peach, mario), (luigi, luigi, False, True)], event)
+        else:
+            reportRound([(luigi, mario, True), (mario, mario, False, True)],
+                        event)
+        standings = playerStandings(event)
+        completeTournament(event, event, archive=True)
+        if countPlayers(event) != 0 or playerStandings(event) != []:
+            raise ValueError(
+                "An archived tournament should leave the live tables."
+                )
+        if pastStandings(event) != standings:
+            raise ValueError(
+                "The archive should keep the final standings."
+                )
+    if headToHead("Mario", "Luigi") != [("Winter Cup", 1, 0, 0),
+                                        ("Spring Cup", 1, 0, 1)]:
+        raise ValueError(
+            "Head-to-head records should cover every archived tournament."
+            )
+    history = playerHistory("Peach")
+    if not ([row[0] for row in history] == ["Winter Cup", "Spring Cup"] and
+            history[0][6] == 1 and history[1][2] == 2):
+        raise ValueError(
+            "A player's history should list every archived tournament."
+            )
+    try:
+        completeTournament("Winter Cup", archive=True)
+    except AssertionError:
+        pass
+    else:
+        raise ValueError(
+            "A tournament name should only be archived once."
+            )
+    deleteArchived()
+
+    print "15. Completed tournaments can be archived."
+
+
+def testSimulation():
+    """
+    Test the simulation of the remaining rounds.
+    Correct behavior:
+    1. With no rounds left, the players in the top cut qualify for certain
+    2. Every playout qualifies exactly as many players as the cut
+    3. The same seed gives the same chances in one or several processes
+    4. The tournament in the database is left as it was
+    """
+    deleteMatches()
+    deletePlayers()
+    ids = registerPlayers(["Mario", "Luigi", "Peach", "Toad", "Yoshi", "Wario"])
+    reportRound([(ids[0], ids[1]), (ids[2], ids[3]), (ids[4], ids[5], True)])
+    standings = playerStandings()
+    chances = simulate.simulate(0, cut=2, playouts=10, processes=1)
+    top = set(row[0] for row in standings[-2:])
+    if [row[0] for row in chances if row[3] == 1] != [id for id in ids
+                                                      if id in top]:
+        raise ValueError(
+            "With no rounds left, the top cut should be certain."
+            )
+    chances = simulate.simulate(2, cut=2, playouts=200, processes=1, seed=7)
+    if abs(sum(row[3] for row in chances) - 2) > 1e-9:
+        raise ValueError(
+            "Every playout should qualify as many players as the cut."
+            )
+    if simulate.simulate(2, cut=2, playouts=200, processes=2,
+                         seed=7) != chances:
+        raise ValueError(
+            "The chances should only depend on the seed."
+            )
+    if playerStandings() != standings:
+        raise ValueError(
+            "Simulating should not change the tournament."
+            )
+
+    print "16. The chances of making the top cut are simulated."
+
+
+def testTiebreaks():
+    """
+    Test ranking players with equal points by other tiebreaks.
+    Round 1: A win B lose. C win D lose. E win F lose.
+    Round 2: A win C lose. D win E lose. B win F lose.
+    Correct behavior:
+    1. Buchholz: A-4 points. B-4 points. C-6 points. D-4 points. E-2 points.
+       F-4 points.
+    2. By OMW, the standings are F, B, E, C, D, A
+    3. By Buchholz, the standings are F, E, B, D, C, A, with or without the
+       standings cache
+    4. Archived by Buchholz, the final standings keep that order, and B and
+       D share third place
+    """
+    deleteMatches()
+    deletePlayers()
+    ids = registerPlayers(["A", "B", "C", "D", "E", "F"])
+    [a, b, c, d, e, f] = ids
+    reportRound([(a, b), (c, d), (e, f)])
+    reportRound([(a, c), (d, e), (b, f)])
+    standings = playerStandings()
+    if [row[0] for row in standings] != [f, b, e, c, d, a]:
+        raise ValueError(
+            "Players with equal points should be ranked by OMW."
+            )
+    buchholz = tiebreaks.compute(standings, loadEvent().matches,
+                                 ['buchholz'])['buchholz']
+    if dict(zip([row[0] for row in standings], buchholz)) != {
+            a: 4, b: 4, c: 6, d: 4, e: 2, f: 4}:
+        raise ValueError(
+            "Buchholz should sum the points of every opponent."
+            )
+    chain = tiebreaks.CHAIN
+    cached = tournament.CACHE_STANDINGS
+    tiebreaks.CHAIN = ('buchholz',)
+    try:
+        for tournament.CACHE_STANDINGS in (True, False):
+            invalidateStandings()
+            if [row[0] for row in playerStandings()] != [f, e, b, d, c, a]:
+                raise ValueError(
+                    "Players with equal points should be ranked by the "
+                    "configured tiebreaks."
+                    )
+        completeTournament("Tiebreak Cup", archive=True)
+        places = dict((row[1], row[6]) for name in ["B", "D"]
+                      for row in playerHistory(name))
+        if not ([row[0] for row in pastStandings("Tiebreak Cup")] ==
+                [f, e, b, d, c, a] and places == {b: 3, d: 3}):
+            raise ValueError(
+                "Archived standings should be ranked by the configured "
+                "tiebreaks."
+                )
+    finally:
+        tiebreaks.CHAIN = chain
+        tournament.CACHE_STANDINGS = cached
+        invalidateStandings()
+        deleteArchived("Tiebreak Cup")
+
+    print "17. Players with equal points are ranked by the configured tiebreaks."
+
+
+def testRounds():
+    """
+    Test reporting results against the pairings of a round.
+    Correct behavior:
+    1. startRound() records swissPairings() with a pairing id for each match
+    2. A result must name a player of its pairing
+    3. A pairing reported many times at once is counted once
+    4. The next round can only start once every pairing has been reported
+    5. Deleting every tournament's matches waits for a round being started,
+       as startRound() reads the tournament under its lock
+    """
+    deleteMatches()
+    deletePlayers()
+    ids = registerPlayers(["Mario", "Luigi", "Peach", "Toad", "Yoshi"])
+    pairings = startRound()
+    if [row[1:] for row in pairings] != swissPairings():
+        raise ValueError(
+            "startRound() should record the pairings of swissPairings()."
+            )
+    try:
+        startRound()
+    except AssertionError:
+        pass
+    else:
+        raise ValueError(
+            "A round should not start before the previous one is reported."
+            )
+    (bye, player, name, player, name) = pairings[0]
+    (first, id1, name1, id2, name2) = pairings[1]
+    (second, id3, name3, id4, name4) = pairings[2]
+    try:
+        reportPairing(first, id3)
+    except AssertionError:
+        pass
+    else:
+        raise ValueError(
+            "The winner should be one of the pairing's players."
+            )
+    reportPairing(bye, player)
+    reportPairing(second, id4, True)
+    rejected = []
+    def report():
+        try:
+            reportPairing(first, id2)
+        except AssertionError:
+            rejected.append(first)
+    threads = [threading.Thread(target=report) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if pendingPairings() != [] or len(rejected) != 4:
+        raise ValueError(
+            "Every pairing should be reported."
+            )
+    points = dict((row[0], row[2]) for row in playerStandings())
+    if points != {player: 2, id1: 0, id2: 2, id3: 1, id4: 1}:
+        raise ValueError(
+            "Each pairing should be counted once."
+            )
+    if len(startRound()) != 3:
+        raise ValueError(
+            "The next round should start once every pairing is reported."
+            )
+    starting = psycopg2.connect(tournament.DSN)
+    try:
+        # Holds the tournament's lock as startRound() does
+        starting.cursor().execute('SELECT pg_advisory_xact_lock(hashtext(%s));',
+                                  [tournament.CURRENT])
+        delete = threading.Thread(target=deleteMatches)
+        delete.start()
+        delete.join(1)
+        waited = delete.is_alive()
+    finally:
+        starting.close()
+    delete.join()
+    if not waited:
+        raise ValueError(
+            "Deleting every match should wait for a tournament's lock."
+            )
+
+    print "18. Results are reported against the pairings of each round."
+
+
+def testExport():
+    """
+    Test exporting a tournament as newline delimited JSON and CSV.
+    Correct behavior:
+    1. The standings are exported first place first, in either format
+    2. Every pairing of every round is exported
+    3. An export of the matches given the cursor of the previous one only
+       includes the matches reported since
+    """
+    deleteMatches()
+    deletePlayers()
+    ids = registerPlayers(["Mario", "Luigi", "Peach", "Toad"])
+    pairings = startRound()
+    out = StringIO()
+    if export.exportPairings(out) != 2 or [
+            json.loads(line)["pairing"] for line in out.getvalue().splitlines()
+            ] != [row[0] for row in pairings]:
+        raise ValueError(
+            "Every pairing should be exported."
+            )
+    reportPairing(pairings[0][0], pairings[0][1])
+    out = StringIO()
+    cursor = export.exportMatches(out)
+    if len(out.getvalue().splitlines()) != 1:
+        raise ValueError(
+            "Every match reported should be exported."
+            )
+    reportPairing(pairings[1][0], pairings[1][3], True)
+    out = StringIO()
+    export.exportMatches(out, since=cursor, format="csv")
+    rows = list(csv.DictReader(StringIO(out.getvalue())))
+    if not (len(rows) == 1 and rows[0]["pairing"] == str(pairings[1][0]) and
+            rows[0]["draw"] == "t"):
+        raise ValueError(
+            "An incremental export should only include the new matches."
+            )
+    for format in export.FORMATS:
+        out = StringIO()
+        export.exportStandings(out, format=format)
+        if format == "csv":
+            exported = [int(row["id"]) for row in
+                        csv.DictReader(StringIO(out.getvalue()))]
+        else:
+            exported = [json.loads(line)["id"]
+                        for line in out.getvalue().splitlines()]
+        if exported != [row[0] for row in playerStandings()][::-1]:
+            raise ValueError(
+                "The standings should be exported first place first."
+                )
+
+    print "19. Tournaments can be exported as JSON or CSV."
+
+
+def testNotifications():
+    """
+    Test the notifications sent when a tournament changes.
+    Correct behavior:
+    1. Registrations and reports notify the tournament's registration on
+       tournament.NOTIFY_CHANNEL once committed
+    2. A report that is rejected notifies nothing
+    3. Deleting the matches or players of every tournament notifies each
+       tournament that had players
+    """
+    deleteMatches()
+    deletePlayers()
+    listener = psycopg2.connect(tournament.DSN)
+    listener.set_isolation_level(
+        psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    listener.cursor().execute('LISTEN %s;' % tournament.NOTIFY_CHANNEL)
+
+    def received():
+        payloads = []
+        while select.select([listener], [], [], 0.2)[0]:
+            listener.poll()
+            payloads.extend(notify.payload for notify in listener.notifies)
+            del listener.notifies[:]
+        return payloads
+
+    try:
+        id1 = registerPlayer("Ryu")
+        id2, id3 = registerPlayers(["Ken", "Guile"], "street")
+        if received() != [tournament.CURRENT, "street"]:
+            raise ValueError(
+                "Registrations should notify their tournament."
+                )
+        reportMatch(id2, id3, registration="street")
+        if received() != ["street"]:
+            raise ValueError(
+                "Reports should notify their tournament."
+                )
+        try:
+            reportMatch(id1, id2)
+        except AssertionError:
+            pass
+        if received():
+            raise ValueError(
+                "A rejected report should notify nothing."
+                )
+        deleteMatches()
+        if sorted(received()) != sorted([tournament.CURRENT, "street"]):
+            raise ValueError(
+                "Deleting every match should notify every tournament."
+                )
+        deletePlayers()
+        if sorted(received()) != sorted([tournament.CURRENT, "street"]):
+            raise ValueError(
+                "Deleting every player should notify every tournament."
+                )
+    finally:
+        listener.close()
+        deleteMatches("street")
+        deletePlayers("street")
+
+    print "20. Changes to a tournament are announced with NOTIFY."
+
+
+def testCacheRace():
+    """
+    Test a standings read that runs between a report's commit and the update
+    of the cache.
+    Correct behavior: the report is counted once, the standings match the
+    database's.
+    """
+    deleteMatches()
+    deletePlayers()
+    cached = tournament.CACHE_STANDINGS
+    updateCache = tournament._updateCache
+    tournament.CACHE_STANDINGS = True
+
+    def readFirst(registration, txid, update):
+        # The read misses the cache and loads the committed report
+        invalidateStandings(registration)
+        playerStandings(registration)
+        updateCache(registration, txid, update)
+
+    def checkStandings():
+        standings = playerStandings()
+        tournament.CACHE_STANDINGS = False
+        if standings != playerStandings():
+            raise ValueError(
+                "A report should be counted once in the cached standings."
+                )
+        tournament.CACHE_STANDINGS = True
+
+    try:
+        ids = registerPlayers(["Sonic", "Tails", "Knuckles", "Amy"])
+        tournament._updateCache = readFirst
+        reportMatch(ids[0], ids[1])
+        checkStandings()
+        pairings = [row for row in startRound() if row[1] != row[3]]
+        reportPairing(pairings[0][0], pairings[0][1])
+        checkStandings()
+        registerPlayer("Shadow")
+        checkStandings()
+    finally:
+        tournament._updateCache = updateCache
+        tournament.CACHE_STANDINGS = cached
+
+    print "21. Reads that race a report leave the cache consistent."
+
+
+def testSingleConnection():
+    """
+    Test that each call needs no more than one pooled connection.
+    Correct behavior: startRound() works with a pool of one connection, with
+    the standings cached or not.
+    """
+    deleteMatches()
+    deletePlayers()
+    cached = tournament.CACHE_STANDINGS
+    pool = tournament._pool
+    tournament.configurePool(maxconn=1, timeout=3)
+    try:
+        ids = registerPlayers(["Zelda", "Link", "Ganon", "Impa", "Midna"])
+        for cache in (True, False):
+            tournament.CACHE_STANDINGS = cache
+            invalidateStandings()
+            pairings = startRound()
+            for pairing, id1, name1, id2, name2 in pairings:
+                reportPairing(pairing, id1)
+        if len(pendingPairings()) != 0 or len(pairings) != 3:
+            raise ValueError(
+                "startRound() should pair every player on one connection."
+                )
+    finally:
+        tournament.CACHE_STANDINGS = cached
+        tournament.configurePool(maxconn=pool.maxconn, timeout=pool.timeout)
+
+    print "22. startRound() needs a single pooled connection."
+
+def testCacheLocks():
+    """
+    Test that a tournament read into the cache does not hold up the others.
+    Correct behavior: while one tournament's read is stalled, the standings
+    of another are served and its reports applied; the stalled tournament's
+    own report waits for the read and is counted once.
+    """
+    deleteMatches()
+    deletePlayers()
+    cached = tournament.CACHE_STANDINGS
+    readEvent = tournament._readEvent
+    tournament.CACHE_STANDINGS = True
+    reading = threading.Event()
+    release = threading.Event()
+
+    def stalled(c, registration):
+        if registration == "slow":
+            reading.set()
+            release.wait(10)
+        return readEvent(c, registration)
+
+    slow = registerPlayers(["Mario", "Luigi"], "slow")
+    fast = registerPlayers(["Peach", "Daisy"], "fast")
+    invalidateStandings()
+    playerStandings("fast")
+    results = {}
+    def read():
+        results["slow"] = playerStandings("slow")
+    def report():
+        reportMatch(slow[0], slow[1], registration="slow")
+    threads = [threading.Thread(target=read)]
+    try:
+        tournament._readEvent = stalled
+        threads[0].start()
+        if not reading.wait(10):
+            raise ValueError("The slow tournament should be read.")
+        threads.append(threading.Thread(target=report))
+        threads[1].start()
+        fastThread = threading.Thread(
+            target=lambda: reportMatch(fast[0], fast[1],
+                                       registration="fast"))
+        fastThread.start()
+        fastThread.join(5)
+        if fastThread.is_alive() or "slow" in results:
+            raise ValueError(
+                "Another tournament should not wait for a stalled read."
+                )
+        if sorted(row[2] for row in playerStandings("fast")) != [0, 2]:
+            raise ValueError(
+                "Another tournament's report should be applied meanwhile."
+                )
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join()
+        tournament._readEvent = readEvent
+    try:
+        if sorted(row[2] for row in playerStandings("slow")) != [0, 2]:
+            raise ValueError(
+                "The stalled tournament's report should be counted once."
+                )
+    finally:
+        tournament.CACHE_STANDINGS = cached
+        deleteMatches()
+        deletePlayers()
+
+    print "23. A stalled read of one tournament does not hold up the others."
 
 if __name__ == '__main__':
     testOddPlayers()
@@ -194,6 +1018,23 @@ if __name__ == '__main__':
     testPointSystem()
     testOMW()
     testRegistration()
+    testConnectionPool()
+    testReportRound()
+    testBulkRegistration()
+    testNoRematches()
+    testTournamentEngine()
+    testStandingsCache()
+    testConcurrentTournaments()
+    testQueryStats()
+    testArchive()
+    testSimulation()
+    testTiebreaks()
+    testRounds()
+    testExport()
+    testNotifications()
+    testCacheRace()
+    testSingleConnection()
+    testCacheLocks()
     print "Success!  All tests pass!"
 
 